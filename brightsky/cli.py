@@ -7,6 +7,7 @@ from fastapi.testclient import TestClient
 from huey.consumer_options import ConsumerConfig
 
 from brightsky import db, tasks
+from brightsky.settings import settings
 from brightsky.utils import parse_date
 from brightsky.web import app
 from brightsky.worker import huey
@@ -49,7 +50,13 @@ def migrate():
     nargs=-1,
     metavar='TARGET [TARGET ...]',
 )
-def parse(targets):
+@click.option(
+    '--merge', is_flag=True,
+    help='Merge records of the targets and export them at once')
+def parse(targets, merge):
+    if merge:
+        tasks.parse_merged(targets)
+        return
     for target in targets:
         tasks.parse(target)
 
@@ -73,8 +80,13 @@ def clean():
 
 @cli.command()
 @click.option('--workers', default=3, type=int, help='Number of threads')
-def work(workers):
+@click.option(
+    '--parse-processes', type=int,
+    help='Number of processes for parsing large files (0: parse in threads)')
+def work(workers, parse_processes):
     """Start brightsky worker."""
+    if parse_processes is not None:
+        settings['PARSE_PROCESSES'] = parse_processes
     huey.flush()
     config = ConsumerConfig(worker_type='thread', workers=workers)
     config.validate()
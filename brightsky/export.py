@@ -1,12 +1,30 @@
+import datetime
 import functools
+import hashlib
+import io
 import logging
+import math
+import operator
+import queue
+import struct
+import threading
+import time
+from contextlib import closing, contextmanager, nullcontext
 from itertools import islice
-from threading import Lock
 
+import numpy as np
+import psycopg2
 from psycopg2 import sql
 from psycopg2.extras import execute_values
 
 from brightsky.db import get_connection
+from brightsky.settings import settings
+from brightsky.storage import (
+    COMPACT_WEATHER_TABLE,
+    encode_column,
+    encode_record,
+    weather_table,
+)
 
 
 logger = logging.getLogger(__name__)
@@ -18,11 +36,317 @@ def batched(it, batch_size):
         yield batch
 
 
+def batched_rows(it, batch_size, key=None):
+    """
+    Like `batched`, but count each `RecordBatch` in `it` as its number of
+    rows, so that batches of columnar and dict records are of similar size.
+
+    With `key`, a full batch is only cut where the key of the next item
+    differs from the key of the last one, so that consecutive items with the
+    same key always end up in the same batch.
+    """
+    batch, rows = [], 0
+    for item in it:
+        if key and rows >= batch_size and key(item) != key(batch[-1]):
+            yield tuple(batch)
+            batch, rows = [], 0
+        batch.append(item)
+        rows += len(item) if isinstance(item, RecordBatch) else 1
+        if not key and rows >= batch_size:
+            yield tuple(batch)
+            batch, rows = [], 0
+    if batch:
+        yield tuple(batch)
+
+
+def iter_records(it):
+    """Yield record dicts from `it`, unpacking any `RecordBatch` items"""
+    for item in it:
+        if isinstance(item, RecordBatch):
+            yield from item.to_records()
+        else:
+            yield item
+
+
+class RecordBatch:
+    """
+    Column-oriented batch of records that share their source.
+
+    Parsers may yield these instead of (or mixed with) record dicts.
+    `source` maps the exporter's source fields to their values, `timestamps`
+    holds UTC timestamps (as `datetime64` values or naive datetimes), and
+    `columns` maps element fields to NumPy arrays of the same length.
+    `valid` maps element fields to boolean masks of non-null values, fields
+    without a mask are null wherever their value is NaN (for float arrays) or
+    None (for object arrays). Element fields missing from `columns` are
+    treated like keys missing from record dicts, i.e. they are left untouched
+    when updating existing rows.
+    """
+
+    def __init__(self, source, timestamps, columns, valid=None):
+        self.source = source
+        self.timestamps = np.asarray(timestamps, dtype='datetime64[us]')
+        self.columns = {
+            field: np.asarray(values) for field, values in columns.items()}
+        self.valid = {
+            field: self.get_valid(field, (valid or {}).get(field))
+            for field in self.columns
+        }
+        assert self.columns, "Got record batch without element fields"
+        assert all(
+            len(values) == len(self.timestamps)
+            for values in self.columns.values())
+
+    def get_valid(self, field, valid):
+        values = self.columns[field]
+        if valid is not None:
+            return np.asarray(valid, dtype=bool)
+        elif values.dtype.kind == 'f':
+            return ~np.isnan(values)
+        elif values.dtype.kind == 'O':
+            return values != None  # noqa: E711
+        return np.ones(len(values), dtype=bool)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __repr__(self):
+        return (
+            f'<RecordBatch {self.source.get("station_name")!r}: '
+            f'{len(self)} records with fields {tuple(self.columns)}>')
+
+    def to_records(self):
+        timestamps = [
+            ts.replace(tzinfo=datetime.timezone.utc)
+            for ts in self.timestamps.tolist()]
+        columns = {
+            field: [
+                value if valid else None
+                for value, valid in zip(
+                    values.tolist(), self.valid[field].tolist())
+            ]
+            for field, values in self.columns.items()
+        }
+        for i, timestamp in enumerate(timestamps):
+            yield {
+                **self.source,
+                'timestamp': timestamp,
+                **{field: values[i] for field, values in columns.items()},
+            }
+
+
+def pipelined_batches(it, batch_size, depth, key=None):
+    """
+    Like `batched_rows`, but consume `it` in a background thread that stays up
+    to `depth` batches ahead, so that parsing the next batch overlaps with
+    exporting the current one.
+
+    Exceptions raised while consuming `it` are re-raised in the calling
+    thread. Closing the generator stops the background thread.
+    """
+    batches = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    timings = {'parse': 0, 'export': 0, 'wait': 0}
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            return True
+        return False
+
+    def produce():
+        try:
+            start = time.perf_counter()
+            for batch in batched_rows(it, batch_size, key=key):
+                timings['parse'] += time.perf_counter() - start
+                if not put(batch):
+                    return
+                start = time.perf_counter()
+        except BaseException as e:
+            put(e)
+        else:
+            put(None)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            start = time.perf_counter()
+            batch = batches.get()
+            timings['wait'] += time.perf_counter() - start
+            if batch is None:
+                break
+            elif isinstance(batch, BaseException):
+                raise batch
+            start = time.perf_counter()
+            yield batch
+            timings['export'] += time.perf_counter() - start
+    finally:
+        stop.set()
+        producer.join()
+        logger.info(
+            "Pipeline timings: %.2f s parsing, %.2f s exporting, %.2f s "
+            "waiting for parser",
+            timings['parse'], timings['export'], timings['wait'])
+
+
+class BinaryCopyWriter:
+    """Serialize rows into PostgreSQL's binary COPY format"""
+
+    HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+    TRAILER = struct.pack('!h', -1)
+    PG_EPOCH = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+    NULL = struct.pack('!i', -1)
+
+    def __init__(self, column_types):
+        self.encoders = [self.get_encoder(t) for t in column_types]
+        self.buf = io.BytesIO()
+        self.buf.write(self.HEADER)
+        self.row_header = struct.pack('!h', len(self.encoders))
+
+    def get_encoder(self, column_type):
+        encoders = {
+            'timestamp with time zone': self.encode_timestamp,
+            'integer': functools.partial(self.encode_int, fmt='!i'),
+            'smallint': functools.partial(self.encode_int, fmt='!h'),
+            'real': functools.partial(self.encode_struct, fmt='!f'),
+            'double precision': functools.partial(
+                self.encode_struct, fmt='!d'),
+        }
+        # Everything else (enums, varchar, text) is sent as its text
+        # representation, which is also what the binary input functions of
+        # these types expect
+        return encoders.get(column_type, self.encode_text)
+
+    def encode_struct(self, value, fmt):
+        data = struct.pack(fmt, value)
+        return struct.pack('!i', len(data)) + data
+
+    def encode_int(self, value, fmt):
+        # Mimic Postgres' assignment cast from numeric to integer types, which
+        # rounds half away from zero
+        if not isinstance(value, int):
+            value = int(math.copysign(math.floor(abs(value) + 0.5), value))
+        return self.encode_struct(value, fmt)
+
+    def encode_timestamp(self, value):
+        us = (value - self.PG_EPOCH) // datetime.timedelta(microseconds=1)
+        return self.encode_struct(us, '!q')
+
+    def encode_text(self, value):
+        data = str(value).encode()
+        return struct.pack('!i', len(data)) + data
+
+    def write_row(self, row):
+        self.buf.write(self.row_header)
+        for encoder, value in zip(self.encoders, row):
+            self.buf.write(self.NULL if value is None else encoder(value))
+
+    # Big-endian NumPy types of the fixed-width binary representations
+    COLUMN_DTYPES = {
+        'timestamp with time zone': '>i8',
+        'integer': '>i4',
+        'smallint': '>i2',
+        'real': '>f4',
+        'double precision': '>f8',
+    }
+
+    def write_columns(self, column_types, columns):
+        """
+        Write rows given as columns, i.e. `(values, valid)` pairs of NumPy
+        arrays, without touching every value in Python.
+
+        `column_types` must match the types this writer was created with.
+        Values of fixed-width types are cast and scattered into the output
+        buffer column by column; only text columns are encoded per value.
+        """
+        n = len(columns[0][0])
+        cells = []
+        for column_type, (values, valid) in zip(column_types, columns):
+            values = values[valid]
+            if column_type == 'timestamp with time zone':
+                values = (
+                    values.astype('datetime64[us]') -
+                    np.datetime64('2000-01-01T00:00:00', 'us')
+                ).astype('int64')
+            elif column_type in ('integer', 'smallint') and (
+                    values.dtype.kind in 'fO'):
+                # Round half away from zero, like `encode_int`
+                values = values.astype(float)
+                values = np.copysign(
+                    np.floor(np.abs(values) + 0.5), values)
+            dtype = self.COLUMN_DTYPES.get(column_type)
+            if dtype:
+                width = np.dtype(dtype).itemsize
+                data = np.ascontiguousarray(
+                    values, dtype=dtype).view(np.uint8)
+                lengths = np.where(valid, width, -1)
+            else:
+                encoded = [str(v).encode() for v in values.tolist()]
+                data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+                lengths = np.full(n, -1)
+                lengths[valid] = [len(e) for e in encoded]
+            cells.append((valid, data, lengths))
+        row_sizes = 2 + sum(
+            4 + np.maximum(lengths, 0) for _, _, lengths in cells)
+        row_starts = np.cumsum(row_sizes) - row_sizes
+        buf = np.empty(int(row_sizes.sum()), dtype=np.uint8)
+        self._scatter(buf, row_starts, np.array([len(cells)], '>i2'), 2)
+        pos = row_starts + 2
+        for valid, data, lengths in cells:
+            self._scatter(buf, pos, lengths.astype('>i4'), 4)
+            pos += 4
+            sizes = np.maximum(lengths, 0)
+            # Offsets of every data byte: the start of its cell plus its
+            # index within the cell
+            starts = np.repeat(pos[valid], sizes[valid])
+            within = np.arange(len(data)) - np.repeat(
+                np.cumsum(sizes[valid]) - sizes[valid], sizes[valid])
+            buf[starts + within] = data
+            pos += sizes
+        self.buf.write(buf.tobytes())
+
+    @staticmethod
+    def _scatter(buf, starts, values, width):
+        values = np.broadcast_to(
+            np.ascontiguousarray(values).view(np.uint8).reshape(-1, width),
+            (len(starts), width))
+        buf[starts[:, np.newaxis] + np.arange(width)] = values
+
+    def getbuffer(self):
+        self.buf.write(self.TRAILER)
+        self.buf.seek(0)
+        return self.buf
+
+
 class DBExporter:
 
-    # The ON CONFLICT clause won't change anything in most cases, but it
-    # ensures that the row is always returned (so that we can build the source
-    # map).
+    # Existing sources are looked up before inserting new ones, as every
+    # INSERT consumes a sequence value even if it ends up in the ON CONFLICT
+    # branch
+    FIND_SOURCES_STMT = """
+        SELECT v.idx, sources.id
+        FROM sources
+        JOIN (VALUES %s) AS v (
+            idx, observation_type, lat, lon, height, dwd_station_id,
+            wmo_station_id, station_name)
+        ON
+            sources.observation_type = v.observation_type::observation_type AND
+            sources.lat = v.lat::real AND
+            sources.lon = v.lon::real AND
+            sources.height = v.height::real AND
+            sources.dwd_station_id IS NOT DISTINCT FROM v.dwd_station_id AND
+            sources.wmo_station_id IS NOT DISTINCT FROM v.wmo_station_id AND
+            sources.station_name = v.station_name;
+    """
+    # The ON CONFLICT clause only comes into play if a concurrent exporter
+    # inserted the same source, or if a source's station IDs or name changed,
+    # but it ensures that the row is always returned (so that we can build the
+    # source map). Rows are sent ordered by their unique key so that
+    # concurrent exporters cannot deadlock each other.
     UPDATE_SOURCES_STMT = """
         INSERT INTO sources (
             observation_type, lat, lon, height, dwd_station_id, wmo_station_id,
@@ -39,10 +363,25 @@ class DBExporter:
                     sources.last_record, EXCLUDED.last_record)
         RETURNING id;
     """
-    UPDATE_SOURCES_CLEANUP = """
-        SELECT setval('sources_id_seq', (SELECT max(id) FROM sources));
+    LOCK_SOURCES_STMT = """
+        SELECT id FROM sources WHERE id = ANY(%s) ORDER BY id FOR UPDATE;
+    """
+    UPDATE_RECORD_RANGES_STMT = """
+        UPDATE sources SET
+            first_record = LEAST(sources.first_record, ranges.first_record),
+            last_record = GREATEST(sources.last_record, ranges.last_record)
+        FROM (VALUES %s) AS ranges (id, first_record, last_record)
+        WHERE
+            sources.id = ranges.id AND (
+                sources.first_record IS NULL OR
+                sources.last_record IS NULL OR
+                ranges.first_record < sources.first_record OR
+                ranges.last_record > sources.last_record
+            );
     """
     WEATHER_TABLE = 'weather'
+    # Whether `settings.WEATHER_STORAGE` selects the table and its encoding
+    STORAGE_CONFIGURABLE = True
     UPDATE_WEATHER_STMT = sql.SQL("""
         INSERT INTO {weather_table} (timestamp, source_id, {fields})
         VALUES %s
@@ -53,6 +392,56 @@ class DBExporter:
     UPDATE_WEATHER_CONFLICT_UPDATE = '{field} = EXCLUDED.{field}'
     UPDATE_WEATHER_VALUES_TEMPLATE = '(%(timestamp)s, %(source_id)s, {values})'
     UPDATE_WEATHER_CLEANUP = None
+    # Statements for the 'copy' and 'merge' export methods. Records are
+    # loaded into a session-local staging table (temporary tables are never
+    # WAL-logged), either through binary COPY or a single multi-row INSERT,
+    # and then merged into the weather table in a single statement per batch.
+    # The `present` bitmask marks which element fields a record actually
+    # carried, so that conflicting rows keep their values for all other
+    # fields, just like the per-field-set statements of the 'insert' method
+    # do.
+    CREATE_STAGING_STMT = sql.SQL("""
+        CREATE TEMPORARY TABLE IF NOT EXISTS {staging_table} (
+            LIKE {weather_table},
+            present integer NOT NULL,
+            PRIMARY KEY (source_id, timestamp)
+        ) ON COMMIT DELETE ROWS;
+        TRUNCATE {staging_table};
+    """)
+    COPY_STAGING_STMT = sql.SQL("""
+        COPY {staging_table} (timestamp, source_id, present, {fields})
+        FROM STDIN WITH (FORMAT binary)
+    """)
+    INSERT_STAGING_STMT = sql.SQL("""
+        INSERT INTO {staging_table} (timestamp, source_id, present, {fields})
+        VALUES %s
+    """)
+    MERGE_STAGING_STMT = sql.SQL("""
+        INSERT INTO {weather_table} (timestamp, source_id, {fields})
+        SELECT timestamp, source_id, {fields}
+        FROM {staging_table}
+        ORDER BY source_id, timestamp
+        ON CONFLICT
+            ON CONSTRAINT {constraint} DO UPDATE SET
+                ({fields}) = (
+                    SELECT {conflict_updates}
+                    FROM {staging_table} s
+                    WHERE
+                        s.source_id = EXCLUDED.source_id AND
+                        s.timestamp = EXCLUDED.timestamp
+                );
+    """)
+    MERGE_STAGING_CONFLICT_UPDATE = """
+        CASE
+            WHEN s.present & {bit} = 0 THEN {weather_table}.{field}
+            ELSE {update}
+        END
+    """
+    MERGE_STAGING_CONFLICT_VALUE = 's.{field}'
+    COPY_SUPPORTED = True
+    # Whether `RecordBatch` items are copied into the staging table directly
+    # (with the 'copy' export method), instead of being unpacked into dicts
+    COLUMNS_SUPPORTED = True
     SOURCE_FIELDS = [
         'observation_type', 'lat', 'lon', 'height', 'dwd_station_id',
         'wmo_station_id', 'station_name']
@@ -75,28 +464,241 @@ class DBExporter:
         'wind_gust_speed',
     ]
 
-    sources_update_lock = Lock()
+    # Namespace for transaction-level advisory locks, see `lock_shards`
+    ADVISORY_LOCK_NAMESPACE = None
+    ADVISORY_LOCK_SHARDS = 64
+
+    # Digests of exported records per source, day, and field set, used to skip
+    # unchanged records when DWD re-publishes observation archives (see
+    # `skip_unchanged`). Only enabled for observation types that no other
+    # product writes to.
+    DIGEST_TABLE = 'weather_digests'
+    DIGEST_OBSERVATION_TYPES = ['historical']
+    FIND_DIGESTS_STMT = sql.SQL("""
+        SELECT source_id, day, fields, digest
+        FROM {digest_table}
+        WHERE (source_id, day, fields) IN (VALUES %s)
+    """)
+    CLEAR_DIGESTS_STMT = sql.SQL("""
+        DELETE FROM {digest_table} d
+        USING unnest(%s::int[], %s::date[]) AS k(source_id, day)
+        WHERE d.source_id = k.source_id AND d.day = k.day
+    """)
+    UPDATE_DIGESTS_STMT = sql.SQL("""
+        INSERT INTO {digest_table} (source_id, day, fields, digest)
+        VALUES %s
+        ON CONFLICT
+            ON CONSTRAINT {constraint} DO UPDATE SET
+                digest = EXCLUDED.digest;
+    """)
 
     BATCH_SIZE = 10000
 
+    _column_types = {}
+    _merge_stmts = {}
+    # Process-wide map of source keys (see `prepare_sources`) to source IDs.
+    # Sources are never deleted while the worker is running, so once a source
+    # is known, we only need to widen its record range (which we do once per
+    # exported file).
+    _source_ids = {}
+    # Incremented whenever this process registered new sources, allowing
+    # other process-wide caches of the sources table to refresh
+    sources_version = 0
+
+    def __init__(self):
+        self.record_ranges = {}
+        self.touched_source_ids = set()
+
+    @classmethod
+    def clear_source_cache(cls):
+        cls._source_ids.clear()
+
+    @property
+    def weather_table(self):
+        if self.STORAGE_CONFIGURABLE:
+            return weather_table()
+        return self.WEATHER_TABLE
+
+    @property
+    def compact(self):
+        """Whether values are stored as scaled integers"""
+        return self.weather_table == COMPACT_WEATHER_TABLE
+
     def export(self, records, fingerprint=None):
-        with get_connection() as conn:
-            for batch in batched(records, self.BATCH_SIZE):
-                self.export_batch(conn, batch)
-            if fingerprint:
-                self.update_parsed_files(conn, fingerprint)
+        self.export_many([(records, fingerprint)])
+
+    def export_many(self, exports):
+        """Export several files' `(records, fingerprint)` in one transaction"""
+        with get_connection() as conn, self.export_context(conn):
+            try:
+                for records, _ in exports:
+                    with closing(self.iter_batches(records)) as batches:
+                        for batch in batches:
+                            self.export_batch(conn, batch)
+            except psycopg2.errors.ForeignKeyViolation:
+                logger.warning('Clearing stale source cache')
+                self.clear_source_cache()
+                raise
+            self.update_record_ranges(conn)
+            self.cleanup_weather(conn)
+            for _, fingerprint in exports:
+                if fingerprint:
+                    self.update_parsed_files(conn, fingerprint)
             conn.commit()
 
+    def export_context(self, conn):
+        """Context wrapped around all work of `export_many` on `conn`"""
+        return nullcontext()
+
+    def iter_batches(self, records):
+        key = None
+        if self.DIGEST_TABLE and settings.EXPORT_SKIP_UNCHANGED:
+            # Keep the records of a station-day together, so that
+            # `skip_unchanged` digests the whole day
+            records = iter_records(records)
+            key = self.station_day
+        if settings.EXPORT_PIPELINE_DEPTH:
+            return pipelined_batches(
+                records, self.BATCH_SIZE, settings.EXPORT_PIPELINE_DEPTH,
+                key=key)
+        if key:
+            return batched_rows(records, self.BATCH_SIZE, key=key)
+        return batched(records, self.BATCH_SIZE)
+
+    def station_day(self, record):
+        return (
+            tuple(record[field] for field in self.SOURCE_FIELDS),
+            record['timestamp'].astimezone(datetime.timezone.utc).date(),
+        )
+
     def export_batch(self, conn, batch):
+        record_batches = [r for r in batch if isinstance(r, RecordBatch)]
+        if record_batches:
+            batch = [r for r in batch if not isinstance(r, RecordBatch)]
+            if self.use_columns():
+                self.copy_record_batches(conn, record_batches)
+            else:
+                batch.extend(iter_records(record_batches))
+            if not batch:
+                return
         records = self.prepare_records(batch)
         sources = self.prepare_sources(batch)
         source_map = self.update_sources(conn, sources)
         self.map_source_ids(records, source_map)
+        # Touch rows in a stable order so that concurrent exporters writing
+        # to the same rows cannot deadlock each other
+        records = sorted(records, key=operator.itemgetter(
+            'source_id', 'timestamp'))
+        if self.compact:
+            records = [encode_record(dict(r)) for r in records]
+        if self.DIGEST_TABLE and settings.EXPORT_SKIP_UNCHANGED:
+            records = self.skip_unchanged(conn, records)
+            if not records:
+                return
         self.update_weather(conn, records)
+        if self.DIGEST_TABLE and not settings.EXPORT_SKIP_UNCHANGED:
+            self.clear_digests(conn, {
+                (
+                    r['source_id'],
+                    r['timestamp'].astimezone(datetime.timezone.utc).date(),
+                )
+                for r in records
+                if r['observation_type'] in self.DIGEST_OBSERVATION_TYPES
+            })
 
     def prepare_records(self, records):
         return records
 
+    def use_columns(self):
+        """Whether `RecordBatch` items can be written without unpacking"""
+        return (
+            self.COLUMNS_SUPPORTED and
+            self.COPY_SUPPORTED and
+            settings.EXPORT_METHOD == 'copy' and
+            not (self.DIGEST_TABLE and settings.EXPORT_SKIP_UNCHANGED))
+
+    def skip_unchanged(self, conn, records):
+        groups = {}
+        for r in records:
+            if r['observation_type'] not in self.DIGEST_OBSERVATION_TYPES:
+                groups.setdefault(None, []).append(r)
+                continue
+            fields = [f for f in self.ELEMENT_FIELDS if f in r]
+            key = (
+                r['source_id'],
+                r['timestamp'].astimezone(datetime.timezone.utc).date(),
+                ','.join(fields),
+            )
+            groups.setdefault(key, []).append(r)
+        digests = {
+            key: self.make_digest(group)
+            for key, group in groups.items()
+            if key is not None
+        }
+        if not digests:
+            return records
+        identifiers = {
+            'digest_table': sql.Identifier(self.DIGEST_TABLE),
+            'constraint': sql.Identifier(f'{self.DIGEST_TABLE}_key'),
+        }
+        with conn.cursor() as cur:
+            rows = execute_values(
+                cur,
+                self.FIND_DIGESTS_STMT.format(**identifiers),
+                list(digests),
+                template='(%s, %s::date, %s)',
+                page_size=len(digests),
+                fetch=True)
+            stored = {
+                (row['source_id'], row['day'], row['fields']):
+                    bytes(row['digest'])
+                for row in rows
+            }
+            changed = sorted(
+                key for key, digest in digests.items()
+                if stored.get(key) != digest)
+            if changed:
+                execute_values(
+                    cur,
+                    self.UPDATE_DIGESTS_STMT.format(**identifiers),
+                    [(*key, digests[key]) for key in changed],
+                    page_size=1000)
+        changed_records = [
+            r
+            for key in [None, *changed]
+            for r in groups.get(key, [])
+        ]
+        logger.info(
+            "Skipping %d unchanged records, writing %d",
+            len(records) - len(changed_records), len(changed_records))
+        return sorted(changed_records, key=operator.itemgetter(
+            'source_id', 'timestamp'))
+
+    def clear_digests(self, conn, days):
+        """
+        Drop the stored digests of `days`, a set of `(source_id, day)` pairs
+        that were written without checking their digests. Otherwise, these
+        digests could wrongly skip records once `EXPORT_SKIP_UNCHANGED` is
+        enabled again.
+        """
+        if not days:
+            return
+        source_ids, dates = zip(*sorted(days))
+        with conn.cursor() as cur:
+            cur.execute(
+                self.CLEAR_DIGESTS_STMT.format(
+                    digest_table=sql.Identifier(self.DIGEST_TABLE)),
+                (list(source_ids), list(dates)))
+
+    def make_digest(self, records):
+        digest = hashlib.blake2b(digest_size=16)
+        for r in records:
+            digest.update(repr((
+                r['timestamp'].isoformat(),
+                *(r[f] for f in self.ELEMENT_FIELDS if f in r),
+            )).encode())
+        return digest.digest()
+
     def prepare_sources(self, records):
         sources = {}
         for r in records:
@@ -115,39 +717,142 @@ class DBExporter:
         return sources
 
     def update_sources(self, conn, sources):
-        extra_fields = ['first_record', 'last_record']
-        fields = ', '.join(
-            f'%({field})s' for field in self.SOURCE_FIELDS + extra_fields)
-        with self.sources_update_lock:
+        source_map = {
+            source_key: self._source_ids[source_key]
+            for source_key in sources
+            if source_key in self._source_ids
+        }
+        new_sources = {
+            source_key: source
+            for source_key, source in sources.items()
+            if source_key not in source_map
+        }
+        if new_sources:
+            new_source_map = self.register_sources(new_sources)
+            self._source_ids.update(new_source_map)
+            DBExporter.sources_version += 1
+            source_map.update(new_source_map)
+        # Record ranges of newly inserted sources are already up to date and
+        # will be skipped when flushing
+        for source_key, source in sources.items():
+            record_range = self.record_ranges.setdefault(
+                source_map[source_key],
+                [source['first_record'], source['last_record']])
+            record_range[0] = min(record_range[0], source['first_record'])
+            record_range[1] = max(record_range[1], source['last_record'])
+        return source_map
+
+    def register_sources(self, sources):
+        """
+        Look up or insert `sources` and return their IDs.
+
+        This runs in a transaction of its own, so that new sources become
+        visible to other exporters right away without committing (and
+        releasing the locks of) the export that found them.
+        """
+        source_keys = list(sources)
+        with get_connection() as conn:
             with conn.cursor() as cur:
                 rows = execute_values(
-                    cur, self.UPDATE_SOURCES_STMT, sources.values(),
-                    template=f'({fields})', fetch=True)
-                cur.execute(self.UPDATE_SOURCES_CLEANUP)
-                conn.commit()
-        return {
-            source_key: row['id']
-            for row, source_key in zip(rows, sources)
-        }
+                    cur,
+                    self.FIND_SOURCES_STMT,
+                    [(idx, *source_key) for idx, source_key in enumerate(
+                        source_keys)],
+                    fetch=True)
+            source_map = {source_keys[row['idx']]: row['id'] for row in rows}
+            missing = sorted(
+                (key for key in source_keys if key not in source_map),
+                key=lambda key: tuple(
+                    sources[key][field]
+                    for field in ['observation_type', 'lat', 'lon', 'height']))
+            if missing:
+                extra_fields = ['first_record', 'last_record']
+                fields = ', '.join(
+                    f'%({field})s'
+                    for field in self.SOURCE_FIELDS + extra_fields)
+                with conn.cursor() as cur:
+                    rows = execute_values(
+                        cur, self.UPDATE_SOURCES_STMT,
+                        [sources[key] for key in missing],
+                        template=f'({fields})', fetch=True)
+                source_map.update(
+                    (source_key, row['id'])
+                    for row, source_key in zip(rows, missing))
+            conn.commit()
+        return source_map
+
+    def update_record_ranges(self, conn):
+        if not self.record_ranges:
+            return
+        # Sort by ID so that concurrent exporters lock rows in the same order
+        ranges = sorted(
+            (source_id, first_record, last_record)
+            for source_id, (first_record, last_record)
+            in self.record_ranges.items())
+        with conn.cursor() as cur:
+            cur.execute(self.LOCK_SOURCES_STMT, ([r[0] for r in ranges],))
+            execute_values(cur, self.UPDATE_RECORD_RANGES_STMT, ranges)
+        self.record_ranges.clear()
+
+    def lock_shards(self, conn, keys):
+        """
+        Acquire transaction-level advisory locks for the shards of `keys`.
+
+        Unlike thread locks, advisory locks are shared by all worker processes
+        and hosts using the same database. Locks are acquired in ascending
+        shard order, so exporters locking overlapping shards cannot deadlock
+        each other, as long as each transaction locks all its shards at once
+        before writing anything.
+        """
+        shards = sorted({key % self.ADVISORY_LOCK_SHARDS for key in keys})
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT pg_advisory_xact_lock(%s, shard)
+                FROM unnest(%s::int[]) AS shard
+                """,
+                (self.ADVISORY_LOCK_NAMESPACE, shards))
 
     def map_source_ids(self, records, source_map):
         for r in records:
             r['source_id'] = source_map[r['source']]
 
     def update_weather(self, conn, records):
+        method = settings.EXPORT_METHOD if self.COPY_SUPPORTED else 'insert'
+        if method == 'insert':
+            self.insert_weather(conn, records)
+        elif method == 'copy':
+            self.copy_weather(conn, records)
+        elif method == 'merge':
+            self.merge_weather(conn, records)
+        else:
+            raise ValueError(f"Unknown export method: '{method}'")
+        if self.UPDATE_WEATHER_CLEANUP:
+            self.touched_source_ids.update(r['source_id'] for r in records)
+
+    def cleanup_weather(self, conn):
+        if not self.touched_source_ids:
+            return
+        with conn.cursor() as cur:
+            cur.execute(
+                self.UPDATE_WEATHER_CLEANUP,
+                {'source_ids': sorted(self.touched_source_ids)})
+        self.touched_source_ids.clear()
+
+    def insert_weather(self, conn, records):
         for fields, records in self.make_batches(records).items():
             logger.info(
                 "Exporting %d records with fields %s",
                 len(records), tuple(fields))
             stmt = self.UPDATE_WEATHER_STMT.format(
-                weather_table=sql.Identifier(self.WEATHER_TABLE),
-                constraint=sql.Identifier(f'{self.WEATHER_TABLE}_key'),
+                weather_table=sql.Identifier(self.weather_table),
+                constraint=sql.Identifier(f'{self.weather_table}_key'),
                 fields=sql.SQL(', ').join(
                     sql.Identifier(f) for f in fields),
                 conflict_updates=sql.SQL(', ').join(
                     sql.SQL(self.UPDATE_WEATHER_CONFLICT_UPDATE).format(
                         field=sql.Identifier(f),
-                        weather_table=sql.Identifier(self.WEATHER_TABLE))
+                        weather_table=sql.Identifier(self.weather_table))
                     for f in fields),
             )
             template = sql.SQL(
@@ -158,9 +863,185 @@ class DBExporter:
             )
             with conn.cursor() as cur:
                 execute_values(cur, stmt, records, template, page_size=1000)
+
+    def copy_weather(self, conn, records):
+        logger.info(
+            "Copying %d records into %s", len(records), self.weather_table)
+        writer = BinaryCopyWriter(self.get_staging_types(conn))
+        for row in self.make_staging_rows(records):
+            writer.write_row(row)
+        self.copy_staging(conn, writer)
+
+    def copy_record_batches(self, conn, batches):
+        batches = [b for b in batches if len(b)]
+        if not batches:
+            return
+        logger.info(
+            "Copying %d columnar records into %s",
+            sum(len(b) for b in batches), self.weather_table)
+        sources = {}
+        for b in batches:
+            source_key = tuple(b.source[field] for field in self.SOURCE_FIELDS)
+            first_record, last_record = (
+                ts.item().replace(tzinfo=datetime.timezone.utc)
+                for ts in [b.timestamps.min(), b.timestamps.max()])
+            source = sources.setdefault(source_key, {
+                **{field: b.source[field] for field in self.SOURCE_FIELDS},
+                'first_record': first_record,
+                'last_record': last_record,
+            })
+            source['first_record'] = min(source['first_record'], first_record)
+            source['last_record'] = max(source['last_record'], last_record)
+        source_map = self.update_sources(conn, sources)
+        column_types = self.get_staging_types(conn)
+        writer = BinaryCopyWriter(column_types)
+        source_ids = set()
+        for b in batches:
+            source_id = source_map[
+                tuple(b.source[field] for field in self.SOURCE_FIELDS)]
+            source_ids.add(source_id)
+            writer.write_columns(
+                column_types, self.make_staging_columns(b, source_id))
+        self.copy_staging(conn, writer)
         if self.UPDATE_WEATHER_CLEANUP:
+            self.touched_source_ids.update(source_ids)
+        if self.DIGEST_TABLE:
+            self.clear_digests(conn, {
+                (source_map[tuple(
+                    b.source[field] for field in self.SOURCE_FIELDS)], day)
+                for b in batches
+                if b.source['observation_type'] in (
+                    self.DIGEST_OBSERVATION_TYPES)
+                for day in np.unique(
+                    b.timestamps.astype('datetime64[D]')).tolist()
+            })
+
+    def make_staging_columns(self, batch, source_id):
+        n = len(batch)
+        order = np.argsort(batch.timestamps, kind='stable')
+        valid = np.ones(n, dtype=bool)
+        present = sum(
+            1 << i
+            for i, field in enumerate(self.ELEMENT_FIELDS)
+            if field in batch.columns)
+        columns = [
+            (batch.timestamps[order], valid),
+            (np.full(n, source_id), valid),
+            (np.full(n, present), valid),
+        ]
+        for field in self.ELEMENT_FIELDS:
+            if field in batch.columns:
+                values = batch.columns[field][order]
+                field_valid = batch.valid[field][order]
+                if self.compact:
+                    values = encode_column(field, values, field_valid)
+                columns.append((values, field_valid))
+            else:
+                columns.append((np.zeros(n), ~valid))
+        return columns
+
+    def get_staging_types(self, conn):
+        column_types = self.get_column_types(conn)
+        return [
+            column_types['timestamp'],
+            column_types['source_id'],
+            'integer',
+            *(column_types[f] for f in self.ELEMENT_FIELDS),
+        ]
+
+    def copy_staging(self, conn, writer):
+        identifiers = self.get_staging_identifiers()
+        with conn.cursor() as cur:
+            cur.execute(self.CREATE_STAGING_STMT.format(**identifiers))
+            cur.copy_expert(
+                self.COPY_STAGING_STMT.format(**identifiers),
+                writer.getbuffer())
+            cur.execute(self.get_merge_stmt())
+
+    def merge_weather(self, conn, records):
+        logger.info(
+            "Merging %d records into %s", len(records), self.weather_table)
+        column_types = self.get_column_types(conn)
+        template = '({})'.format(', '.join(
+            f'%s::{column_types[f]}'
+            for f in ['timestamp', 'source_id', 'present'] +
+            self.ELEMENT_FIELDS))
+        identifiers = self.get_staging_identifiers()
+        with conn.cursor() as cur:
+            cur.execute(self.CREATE_STAGING_STMT.format(**identifiers))
+            execute_values(
+                cur,
+                self.INSERT_STAGING_STMT.format(**identifiers),
+                self.make_staging_rows(records),
+                template=template,
+                page_size=len(records))
+            cur.execute(self.get_merge_stmt())
+
+    def make_staging_rows(self, records):
+        for record in records:
+            present = 0
+            row = [record['timestamp'], record['source_id'], 0]
+            for i, field in enumerate(self.ELEMENT_FIELDS):
+                if field in record:
+                    present |= 1 << i
+                    row.append(record[field])
+                else:
+                    row.append(None)
+            assert present, "Got record without element fields"
+            row[2] = present
+            yield row
+
+    def get_staging_identifiers(self):
+        return {
+            'weather_table': sql.Identifier(self.weather_table),
+            'staging_table': sql.Identifier(f'{self.weather_table}_staging'),
+            'fields': sql.SQL(', ').join(
+                sql.Identifier(f) for f in self.ELEMENT_FIELDS),
+        }
+
+    def get_merge_stmt(self):
+        # The merge statement only depends on the exporter class and its
+        # table, there is no need to compose it again for every batch
+        key = (type(self), self.weather_table)
+        if key not in self._merge_stmts:
+            self._merge_stmts[key] = self.make_merge_stmt(
+                **self.get_staging_identifiers())
+        return self._merge_stmts[key]
+
+    def make_merge_stmt(self, **identifiers):
+        conflict_updates = sql.SQL(', ').join(
+            sql.SQL(self.MERGE_STAGING_CONFLICT_UPDATE).format(
+                bit=sql.Literal(1 << i),
+                field=sql.Identifier(f),
+                weather_table=sql.Identifier(self.weather_table),
+                update=sql.SQL(self.MERGE_STAGING_CONFLICT_VALUE).format(
+                    field=sql.Identifier(f),
+                    weather_table=sql.Identifier(self.weather_table)),
+            )
+            for i, f in enumerate(self.ELEMENT_FIELDS))
+        return self.MERGE_STAGING_STMT.format(
+            constraint=sql.Identifier(f'{self.weather_table}_key'),
+            conflict_updates=conflict_updates,
+            **identifiers)
+
+    def get_column_types(self, conn):
+        if self.weather_table not in self._column_types:
             with conn.cursor() as cur:
-                cur.execute(self.UPDATE_WEATHER_CLEANUP)
+                cur.execute(
+                    """
+                    SELECT attname, format_type(atttypid, atttypmod)
+                    FROM pg_attribute
+                    WHERE
+                        attrelid = %s::regclass AND
+                        attnum > 0 AND
+                        NOT attisdropped
+                    """,
+                    (self.weather_table,))
+                self._column_types[self.weather_table] = {
+                    'present': 'integer',
+                    **dict(cur.fetchall()),
+                }
+        return self._column_types[self.weather_table]
 
     def make_batches(self, records):
         batches = {}
@@ -194,10 +1075,14 @@ class DBExporter:
 class SYNOPExporter(DBExporter):
 
     WEATHER_TABLE = 'synop'
+    STORAGE_CONFIGURABLE = False
     UPDATE_WEATHER_CONFLICT_UPDATE = (
         '{field} = COALESCE(EXCLUDED.{field}, {weather_table}.{field})')
+    MERGE_STAGING_CONFLICT_VALUE = (
+        'COALESCE(s.{field}, {weather_table}.{field})')
+    # Only recompute current weather of the stations we just touched
     UPDATE_WEATHER_CLEANUP = (
-        'REFRESH MATERIALIZED VIEW CONCURRENTLY current_weather')
+        'SELECT refresh_current_weather(%(source_ids)s::int[])')
 
     ELEMENT_FIELDS = [
         'cloud_cover',
@@ -230,7 +1115,16 @@ class SYNOPExporter(DBExporter):
         'wind_gust_speed_60',
     ]
 
-    synop_update_lock = Lock()
+    ADVISORY_LOCK_NAMESPACE = 7
+    DIGEST_TABLE = None
+    # Records must be merged by station and timestamp first
+    COLUMNS_SUPPORTED = False
+
+    # Exports waiting to be coalesced, and the number of exports still
+    # parsing their records, see `export`
+    _pending = None
+    _pending_lock = threading.Condition()
+    _incoming = 0
 
     def prepare_records(self, records):
         # Merge records for same source and timestamp (otherwise we will run
@@ -250,14 +1144,375 @@ class SYNOPExporter(DBExporter):
                 base[k] = v
         return base
 
-    def update_weather(self, *args, **kwargs):
-        with self.synop_update_lock:
-            super().update_weather(*args, **kwargs)
+    def export(self, records, fingerprint=None):
+        """
+        Export records, optionally coalescing SYNOP files that are exported
+        at the same time.
+
+        The first exporter to finish parsing its file waits for the other
+        exporters that are still parsing theirs (but no longer than
+        `settings.SYNOP_COALESCE_DELAY` seconds), and then exports all files
+        that arrived in the meantime in one transaction, with a single
+        refresh of `current_weather`. Without other exporters, it exports
+        right away. The other exporters block until that transaction is
+        committed. If it fails, every file is exported on its own, so that
+        each exporter re-raises only the error caused by its own file.
+        """
+        delay = settings.SYNOP_COALESCE_DELAY
+        if not delay:
+            return super().export(records, fingerprint=fingerprint)
+        with self._pending_lock:
+            SYNOPExporter._incoming += 1
+        # Parse in our own thread, not in the one exporting
+        try:
+            records = list(records)
+        except BaseException:
+            with self._pending_lock:
+                SYNOPExporter._incoming -= 1
+                self._pending_lock.notify_all()
+            raise
+        with self._pending_lock:
+            SYNOPExporter._incoming -= 1
+            pending = SYNOPExporter._pending
+            is_leader = pending is None
+            if is_leader:
+                pending = SYNOPExporter._pending = {
+                    'exports': [],
+                    'done': threading.Event(),
+                    'errors': {},
+                }
+            idx = len(pending['exports'])
+            pending['exports'].append((records, fingerprint))
+            self._pending_lock.notify_all()
+        if is_leader:
+            with self._pending_lock:
+                self._pending_lock.wait_for(
+                    lambda: not SYNOPExporter._incoming, timeout=delay)
+                SYNOPExporter._pending = None
+            try:
+                self._export_pending(pending['exports'], pending['errors'])
+            except BaseException as e:
+                # Interrupted (e.g. on shutdown): none of the exports may
+                # pass as successful
+                for i in range(len(pending['exports'])):
+                    pending['errors'].setdefault(i, e)
+                raise
+            finally:
+                pending['done'].set()
+        else:
+            pending['done'].wait()
+        if idx in pending['errors']:
+            raise pending['errors'][idx]
+
+    def _export_pending(self, exports, errors):
+        if len(exports) > 1:
+            logger.info(
+                'Coalescing %d SYNOP exports with %d records',
+                len(exports), sum(len(records) for records, _ in exports))
+        try:
+            self.export_many(exports)
+        except Exception as e:
+            if len(exports) == 1:
+                errors[0] = e
+                return
+            logger.warning(
+                'Coalesced SYNOP export failed, exporting files one by one: '
+                '%r', e)
+            for idx, export in enumerate(exports):
+                try:
+                    self.export_many([export])
+                except Exception as e:
+                    errors[idx] = e
+
+    def export_many(self, exports):
+        # The shards to lock (see `export_context`) must be known before the
+        # first write, so read all records up front (SYNOP files are small)
+        exports = [
+            (list(records), fingerprint) for records, fingerprint in exports]
+        self.export_records = [r for records, _ in exports for r in records]
+        try:
+            super().export_many(exports)
+        finally:
+            self.export_records = None
+
+    @contextmanager
+    def export_context(self, conn):
+        # Serialize exports touching the same stations (and their refresh of
+        # current_weather) across all worker processes, locking the shards of
+        # all sources in the transaction at once
+        source_map = self.update_sources(
+            conn, self.prepare_sources(self.export_records))
+        self.lock_shards(conn, source_map.values())
+        yield
+
+
+class ForecastExporter(DBExporter):
+    """
+    Exporter for forecast runs that, with `settings.FORECAST_GENERATIONS`,
+    publishes every run as a new generation of the forecast records instead
+    of updating them in place.
+
+    A run's records are collected in a session-local run table. When the run
+    is complete, a fresh generation table is filled with the run's records,
+    overlaid onto the still relevant records of the previous generation (the
+    MOSMIX_S and MOSMIX_L products share their sources, and neither run
+    covers all fields). The new table then replaces the previous one as a
+    child of the inheritance tree of `weather`, which is what all readers
+    query, and the previous generation is dropped. Readers see either the
+    complete previous or the complete new run, and no forecast rows are ever
+    updated or deleted one by one.
+
+    The price is that every run writes a complete new generation: besides
+    its own records, all unexpired records of the previous generation that
+    it does not replace are copied over (with ten days of hourly forecasts
+    for all MOSMIX stations, roughly a million rows per run). The copy is a
+    single sorted bulk insert into a table without indexes, which is much
+    cheaper than updating the same rows in place, but it is not free.
+    """
+
+    GENERATION_PREFIX = 'weather_forecast_'
+    # Records of the previous generation older than this are not carried over,
+    # same as the forecast expiry in `tasks.clean`
+    GENERATION_EXPIRY = '3 hours'
+    # Session-level advisory lock serializing forecast exports, runs must not
+    # build on the same previous generation
+    GENERATION_LOCK = (8, 0)
+    RUN_TABLE = 'weather_forecast_run'
+    CREATE_RUN_STMT = sql.SQL("""
+        DROP TABLE IF EXISTS {run_table};
+        CREATE TEMPORARY TABLE {run_table} (
+            LIKE {weather_table},
+            present integer NOT NULL,
+            PRIMARY KEY (source_id, timestamp)
+        );
+    """)
+    # Merge a batch from the staging table into the run table, keeping track
+    # of all fields each row carried over all batches of the run
+    MERGE_RUN_STMT = sql.SQL("""
+        INSERT INTO {run_table} AS r (timestamp, source_id, present, {fields})
+        SELECT timestamp, source_id, present, {fields}
+        FROM {staging_table}
+        ON CONFLICT (source_id, timestamp) DO UPDATE SET
+            present = r.present | EXCLUDED.present,
+            ({fields}) = (SELECT {conflict_updates});
+    """)
+    MERGE_RUN_CONFLICT_UPDATE = """
+        CASE
+            WHEN EXCLUDED.present & {bit} = 0 THEN r.{field}
+            ELSE EXCLUDED.{field}
+        END
+    """
+    FIND_GENERATION_STMT = """
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE
+            i.inhparent = %s::regclass AND
+            c.relname ~ %s;
+    """
+    # Forecast records that were exported while generations were disabled
+    UNGENERATIONED_RECORDS = sql.SQL("""
+        SELECT {weather_table}.*
+        FROM ONLY {weather_table}
+        JOIN sources ON sources.id = {weather_table}.source_id
+        WHERE sources.observation_type = 'forecast'
+    """)
+    DELETE_UNGENERATIONED_STMT = sql.SQL("""
+        DELETE FROM ONLY {weather_table}
+        USING sources
+        WHERE
+            sources.id = {weather_table}.source_id AND
+            sources.observation_type = 'forecast';
+    """)
+    CREATE_GENERATION_STMT = sql.SQL("""
+        CREATE TABLE {generation} (
+            LIKE {weather_table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS
+        );
+    """)
+    FILL_GENERATION_STMT = sql.SQL("""
+        INSERT INTO {generation} (timestamp, source_id, {fields})
+        SELECT timestamp, source_id, {overlays}
+        FROM {run_table} r
+        FULL JOIN (
+            SELECT * FROM ({previous}) AS previous
+            WHERE timestamp >= current_timestamp - %(expiry)s::interval
+        ) AS o USING (source_id, timestamp)
+        ORDER BY source_id, timestamp;
+    """)
+    CONSTRAIN_GENERATION_STMT = sql.SQL("""
+        ALTER TABLE {generation}
+            ADD CONSTRAINT {generation_key} UNIQUE (source_id, timestamp),
+            ADD CONSTRAINT {generation_fkey} FOREIGN KEY (source_id)
+                REFERENCES sources (id) ON DELETE CASCADE;
+    """)
+    GENERATION_OVERLAY = """
+        CASE WHEN r.present & {bit} <> 0 THEN r.{field} ELSE o.{field} END
+    """
+    # Only this statement and the DROP of the previous generation take
+    # exclusive locks, everything before is invisible to readers
+    PUBLISH_GENERATION_STMT = sql.SQL("""
+        ALTER TABLE {generation} INHERIT {weather_table};
+    """)
+    # Records of the previous generation that were not carried over expired,
+    # narrow the record ranges of the sources that lost them
+    NARROW_RECORD_RANGES_STMT = sql.SQL("""
+        UPDATE sources SET
+            first_record = (
+                SELECT MIN(timestamp) FROM {generation}
+                WHERE source_id = sources.id)
+        WHERE
+            observation_type = 'forecast' AND
+            first_record < current_timestamp - %(expiry)s::interval AND
+            EXISTS (SELECT 1 FROM {generation} WHERE source_id = sources.id);
+    """)
+
+    def export_context(self, conn):
+        return self.generation_context(conn)
+
+    @contextmanager
+    def generation_context(self, conn):
+        with conn.cursor() as cur:
+            cur.execute(
+                'SELECT pg_advisory_lock(%s, %s)', self.GENERATION_LOCK)
+        try:
+            if settings.FORECAST_GENERATIONS:
+                with conn.cursor() as cur:
+                    cur.execute(self.CREATE_RUN_STMT.format(
+                        **self.get_generation_identifiers()))
+            else:
+                self.fold_generations(conn)
+            conn.commit()
+            yield
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            with conn.cursor() as cur:
+                cur.execute(
+                    sql.SQL('DROP TABLE IF EXISTS {run_table}').format(
+                        **self.get_generation_identifiers()))
+                cur.execute(
+                    'SELECT pg_advisory_unlock(%s, %s)', self.GENERATION_LOCK)
+            conn.commit()
+
+    def get_generation_identifiers(self):
+        return {
+            **self.get_staging_identifiers(),
+            'run_table': sql.Identifier(self.RUN_TABLE),
+        }
+
+    def find_generations(self, conn):
+        with conn.cursor() as cur:
+            cur.execute(
+                self.FIND_GENERATION_STMT,
+                (self.weather_table, f'^{self.GENERATION_PREFIX}[0-9]+$'))
+            names = [row[0] for row in cur.fetchall()]
+        prefix = self.GENERATION_PREFIX
+        return sorted(names, key=lambda n: int(n.removeprefix(prefix)))
+
+    def fold_generations(self, conn):
+        """Move records of all generations back into the weather table"""
+        identifiers = self.get_staging_identifiers()
+        for generation in self.find_generations(conn):
+            logger.info('Folding forecast generation %s back', generation)
+            with conn.cursor() as cur:
+                cur.execute(
+                    sql.SQL("""
+                        INSERT INTO {weather_table}
+                        SELECT * FROM {generation}
+                        ON CONFLICT ON CONSTRAINT {constraint} DO NOTHING;
+                        DROP TABLE {generation};
+                    """).format(
+                        generation=sql.Identifier(generation),
+                        constraint=sql.Identifier(f'{self.weather_table}_key'),
+                        **identifiers))
+
+    def use_columns(self):
+        if settings.FORECAST_GENERATIONS:
+            return True
+        return super().use_columns()
+
+    def update_weather(self, conn, records):
+        if settings.FORECAST_GENERATIONS:
+            # Always go through the staging table, which is merged into the
+            # run table by `get_merge_stmt`
+            self.copy_weather(conn, records)
+        else:
+            super().update_weather(conn, records)
+
+    def get_merge_stmt(self):
+        if not settings.FORECAST_GENERATIONS:
+            return super().get_merge_stmt()
+        identifiers = self.get_generation_identifiers()
+        return self.MERGE_RUN_STMT.format(
+            conflict_updates=sql.SQL(', ').join(
+                sql.SQL(self.MERGE_RUN_CONFLICT_UPDATE).format(
+                    bit=sql.Literal(1 << i), field=sql.Identifier(f))
+                for i, f in enumerate(self.ELEMENT_FIELDS)),
+            **identifiers)
+
+    def cleanup_weather(self, conn):
+        if settings.FORECAST_GENERATIONS:
+            self.publish_generation(conn)
+        super().cleanup_weather(conn)
+
+    def publish_generation(self, conn):
+        identifiers = self.get_generation_identifiers()
+        previous_generations = self.find_generations(conn)
+        if previous_generations:
+            previous = previous_generations[-1]
+            number = int(previous.removeprefix(self.GENERATION_PREFIX)) + 1
+            previous_query = sql.SQL('SELECT * FROM {}').format(
+                sql.Identifier(previous))
+        else:
+            number = 1
+            previous_query = self.UNGENERATIONED_RECORDS.format(**identifiers)
+        generation = f'{self.GENERATION_PREFIX}{number}'
+        logger.info('Building forecast generation %s', generation)
+        overlays = sql.SQL(', ').join(
+            sql.SQL(self.GENERATION_OVERLAY).format(
+                bit=sql.Literal(1 << i), field=sql.Identifier(f))
+            for i, f in enumerate(self.ELEMENT_FIELDS))
+        generation_identifiers = {
+            'generation': sql.Identifier(generation),
+            'generation_key': sql.Identifier(f'{generation}_key'),
+            'generation_fkey': sql.Identifier(f'{generation}_fkey'),
+            **identifiers,
+        }
+        with conn.cursor() as cur:
+            cur.execute(self.CREATE_GENERATION_STMT.format(
+                **generation_identifiers))
+            cur.execute(
+                self.FILL_GENERATION_STMT.format(
+                    previous=previous_query,
+                    overlays=overlays,
+                    **generation_identifiers),
+                {'expiry': self.GENERATION_EXPIRY})
+            rows = cur.rowcount
+            cur.execute(self.CONSTRAIN_GENERATION_STMT.format(
+                **generation_identifiers))
+            cur.execute(self.PUBLISH_GENERATION_STMT.format(
+                generation=sql.Identifier(generation), **identifiers))
+            if previous_generations:
+                for previous in previous_generations:
+                    cur.execute(sql.SQL('DROP TABLE {}').format(
+                        sql.Identifier(previous)))
+            else:
+                cur.execute(
+                    self.DELETE_UNGENERATIONED_STMT.format(**identifiers))
+            cur.execute(
+                self.NARROW_RECORD_RANGES_STMT.format(
+                    generation=sql.Identifier(generation)),
+                {'expiry': self.GENERATION_EXPIRY})
+        logger.info(
+            'Published forecast generation %s with %d records',
+            generation, rows)
 
 
 class RadarExporter(DBExporter):
 
     WEATHER_TABLE = 'radar'
+    STORAGE_CONFIGURABLE = False
     UPDATE_WEATHER_STMT = sql.SQL("""
         INSERT INTO {weather_table} (timestamp, {fields})
         VALUES %s
@@ -266,6 +1521,9 @@ class RadarExporter(DBExporter):
                 {conflict_updates};
     """)
     UPDATE_WEATHER_VALUES_TEMPLATE = '(%(timestamp)s, {values})'
+    # Radar records have no source and come in batches of a few dozen rows
+    COPY_SUPPORTED = False
+    DIGEST_TABLE = None
     ELEMENT_FIELDS = [
         'precipitation_5',
         'source',
@@ -319,8 +1577,10 @@ class AlertExporter(DBExporter):
         self.prepare_alerts(alerts)
         with get_connection() as conn:
             last_id = self.get_last_alert_id(conn)
-            self.clear_outdated_alerts(conn, alerts)
-            self.update_alerts(conn, alerts)
+            existing = self.get_existing_alerts(conn)
+            self.clear_outdated_alerts(conn, alerts, existing)
+            changed = self.find_changed_alerts(alerts, existing)
+            self.update_alerts(conn, changed)
             self.reset_alert_id(conn, last_id)
             self.update_alert_cells(conn, alerts)
             if fingerprint:
@@ -336,18 +1596,43 @@ class AlertExporter(DBExporter):
             cur.execute("SELECT MAX(id) FROM alerts")
             return cur.fetchall()[0]['max']
 
-    def clear_outdated_alerts(self, conn, alerts):
+    def get_existing_alerts(self, conn):
         with conn.cursor() as cur:
-            cur.execute("SELECT alert_id FROM alerts")
-            existing = set(row['alert_id'] for row in cur.fetchall())
-            outdated = existing.difference(a['alert_id'] for a in alerts)
-            if outdated:
-                logger.info("Deleting %d outdated alerts", len(outdated))
+            cur.execute(
+                sql.SQL("SELECT id, {fields} FROM alerts").format(
+                    fields=sql.SQL(', ').join(
+                        sql.Identifier(f) for f in self.ELEMENT_FIELDS)))
+            return {row['alert_id']: dict(row) for row in cur.fetchall()}
+
+    def clear_outdated_alerts(self, conn, alerts, existing):
+        outdated = set(existing).difference(a['alert_id'] for a in alerts)
+        if outdated:
+            logger.info("Deleting %d outdated alerts", len(outdated))
+            with conn.cursor() as cur:
                 cur.execute(
                     "DELETE FROM alerts WHERE alert_id IN %(outdated)s",
                     {'outdated': tuple(outdated)},
                 )
 
+    def find_changed_alerts(self, alerts, existing):
+        # Alerts are only written when they are new or when one of their
+        # fields changed, everything else just needs its ID for the cells
+        changed = []
+        for alert in alerts:
+            row = existing.get(alert['alert_id'])
+            if row and all(
+                    alert[f] == row[f]
+                    for f in self.ELEMENT_FIELDS if f in alert):
+                alert['id'] = row['id']
+            else:
+                changed.append(alert)
+        logger.info(
+            "Found %d new, %d changed, and %d unchanged alerts",
+            sum(a['alert_id'] not in existing for a in changed),
+            sum(a['alert_id'] in existing for a in changed),
+            len(alerts) - len(changed))
+        return changed
+
     def update_alerts(self, conn, alerts):
         for fields, alerts in self.make_batches(alerts).items():
             logger.info(
@@ -391,16 +1676,36 @@ class AlertExporter(DBExporter):
             cur.execute(self.UPDATE_ALERTS_CLEANUP, {'max_id': max_id})
 
     def update_alert_cells(self, conn, alerts):
-        rows = [
+        cells = {
             (alert['id'], wcid)
             for alert in alerts
             for wcid in alert['warn_cell_ids']
-        ]
+        }
         with conn.cursor() as cur:
-            cur.execute("DELETE FROM alert_cells")
-            execute_values(
-                cur,
-                "INSERT INTO alert_cells (alert_id, warn_cell_id) VALUES %s",
-                rows,
-                page_size=1000,
-            )
+            cur.execute("SELECT alert_id, warn_cell_id FROM alert_cells")
+            existing = {tuple(row) for row in cur.fetchall()}
+            removed = sorted(existing - cells)
+            added = sorted(cells - existing)
+            logger.info(
+                "Adding %d and removing %d alert cells, keeping %d",
+                len(added), len(removed), len(cells) - len(added))
+            if removed:
+                execute_values(
+                    cur,
+                    """
+                    DELETE FROM alert_cells
+                    WHERE (alert_id, warn_cell_id) IN (VALUES %s)
+                    """,
+                    removed,
+                    page_size=1000,
+                )
+            if added:
+                execute_values(
+                    cur,
+                    """
+                    INSERT INTO alert_cells (alert_id, warn_cell_id)
+                    VALUES %s
+                    """,
+                    added,
+                    page_size=1000,
+                )
@@ -1,17 +1,26 @@
 import csv
 import datetime
+import io
+import itertools
+import os
 import re
+import threading
+import time
+import xml.etree.ElementTree as ET
 
 import dwdparse.parsers
 import numpy as np
 from dateutil.tz import tzutc
+from dwdparse.stations import wmo_id_to_dwd
 from isal import isal_zlib as zlib
 
 from brightsky.db import fetch
 from brightsky.export import (
     AlertExporter,
     DBExporter,
+    ForecastExporter,
     RadarExporter,
+    RecordBatch,
     SYNOPExporter,
 )
 from brightsky.settings import settings
@@ -25,9 +34,21 @@ class BrightSkyMixin:
     def skip_path(self, path):
         return False
 
+    def is_cpu_bound(self, path):
+        """Whether parsing `path` is worth the overhead of a new process"""
+        return False
+
 
 class ObservationsBrightSkyMixin(BrightSkyMixin):
 
+    # Whether to decode product files column-wise with NumPy instead of row
+    # by row, only for parsers without custom row handling
+    DECODE_COLUMNS = False
+    DECODE_COLUMNS_CHUNK_SIZE = 50000
+
+    def is_cpu_bound(self, path):
+        return str(path).endswith('_hist.zip')
+
     def skip_path(self, path):
         if (m := re.search(r'_(\d{8})_(\d{8})_hist\.zip$', str(path))):
             end_date = datetime.datetime.strptime(
@@ -50,10 +71,277 @@ class ObservationsBrightSkyMixin(BrightSkyMixin):
             return True
         return False
 
+    def parse_records(self, zf, lat_lon_history, **extra):
+        # Same as dwdparse's implementation, but with the lines of the product
+        # file passing through `filter_lines`
+        product_filenames = [
+            fn for fn in zf.namelist() if fn.startswith('produkt_')]
+        if len(product_filenames) != 1:
+            raise ValueError(
+                f"Expected 1 product file, found {len(product_filenames)}"
+            )
+        filename = product_filenames[0]
+        with zf.open(filename) as f:
+            lines = self.filter_lines(io.TextIOWrapper(f, encoding='latin1'))
+            if self.DECODE_COLUMNS:
+                yield from self.decode_columns(
+                    filename, lines, lat_lon_history)
+                return
+            reader = csv.DictReader(lines, delimiter=';')
+            yield from self.parse_reader(filename, reader, lat_lon_history)
+
+    def decode_columns(self, filename, lines, lat_lon_history):
+        """
+        Decode the product file `lines` in chunks of whole columns, yielding
+        the same records as `parse_reader`.
+
+        Element values are converted once per distinct raw string (there are
+        usually only a few hundred per column), so that missing value
+        sentinels and unit conversions behave exactly like in `dwdparse`.
+        """
+        header = [c.strip() for c in next(lines, '').split(';')]
+        if header == ['']:
+            return
+        date_column = header.index('MESS_DATUM')
+        element_columns = {
+            element: header.index(key.strip())
+            for element, key in self.elements.items()
+        }
+        history_dates = np.maximum.accumulate(np.array(
+            [d.replace(tzinfo=None) for d in lat_lon_history],
+            dtype='datetime64[us]'))
+        history_params = [None, *lat_lon_history.values()]
+        source = f'Observations:Recent:{filename}'
+        custom_skip = (
+            type(self).skip_timestamp is not
+            ObservationsBrightSkyMixin.skip_timestamp)
+        lines = (line for line in lines if line.strip())
+        while chunk := list(
+                itertools.islice(lines, self.DECODE_COLUMNS_CHUNK_SIZE)):
+            columns = list(zip(*(line.split(';') for line in chunk)))
+            timestamps = self.decode_timestamps(columns[date_column])
+            rows = np.flatnonzero(self.select_timestamps(timestamps))
+            timestamps = timestamps[rows]
+            # Same as `_station_params`: the last entry before the first
+            # entry that lies after the timestamp
+            params_idx = np.searchsorted(
+                history_dates, timestamps, side='right').tolist()
+            elements = {
+                element: self.decode_element(element, columns[column])[rows]
+                for element, column in element_columns.items()
+            }
+            for timestamp, params, *values in zip(
+                    timestamps.tolist(),
+                    params_idx,
+                    *(values.tolist() for values in elements.values())):
+                timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+                if custom_skip and self.skip_timestamp(timestamp):
+                    continue
+                lat, lon, height, station_name = history_params[params]
+                record = {
+                    'source': source,
+                    'lat': lat,
+                    'lon': lon,
+                    'height': height,
+                    'station_name': station_name,
+                    'timestamp': timestamp,
+                }
+                record.update(zip(elements, values))
+                yield record
+
+    def select_timestamps(self, timestamps):
+        """Vectorised counterpart of `skip_timestamp`"""
+        def to_datetime64(dt):
+            return np.datetime64(
+                dt.astimezone(datetime.timezone.utc).replace(tzinfo=None),
+                'us')
+
+        selected = timestamps >= to_datetime64(settings.MIN_DATE)
+        if settings.MAX_DATE:
+            selected &= timestamps <= to_datetime64(settings.MAX_DATE)
+        return selected
+
+    def decode_timestamps(self, values):
+        if any(len(v) != 10 for v in values):
+            raise ValueError(f"Unexpected date format in {values[:3]}")
+        dates = np.array(values).astype(np.int64)
+        year, month = dates // 1000000, dates // 10000 % 100
+        day, hour = dates // 100 % 100, dates % 100
+        months = (
+            (year - 1970).astype('datetime64[Y]').astype('datetime64[M]') +
+            (month - 1).astype('timedelta64[M]'))
+        days = months.astype('datetime64[D]') + (
+            day - 1).astype('timedelta64[D]')
+        if (
+                (month < 1).any() or (month > 12).any() or (day < 1).any() or
+                (days.astype('datetime64[M]') != months).any() or
+                (hour > 23).any()):
+            raise ValueError(f"Invalid date in {values[:3]}")
+        return days.astype('datetime64[us]') + hour.astype('timedelta64[h]')
+
+    def decode_element(self, element, values):
+        raw, inverse = np.unique(np.array(values), return_inverse=True)
+        ignored = ['-999', *self.ignored_values.get(element, [])]
+        converter = self.converters.get(element)
+        decoded = np.empty(len(raw), dtype=object)
+        for i, value in enumerate(raw.tolist()):
+            if value.strip() in ignored:
+                decoded[i] = None
+            else:
+                decoded[i] = float(value)
+                if converter:
+                    decoded[i] = converter(decoded[i])
+        return decoded[inverse]
+
+    def filter_lines(self, lines):
+        """
+        Drop CSV lines whose measurement date lies outside of `MIN_DATE` and
+        `MAX_DATE` by comparing the raw date strings, before any row is split
+        into fields or converted.
+
+        The window is widened by one day, as some parsers look at neighbouring
+        rows or aggregate ten-minute rows into hours. `skip_timestamp` still
+        decides about the rows that pass.
+        """
+        header = next(lines, None)
+        if header is None:
+            return
+        yield header
+        column = [c.strip() for c in header.split(';')].index('MESS_DATUM')
+        margin = datetime.timedelta(days=1)
+        min_day = (settings.MIN_DATE - margin).strftime('%Y%m%d')
+        max_day = (
+            (settings.MAX_DATE + margin).strftime('%Y%m%d')
+            if settings.MAX_DATE else '99999999')
+        for line in lines:
+            day = line.split(';', column + 1)[column].strip()[:8]
+            if min_day <= day <= max_day:
+                yield line
+
 
 class MOSMIXParser(BrightSkyMixin, dwdparse.parsers.MOSMIXParser):
 
     PRIORITY = 20
+    exporter = ForecastExporter
+
+    def is_cpu_bound(self, path):
+        return 'MOSMIX_L' in os.path.basename(path)
+
+    def _parse_stream(self, f):
+        if settings.MOSMIX_STREAMING:
+            return self.parse_station_batches(f)
+        return super()._parse_stream(f)
+
+    def parse_station_batches(self, f):
+        """
+        Like `_parse_stream`, but yield one `RecordBatch` per station and
+        remove every processed placemark from the document, so that memory
+        use does not grow with the number of stations.
+        """
+        timestamps = None
+        source = None
+        ns = {}
+        parents = []
+        for event, element in ET.iterparse(f, ['start', 'end', 'start-ns']):
+            if event == 'start-ns':
+                ns[element[0]] = element[1]
+                continue
+            elif event == 'start':
+                parents.append(element)
+                continue
+            parents.pop()
+            if self._is_tag(element, 'dwd:ProductID', ns):
+                if source is not None:
+                    raise ValueError("Unexpected extra product ID")
+                source = element.text
+            elif self._is_tag(element, 'dwd:IssueTime', ns):
+                if source is None:
+                    raise ValueError("Unexpected issue time w/o ID")
+                source += ':' + element.text
+            elif self._is_tag(element, 'dwd:ForecastTimeSteps', ns):
+                if timestamps is not None:
+                    raise ValueError("Unexpected extra time steps")
+                timestamps = np.array(
+                    [
+                        ts.astimezone(datetime.timezone.utc).replace(
+                            tzinfo=None)
+                        for ts in self.parse_timestamps(element, ns)
+                    ],
+                    dtype='datetime64[us]')
+            elif self._is_tag(element, 'kml:Placemark', ns):
+                if timestamps is None:
+                    raise ValueError("Placemark without time steps")
+                if source is None:
+                    raise ValueError("Placemark without source")
+                batch = self.parse_station_batch(
+                    element, ns, timestamps, source)
+                if batch is not None:
+                    yield batch
+                parents[-1].remove(element)
+
+    def parse_station_batch(self, place, ns, timestamps, source):
+        wmo_station_id = place.find('kml:name', ns).text
+        dwd_station_id = wmo_id_to_dwd(wmo_station_id)
+        station_name = place.find('kml:description', ns).text
+        try:
+            coords = place.find('kml:Point', ns).find('kml:coordinates', ns)
+            lon, lat, height = coords.text.split(',')
+        except AttributeError:
+            self.logger.warning(
+                "Ignoring station without coordinates, WMO ID '%s', DWD ID "
+                "'%s', name '%s'",
+                wmo_station_id, dwd_station_id, station_name)
+            return
+        columns = {}
+        data = place.find('kml:ExtendedData', ns)
+        for forecast in data.findall('dwd:Forecast', ns):
+            param = forecast.attrib[f"{{{ns['dwd']}}}elementName"]
+            try:
+                column = self.ELEMENTS[param]
+            except KeyError:
+                continue
+            converter = getattr(self, f'parse_{column}', float)
+            values = [
+                self.sanitize_value(
+                    column, None if x == '-' else converter(x),
+                    wmo_station_id)
+                for x in forecast.find('dwd:value', ns).text.split()
+            ]
+            if len(values) != len(timestamps):
+                raise ValueError(
+                    f"Expected {len(timestamps)} values for {column}, "
+                    f"got {len(values)}"
+                )
+            columns[column] = np.array(values, dtype=object)
+        if not columns:
+            return
+        return RecordBatch(
+            {
+                'observation_type': 'forecast',
+                'source': source,
+                'lat': float(lat),
+                'lon': float(lon),
+                'height': float(height),
+                'dwd_station_id': dwd_station_id,
+                'wmo_station_id': wmo_station_id,
+                'station_name': station_name,
+            },
+            timestamps,
+            columns,
+            valid={
+                column: values != None  # noqa: E711
+                for column, values in columns.items()
+            })
+
+    def sanitize_value(self, field, value, wmo_station_id):
+        if value is None:
+            return None
+        fixed = self._sanitize_value(field, value)
+        if fixed != value:
+            self.logger.warning(
+                "Fixing out-of-bounds %s value %r -> %r for station %s",
+                field, value, fixed, wmo_station_id)
+        return fixed
 
 
 class SYNOPParser(BrightSkyMixin, dwdparse.parsers.SYNOPParser):
@@ -75,6 +363,15 @@ class CurrentObservationsParser(
             for station in settings.IGNORED_CURRENT_OBSERVATIONS_STATIONS
         ))
 
+    # Worker-wide map of WMO station IDs to their latest location. It is
+    # loaded in bulk and reloaded when a station is missing, when this worker
+    # registered new sources, or when it is older than
+    # `settings.STATION_LOCATIONS_MAX_AGE` seconds.
+    _locations = {}
+    _locations_version = None
+    _locations_loaded_at = None
+    _locations_lock = threading.Lock()
+
     def parse(self, path, lat=None, lon=None, height=None, station_name=None):
         if any(x is None for x in (lat, lon, height, station_name)):
             with open(path) as f:
@@ -91,41 +388,79 @@ class CurrentObservationsParser(
             station_name=station_name,
         )
 
+    @classmethod
+    def clear_location_cache(cls):
+        with cls._locations_lock:
+            cls._locations_loaded_at = None
+
     def _load_location(self, wmo_station_id):
+        cls = type(self)
+        with cls._locations_lock:
+            if (
+                    self._locations_expired() or
+                    wmo_station_id not in cls._locations):
+                self._load_locations()
+            location = cls._locations.get(wmo_station_id)
+        if location is None:
+            raise ValueError(f'Cannot find location for WMO {wmo_station_id}')
+        return location
+
+    def _locations_expired(self):
+        cls = type(self)
+        return (
+            cls._locations_loaded_at is None or
+            cls._locations_version != DBExporter.sources_version or
+            (
+                time.monotonic() - cls._locations_loaded_at >
+                settings.STATION_LOCATIONS_MAX_AGE
+            )
+        )
+
+    def _load_locations(self):
+        cls = type(self)
+        # Read the version first, sources registered while we are loading
+        # will trigger another reload
+        version = DBExporter.sources_version
         rows = fetch(
             """
-            SELECT lat, lon, height, station_name
+            SELECT DISTINCT ON (wmo_station_id)
+                wmo_station_id, lat, lon, height, station_name
             FROM sources
-            WHERE wmo_station_id = %s
-            ORDER BY observation_type DESC, id DESC
-            LIMIT 1
-            """,
-            (wmo_station_id,),
+            WHERE wmo_station_id IS NOT NULL
+            ORDER BY wmo_station_id, observation_type DESC, id DESC
+            """
         )
-        if not rows:
-            raise ValueError(f'Cannot find location for WMO {wmo_station_id}')
-        return rows[0]
+        cls._locations = {
+            row['wmo_station_id']: (
+                row['lat'], row['lon'], row['height'], row['station_name'])
+            for row in rows
+        }
+        cls._locations_version = version
+        cls._locations_loaded_at = time.monotonic()
 
 
 class CloudCoverObservationsParser(
     ObservationsBrightSkyMixin,
     dwdparse.parsers.CloudCoverObservationsParser,
 ):
-    pass
+
+    DECODE_COLUMNS = True
 
 
 class DewPointObservationsParser(
     ObservationsBrightSkyMixin,
     dwdparse.parsers.DewPointObservationsParser,
 ):
-    pass
+
+    DECODE_COLUMNS = True
 
 
 class TemperatureObservationsParser(
     ObservationsBrightSkyMixin,
     dwdparse.parsers.TemperatureObservationsParser,
 ):
-    pass
+
+    DECODE_COLUMNS = True
 
 
 class PrecipitationObservationsParser(
@@ -161,14 +496,16 @@ class VisibilityObservationsParser(
     ObservationsBrightSkyMixin,
     dwdparse.parsers.VisibilityObservationsParser,
 ):
-    pass
+
+    DECODE_COLUMNS = True
 
 
 class WindObservationsParser(
     ObservationsBrightSkyMixin,
     dwdparse.parsers.WindObservationsParser,
 ):
-    pass
+
+    DECODE_COLUMNS = True
 
 
 class WindGustsObservationsParser(
@@ -182,7 +519,8 @@ class SunshineObservationsParser(
     ObservationsBrightSkyMixin,
     dwdparse.parsers.SunshineObservationsParser,
 ):
-    pass
+
+    DECODE_COLUMNS = True
 
 
 class PressureObservationsParser(
@@ -0,0 +1,127 @@
+import datetime
+import logging
+
+from psycopg2 import sql
+
+
+logger = logging.getLogger(__name__)
+
+
+class PartitionManager:
+    """
+    Create and drop the time range partitions of the short-lived tables.
+
+    Partitions are named after the start of their range, e.g.
+    `synop_p2020061700`, and created ahead of time. Records outside of all
+    partitions are stored in the table's default partition and moved out of
+    it when a partition covering them is created.
+    """
+
+    # Partition size and how far into the future partitions are created.
+    # Radar records include forecasts for the next two hours.
+    TABLES = {
+        'synop': (datetime.timedelta(days=1), datetime.timedelta(days=2)),
+        'radar': (datetime.timedelta(hours=1), datetime.timedelta(hours=6)),
+    }
+    # Tables whose records belong to sources
+    SOURCE_TABLES = ('synop',)
+    NAME_FORMAT = '%Y%m%d%H'
+    EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+    FIND_PARTITIONS_STMT = """
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE
+            i.inhparent = %s::regclass AND
+            c.relname LIKE %s;
+    """
+    FIND_SOURCES_STMT = sql.SQL('SELECT DISTINCT source_id FROM {}')
+    # Rows in the default partition that fall into the new partition's range
+    # have to be moved, attaching it would fail otherwise. The lock keeps
+    # exporters from inserting new such rows between the move and the attach
+    # (it is held until `maintain` commits).
+    CREATE_PARTITION_STMT = sql.SQL("""
+        LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE;
+        CREATE TABLE {partition} (
+            LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS
+        );
+        WITH moved AS (
+            DELETE FROM {default}
+            WHERE timestamp >= %(start)s AND timestamp < %(end)s
+            RETURNING *
+        )
+        INSERT INTO {partition} SELECT * FROM moved;
+        ALTER TABLE {table} ATTACH PARTITION {partition}
+            FOR VALUES FROM (%(start)s) TO (%(end)s);
+    """)
+
+    def maintain(self, conn, table, expiry):
+        """
+        Create the partitions of `table` from the expiry threshold until the
+        lookahead, and drop all partitions holding only records older than
+        `expiry` (an SQL interval string).
+
+        Returns the IDs of the sources that lost records.
+        """
+        size, lookahead = self.TABLES[table]
+        with conn.cursor() as cur:
+            cur.execute(
+                'SELECT current_timestamp, current_timestamp - %s::interval',
+                (expiry,))
+            now, threshold = cur.fetchone()
+        partitions = self.get_partitions(conn, table)
+        dropped = 0
+        source_ids = set()
+        for start, name in sorted(partitions.items()):
+            if start + size <= threshold:
+                with conn.cursor() as cur:
+                    partition = sql.Identifier(name)
+                    if table in self.SOURCE_TABLES:
+                        cur.execute(
+                            self.FIND_SOURCES_STMT.format(partition))
+                        source_ids.update(row[0] for row in cur.fetchall())
+                    cur.execute(sql.SQL('DROP TABLE {}').format(partition))
+                dropped += 1
+        created = 0
+        start = self.get_partition_start(table, threshold)
+        while start < now + lookahead:
+            if start not in partitions:
+                self.create_partition(conn, table, start)
+                created += 1
+            start += size
+        conn.commit()
+        if dropped or created:
+            logger.info(
+                'Dropped %d expired and created %d new %s partitions',
+                dropped, created, table)
+        return source_ids
+
+    def get_partition_start(self, table, timestamp):
+        size = self.TABLES[table][0]
+        return self.EPOCH + (timestamp - self.EPOCH) // size * size
+
+    def get_partitions(self, conn, table):
+        """Return a dict mapping the start of each partition to its name"""
+        prefix = f'{table}_p'
+        with conn.cursor() as cur:
+            cur.execute(self.FIND_PARTITIONS_STMT, (table, f'{prefix}%'))
+            names = [row[0] for row in cur.fetchall()]
+        return {
+            datetime.datetime.strptime(
+                name.removeprefix(prefix), self.NAME_FORMAT,
+            ).replace(tzinfo=datetime.timezone.utc): name
+            for name in names
+        }
+
+    def create_partition(self, conn, table, start):
+        end = start + self.TABLES[table][0]
+        name = f'{table}_p{start:{self.NAME_FORMAT}}'
+        with conn.cursor() as cur:
+            cur.execute(
+                self.CREATE_PARTITION_STMT.format(
+                    table=sql.Identifier(table),
+                    partition=sql.Identifier(name),
+                    default=sql.Identifier(f'{table}_default')),
+                {'start': start, 'end': end})
+        return name
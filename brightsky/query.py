@@ -1,4 +1,5 @@
 import datetime
+import itertools
 import json
 import os
 import tempfile
@@ -11,6 +12,7 @@ from pyproj import CRS, Transformer
 from shapely import MultiPolygon, STRtree, Point
 
 from brightsky.settings import settings
+from brightsky.storage import WEATHER_FIELDS, weather_view
 from brightsky.utils import USER_AGENT
 
 
@@ -26,14 +28,65 @@ class PgParams(dict):
     def __getitem__(self, key):
         return f'${self.map.setdefault(key, len(self.map) + 1)}'
 
-    def get_params(self):
-        get_value = super().__getitem__
-        return tuple(get_value(k) for k in self.map)
 
+class Statement:
+    """
+    A query with named `{parameters}`, rendered into SQL with positional
+    parameters once instead of on every request.
+    """
+
+    def __init__(self, query):
+        p = PgParams()
+        self.sql = query.format_map(p)
+        self.param_names = tuple(p.map)
+
+    def get_params(self, params):
+        return tuple(params[name] for name in self.param_names)
+
+
+_statements = {}
+
+
+def get_statements():
+    """
+    Return the catalog of all statements run by the query functions, for the
+    current weather storage settings.
+    """
+    key = weather_view()
+    if key not in _statements:
+        _statements[key] = {
+            name: Statement(query)
+            for name, query in _make_queries().items()
+        }
+    return _statements[key]
+
+
+async def _fetch(conn, name, **params):
+    statement = get_statements()[name]
+    return await conn.fetch(statement.sql, *statement.get_params(params))
 
-def topg(query, params):
-    p = PgParams(params)
-    return query.format_map(p), p.get_params()
+
+async def _fetchval(conn, name, **params):
+    statement = get_statements()[name]
+    return await conn.fetchval(statement.sql, *statement.get_params(params))
+
+
+async def prepare_statements(conn):
+    """
+    Run the statements of the catalog on `conn` once, with all parameters
+    set to NULL, which puts them into the connection's statement cache, from
+    where later queries pick them up prepared. With NULL parameters they
+    match no rows. Statements without parameters would do their full work
+    here and are left to be prepared on first use.
+
+    (asyncpg's public `Connection.prepare()` bypasses the statement cache,
+    and the `PreparedStatement` objects it returns are invalidated when the
+    connection is released back to the pool.)
+    """
+    for statement in get_statements().values():
+        if not statement.param_names:
+            continue
+        await conn.fetch(statement.sql, *([None] * len(statement.param_names)))
 
 
 def make_dicts(rows):
@@ -85,22 +138,167 @@ async def weather(
     }
 
 
-async def _weather(conn, date, last_date, source_ids):
-    params = {
-        'date': date,
-        'last_date': last_date,
-        'source_ids': source_ids,
-    }
-    sql = """
-        SELECT DISTINCT ON (timestamp) *
-        FROM weather
-        WHERE
-            timestamp BETWEEN {date} AND {last_date} AND
-            source_id = ANY({source_ids}::int[])
-        ORDER BY timestamp, array_position({source_ids}::int[], source_id)
+# Optional filters of the `sources` queries, by their parameter
+_SOURCES_FILTERS = {
+    'observation_types': (
+        'observation_type = ANY({observation_types}::observation_type[])'),
+    'date': 'last_record >= {date}',
+    'last_date': 'first_record <= {last_date}',
+}
+_DISTANCE = "earth_distance(ll_to_earth({lat}, {lon}), ll_to_earth(lat, lon))"
+
+
+def _sources_query_name(criterion, filters, ignore_type=False):
+    return '_'.join([
+        f'sources_by_{criterion}',
+        *(f'with_{f}' for f in filters),
+        *(['ignoring_type'] if ignore_type else []),
+    ])
+
+
+def _fallback_fields():
+    return [f for f in WEATHER_FIELDS if f not in IGNORED_MISSING_FIELDS]
+
+
+def _make_queries():
+    """
+    Return all queries run by the query functions, by name. Every query has
+    a fixed text so that it is prepared once per connection. Queries with
+    optional filters have one variant per combination of filters.
+
+    The fallback queries take one boolean `missing_<field>` parameter per
+    field. Their conditions on fields that are not missing are constant
+    false, which the planner folds away (custom plans), or skips with a
+    one-time filter (generic plans).
     """
-    sql, params = topg(sql, params)
-    rows = await conn.fetch(sql, *params)
+    weather = weather_view()
+    fallback_fields = _fallback_fields()
+    # The first three sources with values for each of the missing fields
+    fallback_sources = ' UNION '.join(
+        f"""(
+            SELECT source_id
+            FROM {weather}
+            WHERE
+                {{missing_{f}}} AND
+                timestamp BETWEEN {{date}} AND {{last_date}} AND
+                source_id = ANY({{source_ids}}::int[]) AND
+                {f} IS NOT NULL
+            GROUP BY source_id
+            ORDER BY array_position({{source_ids}}::int[], source_id)
+            LIMIT 3
+        )"""
+        for f in fallback_fields)
+    any_missing_is_set = ' OR '.join(
+        f'({{missing_{f}}} AND {f} IS NOT NULL)' for f in fallback_fields)
+    queries = {
+        'weather': f"""
+            SELECT DISTINCT ON (timestamp) *
+            FROM {weather}
+            WHERE
+                timestamp BETWEEN {{date}} AND {{last_date}} AND
+                source_id = ANY({{source_ids}}::int[])
+            ORDER BY
+                timestamp, array_position({{source_ids}}::int[], source_id)
+        """,
+        'weather_fallback_sources': fallback_sources,
+        'weather_fallback': f"""
+            SELECT *
+            FROM {weather}
+            WHERE
+                timestamp BETWEEN {{date}} AND {{last_date}} AND
+                source_id = ANY({{source_ids}}::int[]) AND
+                ({any_missing_is_set})
+            ORDER BY
+                timestamp, array_position({{source_ids}}::int[], source_id)
+        """,
+        'current_weather': """
+            SELECT *
+            FROM current_weather
+            WHERE source_id = ANY({source_ids}::int[])
+            ORDER BY array_position({source_ids}::int[], source_id)
+        """,
+        'synop': """
+            SELECT *
+            FROM synop
+            WHERE
+                timestamp BETWEEN {date} AND {last_date} AND
+                source_id = ANY({source_ids}::int[])
+            ORDER BY timestamp
+        """,
+        'radar_start': """
+            SELECT MAX(timestamp) - '3 hours'::interval FROM radar
+        """,
+        'radar': """
+            SELECT *
+            FROM radar
+            WHERE timestamp BETWEEN {date} AND {last_date}
+            ORDER BY timestamp
+        """,
+        'alerts': """
+            SELECT *
+            FROM alerts
+            JOIN (
+                SELECT alert_id, array_agg(warn_cell_id) as warn_cell_ids
+                FROM alert_cells
+                GROUP BY alert_id
+            ) cells ON alerts.id = cells.alert_id
+            ORDER BY severity DESC
+        """,
+        'alerts_by_warn_cell': """
+            SELECT *
+            FROM alerts
+            WHERE id IN (
+                SELECT alert_id
+                FROM alert_cells
+                WHERE warn_cell_id = {warn_cell_id}
+            )
+            ORDER BY severity DESC
+        """,
+    }
+    for filters in itertools.chain.from_iterable(
+            itertools.combinations(_SOURCES_FILTERS, n)
+            for n in range(len(_SOURCES_FILTERS) + 1)):
+        filters_sql = ''.join(
+            f' AND {_SOURCES_FILTERS[f]}' for f in filters)
+        for ignore_type in [False, True]:
+            order_by = 'distance' if ignore_type else (
+                'observation_type, distance')
+            name = _sources_query_name('location', filters, ignore_type)
+            queries[name] = f"""
+                SELECT *, round({_DISTANCE}) AS distance
+                FROM sources
+                WHERE
+                    earth_box(
+                        ll_to_earth({{lat}}, {{lon}}),
+                        {{max_dist}}
+                    ) @> ll_to_earth(lat, lon) AND
+                    {_DISTANCE} < {{max_dist}}
+                    {filters_sql}
+                ORDER BY {order_by}
+            """
+        for criterion, column, ids, type_ in [
+            ('id', 'id', 'source_ids', 'int'),
+            ('dwd_station_id', 'dwd_station_id', 'dwd_station_ids', 'text'),
+            ('wmo_station_id', 'wmo_station_id', 'wmo_station_ids', 'text'),
+        ]:
+            name = _sources_query_name(criterion, filters)
+            queries[name] = f"""
+                SELECT *
+                FROM sources
+                WHERE
+                    {column} = ANY({{{ids}}}::{type_}[])
+                    {filters_sql}
+                ORDER BY
+                    array_position({{{ids}}}::{type_}[], {column}::{type_}),
+                    observation_type
+            """
+    return queries
+
+
+async def _weather(conn, date, last_date, source_ids):
+    rows = await _fetch(
+        conn, 'weather',
+        date=date, last_date=last_date, source_ids=source_ids)
     return make_dicts(rows)
 
 
@@ -127,46 +325,21 @@ async def _fill_missing_fields(conn, weather_rows, source_ids):
         return
     min_date = incomplete_rows[0][0]['timestamp']
     max_date = incomplete_rows[-1][0]['timestamp']
-    not_null = ' OR '.join(f"{f} IS NOT NULL" for f in missing_fields)
     params = {
         'date': min_date,
         'last_date': max_date,
         'source_ids': source_ids,
+        **{f'missing_{f}': f in missing_fields for f in _fallback_fields()},
     }
     if (max_date - min_date).days >= 3:
-        per_field_sql = ' UNION '.join(
-            f"""(
-            SELECT source_id
-            FROM weather
-            WHERE
-                timestamp BETWEEN {{date}} AND {{last_date}} AND
-                source_id = ANY({{source_ids}}::int[]) AND
-                {f} IS NOT NULL
-            GROUP BY source_id
-            ORDER BY array_position({{source_ids}}::int[], source_id)
-            LIMIT 3
-            )"""
-            for f in missing_fields
-        )
-        trim_sql, trim_params = topg(per_field_sql, params)
-        useful_ids = [
+        useful_ids = {
             r['source_id']
-            for r in await conn.fetch(trim_sql, *trim_params)
-        ]
+            for r in await _fetch(conn, 'weather_fallback_sources', **params)
+        }
         if not useful_ids:
             return
-        params['source_ids'] = useful_ids
-    sql = f"""
-        SELECT *
-        FROM weather
-        WHERE
-            timestamp BETWEEN {{date}} AND {{last_date}} AND
-            source_id = ANY({{source_ids}}::int[]) AND
-            ({not_null})
-        ORDER BY timestamp, array_position({{source_ids}}::int[], source_id)
-    """
-    sql, params = topg(sql, params)
-    all_rows = await conn.fetch(sql, *params)
+        params['source_ids'] = [i for i in source_ids if i in useful_ids]
+    all_rows = await _fetch(conn, 'weather_fallback', **params)
     fallback_by_ts = {}
     for fb_row in all_rows:
         fallback_by_ts.setdefault(fb_row['timestamp'], []).append(fb_row)
@@ -210,15 +383,8 @@ async def current_weather(
     )
     sources_rows = sources_data['sources']
     source_ids = [row['id'] for row in sources_rows]
-    params = {'source_ids': source_ids}
-    sql = """
-        SELECT *
-        FROM current_weather
-        WHERE source_id = ANY({source_ids}::int[])
-        ORDER BY array_position({source_ids}::int[], source_id)
-    """
-    sql, params = topg(sql, params)
-    rows = make_dicts(await conn.fetch(sql, *params))
+    rows = make_dicts(
+        await _fetch(conn, 'current_weather', source_ids=source_ids))
     if not rows:
         raise NoData(
             "Could not find current weather for your location criteria",
@@ -251,21 +417,9 @@ async def synop(
     )
     sources_rows = sources_data['sources']
     source_ids = [row['id'] for row in sources_rows]
-    sql = """
-        SELECT *
-        FROM synop
-        WHERE
-            timestamp BETWEEN {date} AND {last_date} AND
-            source_id = ANY({source_ids}::int[])
-        ORDER BY timestamp
-        """
-    params = {
-        'date': date,
-        'last_date': last_date,
-        'source_ids': source_ids,
-    }
-    sql, params = topg(sql, params)
-    rows = await conn.fetch(sql, *params)
+    rows = await _fetch(
+        conn, 'synop',
+        date=date, last_date=last_date, source_ids=source_ids)
     return {
         'weather': make_dicts(rows),
         'sources': make_dicts(sources_rows),
@@ -284,9 +438,7 @@ async def radar(
 ):
     extra = {}
     if not date:
-        date = await conn.fetchval(
-            "SELECT MAX(timestamp) - '3 hours'::interval FROM radar"
-        )
+        date = await _fetchval(conn, 'radar_start')
     if not last_date:
         last_date = date + datetime.timedelta(hours=2)
     if lat is not None and lon is not None:
@@ -307,18 +459,8 @@ async def radar(
             'x': round(x - bbox[1], 3),
             'y': round(y - bbox[0], 3),
         }
-    sql = """
-        SELECT *
-        FROM radar
-        WHERE timestamp BETWEEN {date} AND {last_date}
-        ORDER BY timestamp
-        """
-    params = {
-        'date': date,
-        'last_date': last_date,
-    }
-    sql, params = topg(sql, params)
-    rows = make_dicts(await conn.fetch(sql, *params))
+    rows = make_dicts(
+        await _fetch(conn, 'radar', date=date, last_date=last_date))
     if fmt == 'plain':
         for row in rows:
             row['precipitation_5'] = _load_radar(row['precipitation_5'], bbox)
@@ -420,33 +562,10 @@ async def alerts(
                 "district (Landkreis) ids"
             )
     else:
-        sql = """
-            SELECT *
-            FROM alerts
-            JOIN (
-                SELECT alert_id, array_agg(warn_cell_id) as warn_cell_ids
-                FROM alert_cells
-                GROUP BY alert_id
-            ) cells ON alerts.id = cells.alert_id
-            ORDER BY severity DESC
-        """
-        rows = await conn.fetch(sql)
+        rows = await _fetch(conn, 'alerts')
         return {'alerts': make_dicts(rows)}
-    sql = """
-        SELECT *
-        FROM alerts
-        WHERE id IN (
-            SELECT alert_id
-            FROM alert_cells
-            WHERE warn_cell_id = {warn_cell_id}
-        )
-        ORDER BY severity DESC
-        """
-    params = {
-        'warn_cell_id': meta['warn_cell_id'],
-    }
-    sql, params = topg(sql, params)
-    rows = await conn.fetch(sql, *params)
+    rows = await _fetch(
+        conn, 'alerts_by_warn_cell', warn_cell_id=meta['warn_cell_id'])
     return {
         'alerts': make_dicts(rows),
         'location': meta,
@@ -521,8 +640,6 @@ async def sources(
     date=None,
     last_date=None,
 ):
-    select = "*"
-    order_by = "observation_type"
     params = {
         'lat': lat,
         'lon': lon,
@@ -534,56 +651,21 @@ async def sources(
         'date': date,
         'last_date': last_date,
     }
+    filters = [f for f in _SOURCES_FILTERS if params[f]]
     if source_ids:
-        where = "id = ANY({source_ids}::int[])"
-        order_by = "array_position({source_ids}, id), observation_type"
+        name = _sources_query_name('id', filters)
     elif dwd_station_ids:
-        where = "dwd_station_id = ANY({dwd_station_ids}::text[])"
-        order_by = """
-            array_position({dwd_station_ids}, dwd_station_id::text),
-            observation_type
-        """
+        name = _sources_query_name('dwd_station_id', filters)
     elif wmo_station_ids:
-        where = "wmo_station_id = ANY({wmo_station_ids}::text[])"
-        order_by = """
-            array_position({wmo_station_ids}, wmo_station_id::text),
-            observation_type
-        """
+        name = _sources_query_name('wmo_station_id', filters)
     elif (lat is not None and lon is not None):
-        distance = """
-            earth_distance(ll_to_earth({lat}, {lon}), ll_to_earth(lat, lon))
-        """
-        select += f", round({distance}) AS distance"
-        where = f"""
-            earth_box(
-                ll_to_earth({{lat}}, {{lon}}),
-                {{max_dist}}
-            ) @> ll_to_earth(lat, lon) AND
-            {distance} < {{max_dist}}
-        """
-        if ignore_type:
-            order_by = "distance"
-        else:
-            order_by += ", distance"
+        name = _sources_query_name('location', filters, ignore_type)
     else:
         raise ValueError(
             "Please supply lat & lon, or dwd_station_ids, or wmo_station_ids, "
             "or source_ids",
         )
-    if observation_types:
-        where += " AND observation_type = ANY({observation_types}::observation_type[])"  # noqa
-    if date is not None:
-        where += " AND last_record >= {date}"
-    if last_date is not None:
-        where += " AND first_record <= {last_date}"
-    sql = f"""
-        SELECT {select}
-        FROM sources
-        WHERE {where}
-        ORDER BY {order_by}
-    """
-    sql, params = topg(sql, params)
-    rows = await conn.fetch(sql, *params)
+    rows = await _fetch(conn, name, **params)
     if not rows:
         raise NoData("No sources match your criteria")
     return {'sources': make_dicts(rows)}
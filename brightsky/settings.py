@@ -12,7 +12,14 @@ CORS_ALLOW_ALL_HEADERS = False
 CORS_ALLOWED_ORIGINS = []
 CORS_ALLOWED_HEADERS = []
 DATABASE_CONNECTION_POOL_SIZE = cpu_count()
+DATABASE_REPLICA_CHECK_INTERVAL = 5.0
+DATABASE_REPLICA_MAX_LAG = 30.0
+DATABASE_REPLICA_URLS = []
 DATABASE_URL = 'postgres://localhost'
+EXPORT_METHOD = 'insert'
+EXPORT_PIPELINE_DEPTH = 0
+EXPORT_SKIP_UNCHANGED = False
+FORECAST_GENERATIONS = False
 ICON_CLOUDY_THRESHOLD = 80
 ICON_PARTLY_CLOUDY_THRESHOLD = 25
 ICON_RAIN_THRESHOLD = 0.5
@@ -21,14 +28,20 @@ IGNORED_CURRENT_OBSERVATIONS_STATIONS = ['K386']
 KEEP_DOWNLOADS = False
 MIN_DATE = datetime.datetime(2010, 1, 1, tzinfo=tzutc())
 MAX_DATE = None
+MERGE_OBSERVATION_FILES = False
+MOSMIX_STREAMING = False
+PARSE_PROCESSES = 0
 POLLING_CRONTAB_MINUTE = '*'
 REDIS_URL = 'redis://localhost'
 SERVER_URL = 'http://localhost:5000'
+STATION_LOCATIONS_MAX_AGE = 3600
+SYNOP_COALESCE_DELAY = 0.0
 WARN_CELLS_URL = (
     'https://maps.dwd.de/geoserver/wfs'
     '?SERVICE=WFS&VERSION=2.0.0&REQUEST=GetFeature'
     '&TYPENAMES=Warngebiete_Gemeinden&OUTPUTFORMAT=json'
 )
+WEATHER_STORAGE = 'default'
 
 
 def _make_bool(bool_str):
@@ -0,0 +1,84 @@
+import numpy as np
+
+from brightsky.settings import settings
+
+
+COMPACT_WEATHER_TABLE = 'weather_compact'
+COMPACT_WEATHER_VIEW = 'weather_compact_decoded'
+
+# Element columns of the weather table, in table order
+WEATHER_FIELDS = [
+    'precipitation',
+    'pressure_msl',
+    'sunshine',
+    'temperature',
+    'wind_direction',
+    'wind_speed',
+    'cloud_cover',
+    'dew_point',
+    'relative_humidity',
+    'visibility',
+    'wind_gust_direction',
+    'wind_gust_speed',
+    'condition',
+    'precipitation_probability',
+    'precipitation_probability_6h',
+    'solar',
+]
+
+# Fields that the compact weather table stores as scaled `smallint`s, mapped
+# to their `(scale, offset)`. Values are stored as
+# `round((value - offset) * scale)`, the `weather_compact_decoded` view
+# decodes them back to their SI unit.
+SCALED_FIELDS = {
+    # 0.1 °C
+    'dew_point': (10, 273.15),
+    'temperature': (10, 273.15),
+    # 0.01 mm
+    'precipitation': (100, 0),
+    # 0.1 hPa
+    'pressure_msl': (0.1, 0),
+    # 0.1 m/s
+    'wind_gust_speed': (10, 0),
+    'wind_speed': (10, 0),
+}
+
+
+def weather_table():
+    """Name of the table the weather records are written to"""
+    if settings.WEATHER_STORAGE == 'compact':
+        return COMPACT_WEATHER_TABLE
+    return 'weather'
+
+
+def weather_view():
+    """Name of the relation to read decoded weather records from"""
+    if settings.WEATHER_STORAGE == 'compact':
+        return COMPACT_WEATHER_VIEW
+    return 'weather'
+
+
+def encode_value(field, value):
+    if value is None or field not in SCALED_FIELDS:
+        return value
+    scale, offset = SCALED_FIELDS[field]
+    x = (value - offset) * scale
+    # Round half away from zero, like the binary COPY writer
+    return int(x + 0.5) if x >= 0 else -int(-x + 0.5)
+
+
+def encode_column(field, values, valid):
+    """Encode the valid entries of a column, returning an integer array"""
+    if field not in SCALED_FIELDS:
+        return values
+    scale, offset = SCALED_FIELDS[field]
+    x = np.zeros(len(values))
+    x[valid] = (values[valid].astype(float) - offset) * scale
+    return np.trunc(x + np.copysign(0.5, x)).astype('i8')
+
+
+def encode_record(record):
+    for field in SCALED_FIELDS.keys() & record.keys():
+        record[field] = encode_value(field, record[field])
+    return record
+
@@ -1,16 +1,36 @@
+import heapq
 import logging
+import multiprocessing
+import operator
 import os
+import pickle
+import queue
+import re
 import tempfile
+import threading
+import traceback
+
+from dwdparse.stations import _converter as station_converter
 
 from brightsky.db import get_connection
+from brightsky.export import DBExporter, batched, iter_records
 from brightsky.parsers import get_parser
+from brightsky.partitions import PartitionManager
 from brightsky.polling import DWDPoller
+from brightsky.settings import settings
+from brightsky.storage import weather_table
 from brightsky.utils import download
-from brightsky.worker import huey, process
+from brightsky.worker import huey, process, process_merged
 
 
 logger = logging.getLogger('brightsky')
 
+PARSE_PROCESS_BATCH_SIZE = 1000
+PARSE_PROCESS_QUEUE_SIZE = 10
+
+_parse_slots = None
+_parse_slots_lock = threading.Lock()
+
 
 def parse(url):
     parser = get_parser(os.path.basename(url))()
@@ -21,7 +41,174 @@ def parse(url):
             for kwarg, extra_url in parser.get_extra_urls(path).items()
         }
         exporter = parser.exporter()
-        exporter.export(parser.parse(path, **extra), fingerprint=fingerprint)
+        exporter.export(
+            parse_records(parser, path, **extra), fingerprint=fingerprint)
+
+
+def parse_records(parser, path, wait=True, **extra):
+    """
+    Parse records from `path`, in a separate process if parsing it is
+    CPU-bound and `settings.PARSE_PROCESSES` is set.
+
+    Without `wait`, the records are parsed in this process instead of
+    waiting for a free process slot.
+    """
+    if settings.PARSE_PROCESSES and parser.is_cpu_bound(path):
+        return _parse_in_process(type(parser), path, extra, wait=wait)
+    return parser.parse(path, **extra)
+
+
+def _get_parse_slots():
+    global _parse_slots
+    with _parse_slots_lock:
+        if _parse_slots is None:
+            _parse_slots = threading.BoundedSemaphore(settings.PARSE_PROCESSES)
+        return _parse_slots
+
+
+def _parse_in_process(parser_cls, path, extra, wait=True):
+    slots = _get_parse_slots()
+    if not slots.acquire(blocking=wait):
+        logger.info('No free parser process for %s, parsing in thread', path)
+        yield from parser_cls().parse(path, **extra)
+        return
+    # Spawn instead of fork, the worker is running other threads
+    ctx = multiprocessing.get_context('spawn')
+    batches = ctx.Queue(maxsize=PARSE_PROCESS_QUEUE_SIZE)
+    try:
+        process = ctx.Process(
+            target=_parse_worker,
+            args=(
+                parser_cls, path, extra, dict(settings),
+                (station_converter.dwd_to_wmo, station_converter.wmo_to_dwd),
+                batches),
+            daemon=True)
+        process.start()
+        logger.info('Parsing %s in process %d', path, process.pid)
+        try:
+            while True:
+                try:
+                    kind, payload = batches.get(timeout=1)
+                except queue.Empty:
+                    if process.is_alive():
+                        continue
+                    # Give the queue a last chance to deliver what the
+                    # process sent before exiting
+                    try:
+                        kind, payload = batches.get(timeout=1)
+                    except queue.Empty:
+                        raise RuntimeError(
+                            f'Parser process exited with code '
+                            f'{process.exitcode}') from None
+                if kind == 'batch':
+                    yield from payload
+                elif kind == 'error':
+                    raise payload
+                else:
+                    break
+        finally:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+    finally:
+        slots.release()
+
+
+def _parse_worker(
+        parser_cls, path, extra, parent_settings, station_ids, batches):
+    # Inherit what the parent loaded instead of fetching it again
+    settings.update(parent_settings)
+    settings.loaded = True
+    station_converter.dwd_to_wmo, station_converter.wmo_to_dwd = station_ids
+    try:
+        records = parser_cls().parse(path, **extra)
+        for batch in batched(records, PARSE_PROCESS_BATCH_SIZE):
+            batches.put(('batch', batch))
+    except Exception as e:
+        try:
+            pickle.dumps(e)
+        except Exception:
+            e = RuntimeError(''.join(traceback.format_exception(e)))
+        batches.put(('error', e))
+    else:
+        batches.put(('done', None))
+
+
+def parse_merged(urls):
+    """
+    Parse several observation files of the same station and export their
+    merged records, so that each weather row is written once instead of once
+    per file.
+    """
+    parsers = [get_parser(os.path.basename(url))() for url in urls]
+    exporters = {parser.exporter for parser in parsers}
+    if len(exporters) != 1:
+        raise ValueError('Can only merge files that share their exporter')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        record_iters = []
+        fingerprints = []
+        for url, parser in zip(urls, parsers):
+            path, fingerprint = download(url, tmpdir)
+            extra = {
+                kwarg: download(extra_url, tmpdir)[0]
+                for kwarg, extra_url in parser.get_extra_urls(path).items()
+            }
+            # All files are parsed side by side, waiting for a process slot
+            # while holding another could deadlock
+            record_iters.append(iter_records(
+                parse_records(parser, path, wait=False, **extra)))
+            fingerprints.append(fingerprint)
+        logger.info('Merging records from %d files', len(urls))
+        exporter = exporters.pop()()
+        exporter.export_many([
+            (merge_records(record_iters), None),
+            *(([], fingerprint) for fingerprint in fingerprints),
+        ])
+
+
+def merge_records(record_iters):
+    """
+    Merge several streams of records sorted by timestamp (like those of
+    observation files) into one, combining the records of the same source
+    and timestamp. Later streams take precedence.
+
+    Only the records of one timestamp are held in memory at a time.
+    """
+    merged = {}
+    timestamp = None
+    for record in heapq.merge(
+            *(_ensure_sorted(records) for records in record_iters),
+            key=operator.itemgetter('timestamp')):
+        if record['timestamp'] != timestamp:
+            yield from merged.values()
+            merged = {}
+            timestamp = record['timestamp']
+        key = tuple(record[f] for f in DBExporter.SOURCE_FIELDS)
+        merged.setdefault(key, {}).update(record)
+    yield from merged.values()
+
+
+def _ensure_sorted(records):
+    last = None
+    for record in records:
+        if last is not None and record['timestamp'] < last:
+            raise ValueError('Cannot merge records not sorted by timestamp')
+        last = record['timestamp']
+        yield record
+
+
+def group_station_files(urls):
+    """
+    Group hourly observation files by station and archive ('akt' or 'hist'),
+    in the order their first file appears in `urls`.
+    """
+    groups = {}
+    for url in urls:
+        m = re.search(
+            r'/stundenwerte_[A-Z0-9]+_(\d{5})_(?:.*_)?(akt|hist)\.zip$', url)
+        key = m.groups() if m else url
+        groups.setdefault(key, []).append(url)
+    return list(groups.values())
 
 
 def poll(enqueue=False):
@@ -30,22 +217,35 @@ def poll(enqueue=False):
         if (expired_locks := huey.expire_locks(1800)):
             logger.warning(
                 'Removed expired locks: %s', ', '.join(expired_locks))
-        pending_urls = [
-            t.args[0] for t in huey.pending() if t.name == 'process']
+        pending_urls = set()
+        for t in huey.pending():
+            if t.name == 'process':
+                pending_urls.add(t.args[0])
+            elif t.name == 'process_merged':
+                pending_urls.update(t.args[0])
         enqueued = 0
-        for updated_file in updated_files:
-            url = updated_file['url']
-            if url in pending_urls:
-                logger.debug('Skipping "%s": already queued', url)
+        if settings.MERGE_OBSERVATION_FILES:
+            url_groups = group_station_files(f['url'] for f in updated_files)
+        else:
+            url_groups = [[f['url']] for f in updated_files]
+        for urls in url_groups:
+            if any(url in pending_urls for url in urls):
+                logger.debug('Skipping "%s": already queued', urls[0])
                 continue
-            elif huey.is_locked(url):
-                logger.debug('Skipping "%s": already running', url)
+            elif any(huey.is_locked(url) for url in urls):
+                logger.debug('Skipping "%s": already running', urls[0])
                 continue
-            logger.debug('Enqueueing "%s"', url)
-            parser_cls = get_parser(os.path.basename(url))
-            process(url, priority=parser_cls.PRIORITY)
-            enqueued += 1
-        queue_size = len([t for t in huey.pending() if t.name == 'process'])
+            parser_cls = get_parser(os.path.basename(urls[0]))
+            if len(urls) == 1:
+                logger.debug('Enqueueing "%s"', urls[0])
+                process(urls[0], priority=parser_cls.PRIORITY)
+            else:
+                logger.debug('Enqueueing merged "%s"', '", "'.join(urls))
+                process_merged(urls, priority=parser_cls.PRIORITY)
+            enqueued += len(urls)
+        queue_size = len([
+            t for t in huey.pending()
+            if t.name in ('process', 'process_merged')])
         logger.info(
             'Enqueued %d updated files for processing. Queue size: %d',
             enqueued,
@@ -54,9 +254,37 @@ def poll(enqueue=False):
     return updated_files
 
 
+def update_record_ranges(cur, table, source_ids):
+    """
+    Recompute `first_record` and `last_record` of the given sources from
+    their records in `table`, leaving sources without records untouched.
+    """
+    cur.execute(
+        f"""
+        UPDATE sources SET
+          first_record = record_range.first_record,
+          last_record = record_range.last_record
+        FROM (
+          SELECT
+            id AS source_id,
+            (
+              SELECT MIN(timestamp) FROM {table} WHERE source_id = id
+            ) AS first_record,
+            (
+              SELECT MAX(timestamp) FROM {table} WHERE source_id = id
+            ) AS last_record
+          FROM unnest(%s::int[]) AS id
+        ) AS record_range
+        WHERE
+          sources.id = record_range.source_id AND
+          record_range.first_record IS NOT NULL;
+        """,
+        (sorted(source_ids),))
+
+
 def clean():
     expiry_intervals = {
-        'weather': {
+        weather_table(): {
             'forecast': '3 hours',
             'current': '48 hours',
         },
@@ -70,43 +298,58 @@ def clean():
         '%/DE1200_RV%': '1 week',
         '%/composite_rv%': '1 week',
     }
+    partition_expiry_intervals = {
+        'synop': expiry_intervals['synop']['synop'],
+        'radar': radar_expiry_interval,
+    }
     with get_connection() as conn:
+        # Dropping expired partitions leaves only the records of the oldest
+        # remaining partitions for the deletes below
+        logger.info(
+            'Maintaining partitions: %s', partition_expiry_intervals)
+        partitions = PartitionManager()
+        affected_source_ids = {
+            table: partitions.maintain(conn, table, interval)
+            for table, interval in partition_expiry_intervals.items()
+        }
+        # `weather` is not partitioned: it holds historical records of all
+        # years, and forecast generations are attached to it as inheritance
+        # children, which partitioned tables cannot have. Its expired current
+        # records are still deleted row by row.
         with conn.cursor() as cur:
             logger.info(
                 'Deleting expired weather records: %s', expiry_intervals)
             for table, table_expires in expiry_intervals.items():
+                source_ids = affected_source_ids.get(table, set())
                 for observation_type, interval in table_expires.items():
                     cur.execute(
                         f"""
-                        DELETE FROM {table} WHERE
-                            source_id IN (
-                                SELECT id FROM sources
-                                WHERE observation_type = %s) AND
-                            timestamp < current_timestamp - %s::interval;
+                        WITH deleted AS (
+                            DELETE FROM {table} WHERE
+                                source_id IN (
+                                    SELECT id FROM sources
+                                    WHERE observation_type = %s) AND
+                                timestamp < current_timestamp - %s::interval
+                            RETURNING source_id
+                        )
+                        SELECT source_id, COUNT(*) FROM deleted
+                        GROUP BY source_id;
                         """,
                         (observation_type, interval),
                     )
+                    rows = cur.fetchall()
                     conn.commit()
-                    if cur.rowcount:
+                    if rows:
                         logger.info(
                             'Deleted %d outdated %s weather records from %s',
-                            cur.rowcount, observation_type, table)
-                cur.execute(
-                    f"""
-                    UPDATE sources SET
-                      first_record = record_range.first_record,
-                      last_record = record_range.last_record
-                    FROM (
-                      SELECT
-                        source_id,
-                        MIN(timestamp) AS first_record,
-                        MAX(timestamp) AS last_record
-                      FROM {table}
-                      GROUP BY source_id
-                    ) AS record_range
-                    WHERE sources.id = record_range.source_id;
-                    """)
-                conn.commit()
+                            sum(row[1] for row in rows), observation_type,
+                            table)
+                    source_ids.update(row[0] for row in rows)
+                # Exporters only ever widen the record ranges, narrow them for
+                # the sources that lost records
+                if source_ids:
+                    update_record_ranges(cur, table, source_ids)
+                    conn.commit()
             logger.info('Deleting expired radar records')
             cur.execute(
                 """
@@ -118,6 +361,11 @@ def clean():
             conn.commit()
             if cur.rowcount:
                 logger.info('Deleted %d outdated radar records', cur.rowcount)
+            # SYNOP exports only recompute the current weather of the stations
+            # they touched, catch up on all others once in a while
+            logger.info('Refreshing current weather')
+            cur.execute('SELECT refresh_current_weather()')
+            conn.commit()
             logger.info(
                 'Deleting expired parsed files: %s',
                 parsed_files_expiry_intervals)
@@ -3,7 +3,6 @@ import contextlib
 from pathlib import Path
 from typing import Any, Annotated
 
-import asyncpg
 import orjson
 from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
@@ -31,6 +30,7 @@ from .params import (
     SynopParams,
     WeatherParams,
 )
+from .replicas import DatabasePools
 
 
 with open(Path(__file__).parent / 'intro.md') as f:
@@ -66,19 +66,25 @@ async def init_connection(conn):
         decoder=float,
         schema='pg_catalog',
     )
+    await query.prepare_statements(conn)
 
 
 @contextlib.asynccontextmanager
 async def lifespan(app: FastAPI):
-    async with asyncpg.create_pool(
-        dsn=settings.DATABASE_URL,
+    async with DatabasePools(
+        settings.DATABASE_URL,
+        replica_dsns=settings.DATABASE_REPLICA_URLS,
+        max_lag=settings.DATABASE_REPLICA_MAX_LAG,
+        check_interval=settings.DATABASE_REPLICA_CHECK_INTERVAL,
         min_size=1,
         max_size=settings.DATABASE_CONNECTION_POOL_SIZE,
+        # The statement catalog is small and fixed, keep it prepared
+        max_cached_statement_lifetime=0,
         init=init_connection,
-    ) as pool:
-        ctx['pool'] = pool
+    ) as pools:
+        ctx['pools'] = pools
         yield
-        del ctx['pool']
+        del ctx['pools']
 
 
 def make_app():
@@ -145,7 +151,7 @@ async def sources(
     `wmo_station_id`, or `source_id`.
     """
     result = await query.sources(
-        ctx['pool'],
+        ctx['pools'].reader(),
         lat=q.lat,
         lon=q.lon,
         max_dist=q.max_dist,
@@ -181,7 +187,7 @@ async def current_weather(
     past one and a half hours.
     """
     result = await query.current_weather(
-        ctx['pool'],
+        ctx['pools'].reader(),
         lat=q.lat,
         lon=q.lon,
         max_dist=q.max_dist,
@@ -211,7 +217,7 @@ async def weather(
     `wmo_station_id`, or `source_id`.
     """
     result = await query.weather(
-        ctx['pool'],
+        ctx['pools'].reader(),
         date=q.date,
         last_date=q.last_date,
         lat=q.lat,
@@ -256,7 +262,7 @@ async def synop(
     weather" record.
     """
     result = await query.synop(
-        ctx['pool'],
+        ctx['pools'].reader(),
         date=q.date,
         last_date=q.last_date,
         dwd_station_ids=q.dwd_station_ids,
@@ -468,7 +474,7 @@ async def radar(
                 ),
             )
     result = await query.radar(
-        ctx['pool'],
+        ctx['pools'].reader(),
         date=q.date,
         last_date=q.last_date,
         lat=q.lat,
@@ -521,7 +527,7 @@ async def alerts(
     * [DWD Documentation on alert fields and their allowed contents (German)](https://www.dwd.de/DE/leistungen/opendata/help/warnungen/cap_dwd_profile_de_pdf_2_1_13.pdf?__blob=publicationFile&v=3)
     """
     result = await query.alerts(
-        ctx['pool'],
+        ctx['pools'].reader(),
         lat=q.lat,
         lon=q.lon,
         warn_cell_id=q.warn_cell_id,
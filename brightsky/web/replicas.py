@@ -0,0 +1,192 @@
+import asyncio
+import contextlib
+import itertools
+import logging
+
+import asyncpg
+
+
+logger = logging.getLogger(__name__)
+
+
+# Errors that mean a replica cannot serve queries right now, as opposed to
+# errors in the queries themselves
+CONNECTION_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.InterfaceError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.CannotConnectNowError,
+    asyncpg.AdminShutdownError,
+)
+
+
+class Replica:
+
+    def __init__(self, dsn, pool):
+        self.dsn = dsn
+        self.pool = pool
+        # Unknown until the first check
+        self.healthy = None
+        self.lag = None
+
+    def __repr__(self):
+        return f'<Replica {self.dsn}>'
+
+
+class DatabasePools:
+    """
+    Connection pools for the primary database and its read replicas.
+
+    Replicas are checked every `check_interval` seconds, and only those that
+    can be reached and lag at most `max_lag` seconds behind the primary
+    serve reads (in turn). Without any healthy replica, reads go to the
+    primary.
+    """
+
+    # Position of the primary's WAL, which replicas must have replayed to be
+    # up to date
+    PRIMARY_LSN_STMT = 'SELECT pg_current_wal_lsn();'
+    # Replication lag in seconds. A replica that replayed the primary's WAL up
+    # to its position at the start of the check is up to date, even if the
+    # primary has not written anything in a while. Otherwise, its lag is the
+    # age of the last transaction it replayed, which keeps growing while its
+    # WAL receiver is disconnected or stalled. Without the primary's position
+    # (if it cannot be reached), a replica is only up to date if its WAL
+    # receiver is streaming and it replayed everything it received.
+    # Non-replicas have no lag.
+    LAG_STMT = """
+        SELECT CASE
+            WHEN NOT pg_is_in_recovery() THEN 0
+            WHEN pg_last_wal_replay_lsn() >= $1::pg_lsn THEN 0
+            WHEN
+                $1::pg_lsn IS NULL AND
+                pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() AND
+                EXISTS (
+                    SELECT 1 FROM pg_stat_wal_receiver
+                    WHERE status = 'streaming')
+            THEN 0
+            ELSE EXTRACT(
+                EPOCH FROM now() - pg_last_xact_replay_timestamp())
+        END;
+    """
+
+    def __init__(
+            self, dsn, replica_dsns=(), max_lag=30., check_interval=5.,
+            **pool_kwargs):
+        self.dsn = dsn
+        self.replica_dsns = list(replica_dsns)
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.pool_kwargs = pool_kwargs
+        self.primary = None
+        self.replicas = []
+        self._turns = itertools.count()
+        self._checks = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def open(self):
+        self.primary = await asyncpg.create_pool(
+            dsn=self.dsn, **self.pool_kwargs)
+        # Replica pools connect on demand, so that unreachable replicas do
+        # not keep the app from starting
+        for dsn in self.replica_dsns:
+            pool = await asyncpg.create_pool(
+                dsn=dsn, **{**self.pool_kwargs, 'min_size': 0})
+            self.replicas.append(Replica(dsn, pool))
+        if self.replicas:
+            await self.check_replicas()
+            self._checks = asyncio.create_task(self._check_periodically())
+
+    async def close(self):
+        if self._checks:
+            self._checks.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._checks
+            self._checks = None
+        for replica in self.replicas:
+            await replica.pool.close()
+        self.replicas = []
+        await self.primary.close()
+
+    async def _check_periodically(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            await self.check_replicas()
+
+    async def check_replicas(self):
+        try:
+            primary_lsn = await asyncio.wait_for(
+                self.primary.fetchval(self.PRIMARY_LSN_STMT),
+                timeout=self.check_interval)
+        except (*CONNECTION_ERRORS, asyncpg.PostgresError) as e:
+            logger.warning('Cannot find WAL position of primary: %r', e)
+            primary_lsn = None
+        await asyncio.gather(
+            *(self.check(r, primary_lsn) for r in self.replicas))
+
+    async def check(self, replica, primary_lsn=None):
+        try:
+            lag = await asyncio.wait_for(
+                replica.pool.fetchval(self.LAG_STMT, primary_lsn),
+                timeout=self.check_interval)
+        except (*CONNECTION_ERRORS, asyncpg.PostgresError) as e:
+            self.mark_unhealthy(replica, e)
+            return
+        replica.lag = None if lag is None else float(lag)
+        healthy = replica.lag is not None and replica.lag <= self.max_lag
+        if healthy != replica.healthy:
+            logger.info(
+                'Replica %s is %s (lag: %s s)', replica.dsn,
+                'healthy' if healthy else 'lagging', replica.lag)
+        replica.healthy = healthy
+
+    def mark_unhealthy(self, replica, error):
+        if replica.healthy is not False:
+            logger.warning('Replica %s is unreachable: %r', replica.dsn, error)
+        replica.healthy = False
+
+    def reader(self):
+        """
+        Return something to run read queries on, with the same `fetch` and
+        `fetchval` methods as a pool.
+        """
+        healthy = [r for r in self.replicas if r.healthy]
+        if not healthy:
+            return self.primary
+        replica = healthy[next(self._turns) % len(healthy)]
+        return ReplicaReader(self, replica)
+
+
+class ReplicaReader:
+    """
+    Run queries on a replica, falling back to the primary if the replica
+    turns out to be unreachable.
+    """
+
+    def __init__(self, pools, replica):
+        self.pools = pools
+        self.replica = replica
+
+    async def fetch(self, *args, **kwargs):
+        return await self._run('fetch', *args, **kwargs)
+
+    async def fetchval(self, *args, **kwargs):
+        return await self._run('fetchval', *args, **kwargs)
+
+    async def _run(self, method, *args, **kwargs):
+        if self.replica:
+            try:
+                return await getattr(self.replica.pool, method)(
+                    *args, **kwargs)
+            except CONNECTION_ERRORS as e:
+                self.pools.mark_unhealthy(self.replica, e)
+                # Stick to the primary for the rest of the request
+                self.replica = None
+        return await getattr(self.pools.primary, method)(*args, **kwargs)
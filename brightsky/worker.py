@@ -3,6 +3,7 @@ import pathlib
 import resource
 import threading
 import time
+from contextlib import ExitStack
 
 from dwdparse.stations import StationIDConverter, load_stations
 from dwdparse.utils import fetch
@@ -84,6 +85,14 @@ def process(url):
         tasks.parse(url)
 
 
+@huey.task()
+def process_merged(urls):
+    with ExitStack() as stack:
+        for url in urls:
+            stack.enter_context(huey.lock_task(url))
+        tasks.parse_merged(urls)
+
+
 @huey.periodic_task(
     crontab(minute=settings.POLLING_CRONTAB_MINUTE), priority=50)
 def poll():
@@ -0,0 +1,188 @@
+-- Turn current_weather into a table that SYNOP exports update incrementally
+-- for the stations they touched, instead of re-aggregating the last 90
+-- minutes of all stations on every export
+CREATE TABLE current_weather_new AS SELECT * FROM current_weather;
+DROP MATERIALIZED VIEW current_weather;
+ALTER TABLE current_weather_new RENAME TO current_weather;
+ALTER TABLE current_weather
+  ADD CONSTRAINT current_weather_key PRIMARY KEY (source_id),
+  ADD CONSTRAINT current_weather_source_id_fkey
+    FOREIGN KEY (source_id) REFERENCES sources(id) ON DELETE CASCADE;
+
+-- Recomputing single stations needs to look up their records by source
+ALTER TABLE synop
+  DROP CONSTRAINT synop_key,
+  ADD CONSTRAINT synop_key UNIQUE (source_id, timestamp);
+
+-- Same query as the materialized view, restricted to the given sources.
+-- Rows of stations that have not reported within the last 90 minutes are
+-- removed, just like they would have dropped out of the materialized view.
+-- Passing NULL recomputes all stations.
+CREATE FUNCTION refresh_current_weather(source_ids int[] DEFAULT NULL)
+RETURNS void LANGUAGE plpgsql AS $$
+BEGIN
+  IF source_ids IS NULL THEN
+    source_ids := ARRAY(
+      SELECT source_id FROM current_weather
+      UNION
+      SELECT source_id FROM synop
+      WHERE timestamp >= now() - '90 minutes'::interval);
+  END IF;
+  DELETE FROM current_weather
+  WHERE
+    source_id = ANY(source_ids) OR
+    timestamp < now() - '90 minutes'::interval;
+  INSERT INTO current_weather
+    WITH last_timestamp AS (
+      SELECT
+        source_id,
+        MAX(timestamp) AS last_timestamp
+      FROM synop
+      WHERE
+        source_id = ANY(source_ids) AND
+        timestamp >= now() - '90 minutes'::interval
+      GROUP BY source_id
+    )
+    SELECT
+      last_timestamp.source_id,
+      last_timestamp.last_timestamp AS timestamp,
+      latest.cloud_cover,
+      latest.condition,
+      latest.dew_point,
+      latest.solar_10,
+      last_half_hour.solar_30,
+      last_hour.solar_60,
+      latest.precipitation_10,
+      last_half_hour.precipitation_30,
+      last_hour.precipitation_60,
+      latest.pressure_msl,
+      latest.relative_humidity,
+      latest.visibility,
+      latest.wind_direction_10,
+      last_half_hour.wind_direction_30,
+      last_hour.wind_direction_60,
+      latest.wind_speed_10,
+      last_half_hour.wind_speed_30,
+      last_hour.wind_speed_60,
+      latest.wind_gust_direction_10,
+      last_half_hour.wind_gust_direction_30,
+      last_hour.wind_gust_direction_60,
+      latest.wind_gust_speed_10,
+      last_half_hour.wind_gust_speed_30,
+      last_hour.wind_gust_speed_60,
+      sunshine.sunshine_30,
+      sunshine.sunshine_60,
+      latest.temperature
+    FROM last_timestamp
+    JOIN (
+      SELECT
+        source_id,
+        LAST(cloud_cover ORDER BY timestamp) AS cloud_cover,
+        LAST(condition ORDER BY timestamp) AS condition,
+        LAST(dew_point ORDER BY timestamp) AS dew_point,
+        LAST(solar_10 ORDER BY timestamp) AS solar_10,
+        LAST(precipitation_10 ORDER BY timestamp) AS precipitation_10,
+        LAST(pressure_msl ORDER BY timestamp) AS pressure_msl,
+        LAST(relative_humidity ORDER BY timestamp) AS relative_humidity,
+        LAST(visibility ORDER BY timestamp) AS visibility,
+        LAST(wind_direction_10 ORDER BY timestamp) AS wind_direction_10,
+        LAST(wind_speed_10 ORDER BY timestamp) AS wind_speed_10,
+        LAST(wind_gust_direction_10 ORDER BY timestamp) AS wind_gust_direction_10,
+        LAST(wind_gust_speed_10 ORDER BY timestamp) AS wind_gust_speed_10,
+        LAST(temperature ORDER BY timestamp) AS temperature
+      FROM synop s
+      WHERE
+        source_id = ANY(source_ids) AND
+        timestamp >= now() - '90 minutes'::interval
+      GROUP BY source_id
+    ) latest ON last_timestamp.source_id = latest.source_id
+    LEFT JOIN (
+      SELECT
+        synop.source_id,
+        round(AVG(solar_10) * 6)::int AS solar_60,
+        round(AVG(precipitation_10) * 6 * 100) / 100 AS precipitation_60,
+        round(AVG(wind_speed_10) * 10) / 10 AS wind_speed_60,
+        (round(atan2d(AVG(sind(wind_direction_10)), AVG(cosd(wind_direction_10))))::int + 360) % 360 AS wind_direction_60,
+        MAX(wind_gust_speed_10) AS wind_gust_speed_60,
+        LAST(wind_gust_direction_10 ORDER BY wind_gust_speed_10) AS wind_gust_direction_60
+      FROM synop
+      JOIN last_timestamp ON synop.source_id = last_timestamp.source_id
+      WHERE timestamp > last_timestamp - '60 minutes'::interval
+      GROUP BY synop.source_id
+    ) last_hour ON latest.source_id = last_hour.source_id
+    LEFT JOIN (
+      SELECT
+        synop.source_id,
+        round(AVG(solar_10) * 3)::int AS solar_30,
+        round(AVG(precipitation_10) * 3 * 100) / 100 AS precipitation_30,
+        round(AVG(wind_speed_10) * 10) / 10 AS wind_speed_30,
+        (round(atan2d(AVG(sind(wind_direction_10)), AVG(cosd(wind_direction_10))))::int + 360) % 360 AS wind_direction_30,
+        MAX(wind_gust_speed_10) AS wind_gust_speed_30,
+        LAST(wind_gust_direction_10 ORDER BY wind_gust_speed_10) AS wind_gust_direction_30
+      FROM synop
+      JOIN last_timestamp ON synop.source_id = last_timestamp.source_id
+      WHERE timestamp > last_timestamp - '30 minutes'::interval
+      GROUP BY synop.source_id
+    ) last_half_hour ON latest.source_id = last_half_hour.source_id
+    -- Same as the view's sunshine subquery, but looked up per station so
+    -- that the cost only depends on the number of touched stations
+    LEFT JOIN LATERAL (
+      SELECT
+        CASE
+          WHEN s30_latest.timestamp > s60.timestamp THEN s30_latest.sunshine_30
+          ELSE s60.sunshine_60 - s30_latest.sunshine_30
+        END AS sunshine_30,
+        CASE
+          WHEN s30_latest.timestamp > s60.timestamp THEN s30_latest.sunshine_30 + s60.sunshine_60 - s30_previous.sunshine_30
+          ELSE s60.sunshine_60
+        END AS sunshine_60
+      FROM (
+        SELECT timestamp, sunshine_30
+        FROM synop
+        WHERE source_id = latest.source_id AND sunshine_30 IS NOT NULL
+        ORDER BY timestamp DESC
+        LIMIT 1
+      ) s30_latest
+      JOIN synop s30_previous ON
+        s30_previous.source_id = latest.source_id AND
+        s30_previous.timestamp = s30_latest.timestamp - '1 hour'::interval
+      JOIN (
+        SELECT timestamp, sunshine_60
+        FROM synop
+        WHERE source_id = latest.source_id AND sunshine_60 IS NOT NULL
+        ORDER BY timestamp DESC
+        LIMIT 1
+      ) s60 ON
+        s60.timestamp > s30_previous.timestamp
+    ) sunshine ON true
+  ON CONFLICT ON CONSTRAINT current_weather_key DO UPDATE SET
+    timestamp = EXCLUDED.timestamp,
+    cloud_cover = EXCLUDED.cloud_cover,
+    condition = EXCLUDED.condition,
+    dew_point = EXCLUDED.dew_point,
+    solar_10 = EXCLUDED.solar_10,
+    solar_30 = EXCLUDED.solar_30,
+    solar_60 = EXCLUDED.solar_60,
+    precipitation_10 = EXCLUDED.precipitation_10,
+    precipitation_30 = EXCLUDED.precipitation_30,
+    precipitation_60 = EXCLUDED.precipitation_60,
+    pressure_msl = EXCLUDED.pressure_msl,
+    relative_humidity = EXCLUDED.relative_humidity,
+    visibility = EXCLUDED.visibility,
+    wind_direction_10 = EXCLUDED.wind_direction_10,
+    wind_direction_30 = EXCLUDED.wind_direction_30,
+    wind_direction_60 = EXCLUDED.wind_direction_60,
+    wind_speed_10 = EXCLUDED.wind_speed_10,
+    wind_speed_30 = EXCLUDED.wind_speed_30,
+    wind_speed_60 = EXCLUDED.wind_speed_60,
+    wind_gust_direction_10 = EXCLUDED.wind_gust_direction_10,
+    wind_gust_direction_30 = EXCLUDED.wind_gust_direction_30,
+    wind_gust_direction_60 = EXCLUDED.wind_gust_direction_60,
+    wind_gust_speed_10 = EXCLUDED.wind_gust_speed_10,
+    wind_gust_speed_30 = EXCLUDED.wind_gust_speed_30,
+    wind_gust_speed_60 = EXCLUDED.wind_gust_speed_60,
+    sunshine_30 = EXCLUDED.sunshine_30,
+    sunshine_60 = EXCLUDED.sunshine_60,
+    temperature = EXCLUDED.temperature;
+END;
+$$;
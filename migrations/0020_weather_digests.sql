@@ -0,0 +1,8 @@
+CREATE TABLE weather_digests (
+  source_id  int NOT NULL REFERENCES sources(id) ON DELETE CASCADE,
+  day        date NOT NULL,
+  fields     text NOT NULL,
+  digest     bytea NOT NULL,
+
+  CONSTRAINT weather_digests_key PRIMARY KEY (source_id, day, fields)
+);
@@ -0,0 +1,25 @@
+-- Partition the short-lived SYNOP and radar records by time, so that expired
+-- records can be dropped together with their partitions instead of being
+-- deleted row by row. Partitions are created ahead of time by
+-- `brightsky.partitions.PartitionManager`, records outside of all of them
+-- end up in the default partitions.
+CREATE TABLE synop_partitioned (
+  LIKE synop INCLUDING DEFAULTS INCLUDING CONSTRAINTS
+) PARTITION BY RANGE (timestamp);
+CREATE TABLE synop_default PARTITION OF synop_partitioned DEFAULT;
+INSERT INTO synop_partitioned SELECT * FROM synop;
+DROP TABLE synop;
+ALTER TABLE synop_partitioned RENAME TO synop;
+ALTER TABLE synop
+  ADD CONSTRAINT synop_key UNIQUE (source_id, timestamp),
+  ADD CONSTRAINT synop_source_id_fkey
+    FOREIGN KEY (source_id) REFERENCES sources(id) ON DELETE CASCADE;
+
+CREATE TABLE radar_partitioned (
+  LIKE radar INCLUDING DEFAULTS INCLUDING CONSTRAINTS
+) PARTITION BY RANGE (timestamp);
+CREATE TABLE radar_default PARTITION OF radar_partitioned DEFAULT;
+INSERT INTO radar_partitioned SELECT * FROM radar;
+DROP TABLE radar;
+ALTER TABLE radar_partitioned RENAME TO radar;
+ALTER TABLE radar ADD CONSTRAINT radar_key UNIQUE (timestamp);
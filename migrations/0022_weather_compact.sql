@@ -0,0 +1,58 @@
+-- Compact weather storage, used with `WEATHER_STORAGE = 'compact'`. Values
+-- with a natural fixed precision are stored as scaled integers (see
+-- `brightsky.storage.SCALED_FIELDS`), and columns are ordered by decreasing
+-- alignment so that rows need no padding.
+CREATE TABLE weather_compact (
+  timestamp                     timestamptz NOT NULL,
+  source_id                     int NOT NULL REFERENCES sources(id) ON DELETE CASCADE,
+  visibility                    int CHECK (visibility >= 0),
+  solar                         int CHECK (solar >= 0),
+  condition                     weather_condition,
+
+  -- 0.01 mm
+  precipitation                 smallint CHECK (precipitation >= 0),
+  -- 0.1 hPa
+  pressure_msl                  smallint CHECK (pressure_msl > 0),
+  sunshine                      smallint CHECK (sunshine BETWEEN 0 and 3600),
+  -- 0.1 °C
+  temperature                   smallint CHECK (temperature > -2732),
+  wind_direction                smallint CHECK (wind_direction BETWEEN 0 AND 360),
+  -- 0.1 m/s
+  wind_speed                    smallint CHECK (wind_speed >= 0),
+  cloud_cover                   smallint CHECK (cloud_cover BETWEEN 0 and 100),
+  -- 0.1 °C
+  dew_point                     smallint CHECK (dew_point > -2732),
+  relative_humidity             smallint CHECK (relative_humidity BETWEEN 0 and 100),
+  wind_gust_direction           smallint CHECK (wind_gust_direction BETWEEN 0 AND 360),
+  -- 0.1 m/s
+  wind_gust_speed               smallint CHECK (wind_gust_speed >= 0),
+  precipitation_probability     smallint CHECK (precipitation_probability BETWEEN 0 and 100),
+  precipitation_probability_6h  smallint CHECK (precipitation_probability_6h BETWEEN 0 and 100),
+
+  CONSTRAINT weather_compact_key UNIQUE (source_id, timestamp)
+);
+
+-- Compact records decoded to the units and types of the weather table, for
+-- reading. Values are cast back to real, so they are returned exactly like
+-- their counterparts in the weather table.
+CREATE VIEW weather_compact_decoded AS
+SELECT
+  timestamp,
+  source_id,
+  (precipitation / 100::float8)::real AS precipitation,
+  pressure_msl * 10 AS pressure_msl,
+  sunshine,
+  (temperature / 10::float8 + 273.15)::real AS temperature,
+  wind_direction,
+  (wind_speed / 10::float8)::real AS wind_speed,
+  cloud_cover,
+  (dew_point / 10::float8 + 273.15)::real AS dew_point,
+  relative_humidity,
+  visibility,
+  wind_gust_direction,
+  (wind_gust_speed / 10::float8)::real AS wind_gust_speed,
+  condition,
+  precipitation_probability,
+  precipitation_probability_6h,
+  solar
+FROM weather_compact;
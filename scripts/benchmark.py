@@ -1,25 +1,42 @@
 #!/usr/bin/env python
 
+import asyncio
 import datetime
 import logging
 import random
 import re
+import tempfile
 import time
+import tracemalloc
+import zipfile
 from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
-from contextlib import contextmanager
+from contextlib import contextmanager, suppress
 from functools import lru_cache
 from multiprocessing import cpu_count
+from pathlib import Path
 
+import asyncpg
 import click
+import numpy as np
 import psycopg2
 import requests
 from dateutil.tz import tzutc
 from falcon.testing import TestClient
-
-from brightsky import db, tasks
+from psycopg2.extras import DictCursor
+
+from brightsky import db, query, tasks
+from brightsky.export import DBExporter, RecordBatch, SYNOPExporter
+from brightsky.parsers import (
+    CurrentObservationsParser,
+    MOSMIXParser,
+    SolarRadiationObservationsParser,
+    WindObservationsParser,
+)
 from brightsky.settings import settings
+from brightsky.storage import weather_table
 from brightsky.utils import configure_logging
 from brightsky.web import app
+from brightsky.web.app import init_connection
 
 
 logger = logging.getLogger('benchmark')
@@ -98,15 +115,650 @@ def db_size():
             cur.execute(
                 'SELECT pg_database_size(%s)', (db_name,))
             db_size = cur.fetchone()
-            table_sizes = {}
-            for table in ['weather', 'synop', 'sources']:
-                cur.execute('SELECT pg_total_relation_size(%s)', (table,))
-                table_sizes[table] = cur.fetchone()[0]
+            table_sizes = {
+                table: _relation_sizes(cur, table)
+                for table in ['weather', 'weather_compact', 'synop', 'sources']
+            }
     click.echo('Total database size:\n%6d MB' % (db_size[0] / 1024 / 1024))
     click.echo(
-        'Table sizes:\n' + '\n'.join(
-            '%6d MB  %s' % (size / 1024 / 1024, table)
-            for table, size in table_sizes.items()))
+        'Table sizes (table + indexes):\n' + '\n'.join(
+            '%6d MB + %6d MB  %s' % (
+                table_size / 1024 / 1024, index_size / 1024 / 1024, table)
+            for table, (table_size, index_size) in table_sizes.items()))
+
+
+def _relation_sizes(cur, table):
+    cur.execute(
+        'SELECT pg_table_size(%s), pg_indexes_size(%s)', (table, table))
+    return cur.fetchone()
+
+
+def _make_benchmark_records(stations, hours, **fields):
+    start = datetime.datetime(2020, 1, 1, tzinfo=tzutc())
+    for station in range(stations):
+        source = {
+            'observation_type': 'forecast',
+            'lat': 47.3 + station / stations * 7.7,
+            'lon': 6 + station / stations * 9,
+            'height': station % 1000,
+            'dwd_station_id': None,
+            'wmo_station_id': f'B{station:04d}',
+            'station_name': f'Benchmark {station}',
+        }
+        for hour in range(hours):
+            yield {
+                **source,
+                'timestamp': start + datetime.timedelta(hours=hour),
+                'temperature': 270 + (station + hour) % 30,
+                'precipitation': (station * hour) % 7 / 10,
+                'pressure_msl': 100000 + (station + hour) % 2000,
+                'wind_speed': (station + hour) % 15 / 2,
+                'wind_direction': (station * 7 + hour) % 360,
+                'condition': 'rain' if hour % 3 else 'dry',
+                **fields,
+            }
+
+
+def _delete_benchmark_records():
+    with db.get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "DELETE FROM sources WHERE station_name LIKE 'Benchmark %'")
+        conn.commit()
+    DBExporter.clear_source_cache()
+
+
+@contextmanager
+def _count_statements():
+    counter = {'statements': 0}
+    execute, copy_expert = DictCursor.execute, DictCursor.copy_expert
+
+    def counting_execute(self, *args, **kwargs):
+        counter['statements'] += 1
+        return execute(self, *args, **kwargs)
+
+    def counting_copy_expert(self, *args, **kwargs):
+        counter['statements'] += 1
+        return copy_expert(self, *args, **kwargs)
+
+    DictCursor.execute = counting_execute
+    DictCursor.copy_expert = counting_copy_expert
+    try:
+        yield counter
+    finally:
+        DictCursor.execute = execute
+        DictCursor.copy_expert = copy_expert
+
+
+def _drop_fields(records):
+    # Give records varying field sets, like MOSMIX and current observations
+    # files do
+    optional_fields = ['precipitation', 'pressure_msl', 'wind_direction']
+    for i, record in enumerate(records):
+        for bit, field in enumerate(optional_fields):
+            if i & (1 << bit):
+                del record[field]
+        yield record
+
+
+def _time_export(description, records):
+    start = time.time()
+    with _count_statements() as counter:
+        DBExporter().export(records)
+    delta = time.time() - start
+    click.echo(
+        f'  {len(records)} {description + ":":14s}{delta:8.2f} s '
+        f'{len(records) / delta:10,.0f} rows/s '
+        f'{counter["statements"]:6d} statements')
+
+
+@cli.command(help='Compare export throughput of the export methods')
+@click.option('--stations', default=500, help='Number of sources')
+@click.option('--hours', default=240, help='Number of records per source')
+def export(stations, hours):
+    for method in ['insert', 'copy', 'merge']:
+        settings['EXPORT_METHOD'] = method
+        _delete_benchmark_records()
+        click.echo(f'{method}:')
+        for description, fields in [
+            ('new rows', {}),
+            ('updated rows', {'cloud_cover': 50}),
+        ]:
+            records = list(_make_benchmark_records(stations, hours, **fields))
+            _time_export(description, records)
+        records = list(_drop_fields(
+            _make_benchmark_records(stations, hours, cloud_cover=25)))
+        _time_export('mixed rows', records)
+    _delete_benchmark_records()
+
+
+@cli.command(help='Compare export methods on the recorded test files')
+@click.option('--repeat', default=100, help='Number of copies of each file')
+def export_files(repeat):
+    settings['MIN_DATE'] = datetime.datetime(1900, 1, 1, tzinfo=tzutc())
+    settings['MAX_DATE'] = None
+    data_dir = Path(__file__).parent.parent / 'tests' / 'data'
+    parsed = [
+        *WindObservationsParser().parse(
+            data_dir / 'observations_recent_FF_akt.zip'),
+        *CurrentObservationsParser().parse(
+            data_dir / 'observations_current.csv',
+            lat=50.0, lon=7.0, height=100.0, station_name='Benchmark'),
+        *SolarRadiationObservationsParser().parse(
+            data_dir / '10minutenwerte_SOLAR_01766_akt.zip',
+            meta_path=data_dir / 'Meta_Daten_zehn_min_sd_01766.zip'),
+    ]
+    # Spread copies of the files over different sources, interleaving them
+    # like a multi-product export would
+    records = [
+        {
+            **record,
+            'lat': record['lat'] + i / 1000,
+            'station_name': f'Benchmark {i}',
+        }
+        for i in range(repeat)
+        for record in parsed
+    ]
+    for method in ['insert', 'copy', 'merge']:
+        settings['EXPORT_METHOD'] = method
+        _delete_benchmark_records()
+        click.echo(f'{method}:')
+        for description in ['new rows', 'updated rows']:
+            _time_export(description, [dict(r) for r in records])
+    _delete_benchmark_records()
+
+
+def _make_record_batches(records):
+    fields = [
+        'temperature', 'precipitation', 'pressure_msl', 'wind_speed',
+        'wind_direction', 'condition']
+    by_source = {}
+    for r in records:
+        key = tuple(r[f] for f in DBExporter.SOURCE_FIELDS)
+        by_source.setdefault(key, []).append(r)
+    return [
+        RecordBatch(
+            {f: rs[0][f] for f in DBExporter.SOURCE_FIELDS},
+            [r['timestamp'].replace(tzinfo=None) for r in rs],
+            {
+                f: np.array(
+                    [r[f] for r in rs],
+                    dtype=object if f == 'condition' else float)
+                for f in fields
+            })
+        for rs in by_source.values()
+    ]
+
+
+@cli.command(help='Compare COPY export of record dicts and columnar batches')
+@click.option('--stations', default=500, help='Number of sources')
+@click.option('--hours', default=240, help='Number of records per source')
+def export_columns(stations, hours):
+    settings['EXPORT_METHOD'] = 'copy'
+    records = list(_make_benchmark_records(stations, hours))
+    for description, make_items in [
+        ('dicts', lambda: [dict(r) for r in records]),
+        ('columns', lambda: _make_record_batches(records)),
+    ]:
+        _delete_benchmark_records()
+        click.echo(f'{description}:')
+        for rows in ['new rows', 'updated rows']:
+            items = make_items()
+            start = time.time()
+            DBExporter().export(items)
+            delta = time.time() - start
+            click.echo(
+                f'  {len(records)} {rows + ":":14s}{delta:8.2f} s '
+                f'{len(records) / delta:10,.0f} rows/s')
+    _delete_benchmark_records()
+
+
+def _make_observations_archive(path, years):
+    data_dir = Path(__file__).parent.parent / 'tests' / 'data'
+    start = datetime.datetime(2024 - years, 1, 1)
+    hours = years * 365 * 24
+    with zipfile.ZipFile(data_dir / 'observations_recent_FF_akt.zip') as zf:
+        metadata = zf.read('Metadaten_Geographie_04911.txt')
+    lines = ['STATIONS_ID;MESS_DATUM;QN_3;   F;   D;eor']
+    for hour in range(hours):
+        timestamp = start + datetime.timedelta(hours=hour)
+        lines.append(
+            f'       4911;{timestamp:%Y%m%d%H};   10;'
+            f'{hour % 130 / 10:6.1f};{hour * 7 % 360:4d};eor')
+    end = start + datetime.timedelta(hours=hours - 1)
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('Metadaten_Geographie_04911.txt', metadata)
+        zf.writestr(
+            f'produkt_ff_stunde_{start:%Y%m%d}_{end:%Y%m%d}_04911.txt',
+            '\n'.join(lines) + '\n')
+    return hours
+
+
+@cli.command(help='Compare parsing a long archive with and without pushdown')
+@click.option('--years', default=60, help='Number of years in the archive')
+def parse_window(years):
+    settings['MIN_DATE'] = datetime.datetime(2020, 1, 1, tzinfo=tzutc())
+    settings['MAX_DATE'] = None
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir) / 'stundenwerte_FF_04911_hist.zip'
+        with _time(f'Creating archive with {years} years of data'):
+            rows = _make_observations_archive(path, years)
+        click.echo(f'  {rows} rows')
+        unfiltered = WindObservationsParser()
+        unfiltered.filter_lines = lambda lines: lines
+        for description, parser in [
+            ('without pushdown', unfiltered),
+            ('with pushdown', WindObservationsParser()),
+        ]:
+            start = time.time()
+            records = sum(1 for _ in parser.parse(path))
+            delta = time.time() - start
+            click.echo(
+                f'  {description + ":":18s}{delta:6.2f} s '
+                f'({records} records since {settings.MIN_DATE:%Y-%m-%d})')
+
+
+@cli.command(help='Compare row-wise and column-wise observation decoding')
+@click.option('--years', default=20, help='Number of years in the archive')
+def parse_columns(years):
+    settings['MIN_DATE'] = datetime.datetime(1900, 1, 1, tzinfo=tzutc())
+    settings['MAX_DATE'] = None
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir) / 'stundenwerte_FF_04911_hist.zip'
+        rows = _make_observations_archive(path, years)
+        for description, decode_columns in [
+                ('rows', False), ('columns', True)]:
+            parser = WindObservationsParser()
+            parser.DECODE_COLUMNS = decode_columns
+            start = time.time()
+            records = sum(1 for _ in parser.parse(path))
+            delta = time.time() - start
+            click.echo(
+                f'  {description + ":":9s}{delta:6.2f} s '
+                f'{rows / delta:10,.0f} rows/s ({records} records)')
+
+
+def _make_mosmix_kmz(path, stations, steps):
+    start = datetime.datetime(2020, 3, 29, 10)
+    parts = [
+        '<?xml version="1.0" encoding="ISO-8859-1" standalone="yes"?>',
+        '<kml:kml xmlns:dwd="https://opendata.dwd.de/weather/lib/'
+        'pointforecast_dwd_extension_V1_0.xsd" '
+        'xmlns:kml="http://www.opengis.net/kml/2.2">',
+        '<kml:Document><kml:ExtendedData><dwd:ProductDefinition>',
+        '<dwd:ProductID>MOSMIX</dwd:ProductID>',
+        '<dwd:IssueTime>2020-03-29T09:00:00.000Z</dwd:IssueTime>',
+        '<dwd:ForecastTimeSteps>',
+        *(
+            f'<dwd:TimeStep>'
+            f'{start + datetime.timedelta(hours=i):%Y-%m-%dT%H:%M:%S}.000Z'
+            f'</dwd:TimeStep>'
+            for i in range(steps)
+        ),
+        '</dwd:ForecastTimeSteps></dwd:ProductDefinition></kml:ExtendedData>',
+    ]
+    elements = list(MOSMIXParser.ELEMENTS) + [f'E_{i}' for i in range(25)]
+    for station in range(stations):
+        parts.append(
+            f'<kml:Placemark><kml:name>B{station:04d}</kml:name>'
+            f'<kml:description>Benchmark {station}</kml:description>'
+            f'<kml:ExtendedData>')
+        for element in elements:
+            values = ' '.join(
+                f'{(station + i) % 90 + 1:10.2f}' for i in range(steps))
+            parts.append(
+                f'<dwd:Forecast dwd:elementName="{element}">'
+                f'<dwd:value>{values}</dwd:value></dwd:Forecast>')
+        parts.append(
+            f'</kml:ExtendedData><kml:Point><kml:coordinates>'
+            f'{6 + station / stations * 9:.2f},'
+            f'{47.3 + station / stations * 7.7:.2f},{station % 1000}.0'
+            f'</kml:coordinates></kml:Point></kml:Placemark>')
+    parts.append('</kml:Document></kml:kml>')
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('MOSMIX_L_2020032909.kml', '\n'.join(parts))
+
+
+@cli.command(help='Compare MOSMIX parser memory with and without streaming')
+@click.option('--steps', default=48, help='Number of forecast time steps')
+def mosmix_memory(steps):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for stations in [500, 2000, 8000]:
+            path = Path(tmpdir) / f'MOSMIX_L_{stations}.kmz'
+            _make_mosmix_kmz(path, stations, steps)
+            click.echo(f'{stations} stations:')
+            for streaming in [False, True]:
+                settings['MOSMIX_STREAMING'] = streaming
+                tracemalloc.start()
+                start = time.time()
+                for _ in MOSMIXParser().parse(path):
+                    pass
+                delta = time.time() - start
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                description = 'streaming' if streaming else 'records'
+                click.echo(
+                    f'  {description + ":":11s}{delta:6.2f} s '
+                    f'{peak / 1024 / 1024:8.1f} MB peak')
+
+
+# Element fields of the hourly observation parameter files
+_PARAMETER_FIELDS = {
+    'TU': ['temperature', 'relative_humidity'],
+    'RR': ['precipitation', 'condition'],
+    'FF': ['wind_speed', 'wind_direction'],
+    'N': ['cloud_cover'],
+    'P0': ['pressure_msl'],
+    'SD': ['sunshine'],
+    'TD': ['dew_point'],
+    'VV': ['visibility'],
+}
+
+
+def _make_parameter_files(stations, hours):
+    source_fields = DBExporter.SOURCE_FIELDS + ['timestamp']
+    records = [
+        {
+            **r,
+            'observation_type': 'historical',
+            'relative_humidity': 80,
+            'cloud_cover': 50,
+            'sunshine': 30,
+            'dew_point': 280.0,
+            'visibility': 20000,
+        }
+        for r in _make_benchmark_records(stations, hours)
+    ]
+    return {
+        parameter: [
+            {f: r[f] for f in source_fields + fields}
+            for r in records
+        ]
+        for parameter, fields in _PARAMETER_FIELDS.items()
+    }
+
+
+def _measure_writes(description, export):
+    with db.get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT pg_current_wal_lsn(), pg_relation_size('weather')")
+            start_lsn, start_size = cur.fetchone()
+        conn.commit()
+        start = time.time()
+        export()
+        delta = time.time() - start
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT
+                    pg_wal_lsn_diff(pg_current_wal_lsn(), %s),
+                    pg_relation_size('weather') - %s
+                """,
+                (start_lsn, start_size))
+            wal_bytes, table_growth = cur.fetchone()
+        conn.commit()
+    click.echo(
+        f'{description + ":":10s}{delta:8.2f} s '
+        f'{wal_bytes / 1024 / 1024:8.1f} MB WAL '
+        f'{table_growth / 1024 / 1024:8.1f} MB table growth')
+
+
+@cli.command(help='Compare write volume of separate and merged backfills')
+@click.option('--stations', default=20, help='Number of stations')
+@click.option('--hours', default=24*365, help='Number of records per station')
+def merge_backfill(stations, hours):
+    files = _make_parameter_files(stations, hours)
+
+    def export_separately():
+        for records in files.values():
+            DBExporter().export([dict(r) for r in records])
+
+    def export_merged():
+        DBExporter().export(tasks.merge_records([
+            sorted(records, key=lambda r: r['timestamp'])
+            for records in files.values()
+        ]))
+
+    for description, export in [
+        ('separate', export_separately),
+        ('merged', export_merged),
+    ]:
+        _delete_benchmark_records()
+        # Make space of deleted rows reusable so that both runs start out
+        # equally
+        conn = psycopg2.connect(settings.DATABASE_URL)
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute('VACUUM weather')
+        conn.close()
+        _measure_writes(description, export)
+    _delete_benchmark_records()
+
+
+@cli.command(help='Compare current weather refresh cost by stations touched')
+@click.option('--stations', default=1000, help='Number of SYNOP stations')
+def current_weather(stations):
+    now = datetime.datetime.now(tzutc()).replace(
+        minute=0, second=0, microsecond=0)
+    records = [
+        {
+            'observation_type': 'synop',
+            'lat': 50 + station / 1000,
+            'lon': 7 + station / 1000,
+            'height': station % 1000,
+            'dwd_station_id': None,
+            'wmo_station_id': f'B{station:04d}',
+            'station_name': f'Benchmark {station}',
+            'timestamp': now - datetime.timedelta(minutes=10 * i),
+            'temperature': 270 + (station + i) % 30,
+            'precipitation_10': (station * i) % 7 / 10,
+            'wind_speed_10': (station + i) % 15 / 2,
+            'wind_direction_10': (station * 7 + i) % 360,
+            'sunshine_30': 600 if i % 3 == 0 else None,
+            'sunshine_60': 1200 if i % 6 == 0 else None,
+        }
+        for station in range(stations)
+        for i in range(6 * 30)
+    ]
+    _delete_benchmark_records()
+    SYNOPExporter().export(records)
+    with db.get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute('ANALYZE synop')
+            cur.execute(
+                """
+                SELECT array_agg(id ORDER BY id) FROM sources
+                WHERE station_name LIKE 'Benchmark %%'
+                """)
+            source_ids = cur.fetchone()[0]
+            touched = 1
+            # Recomputing all stations is what refreshing the materialized
+            # view used to do on every export
+            while touched < len(source_ids):
+                with _time(f'{touched:6d} stations', precision=3):
+                    cur.execute(
+                        'SELECT refresh_current_weather(%s)',
+                        (source_ids[:touched],))
+                conn.commit()
+                touched *= 10
+            with _time('   all stations', precision=3):
+                cur.execute('SELECT refresh_current_weather()')
+            conn.commit()
+    _delete_benchmark_records()
+
+
+async def _time_weather_queries(source_ids, days, queries, span=1):
+    conn = await asyncpg.connect(settings.DATABASE_URL)
+    await init_connection(conn)
+    random.seed(1)
+    start_date = datetime.datetime(2020, 1, 1, tzinfo=tzutc())
+    durations = []
+    try:
+        for _ in range(queries):
+            date = start_date + datetime.timedelta(
+                days=random.randrange(days - span))
+            start = time.perf_counter()
+            await query._weather(
+                conn, date, date + datetime.timedelta(days=span),
+                [random.choice(source_ids)])
+            durations.append(time.perf_counter() - start)
+    finally:
+        await conn.close()
+    return np.percentile(durations, [50, 95]) * 1000
+
+
+@cli.command(help='Compare table sizes and query latency of weather storages')
+@click.option('--stations', default=500, help='Number of sources')
+@click.option('--hours', default=24*60, help='Number of records per source')
+@click.option('--queries', default=500, help='Number of day queries')
+def compact_storage(stations, hours, queries):
+    settings['EXPORT_METHOD'] = 'copy'
+    _delete_benchmark_records()
+    records = list(_make_benchmark_records(
+        stations, hours, cloud_cover=50, dew_point=280.15, wind_gust_speed=4,
+        visibility=20000, sunshine=1800))
+    for record in records:
+        record['temperature'] += 0.15
+    for storage in ['default', 'compact']:
+        settings['WEATHER_STORAGE'] = storage
+        table = weather_table()
+        DBExporter().export([dict(r) for r in records])
+        conn = psycopg2.connect(settings.DATABASE_URL)
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute(f'VACUUM ANALYZE {table}')
+            table_size, index_size = _relation_sizes(cur, table)
+            cur.execute(f'SELECT avg(pg_column_size({table}.*)) FROM {table}')
+            row_size = cur.fetchone()[0]
+            cur.execute(
+                "SELECT id FROM sources WHERE station_name LIKE 'Benchmark %'")
+            source_ids = [row[0] for row in cur.fetchall()]
+        conn.close()
+        p50, p95 = asyncio.run(
+            _time_weather_queries(source_ids, hours // 24, queries))
+        click.echo(
+            f'{storage}: {table_size / 1024 / 1024:6.1f} MB table '
+            f'+ {index_size / 1024 / 1024:6.1f} MB indexes, '
+            f'{row_size:5.1f} B/row, day query p50 {p50:5.2f} ms '
+            f'p95 {p95:5.2f} ms')
+        with db.get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f'TRUNCATE {table}')
+            conn.commit()
+    _delete_benchmark_records()
+
+
+@contextmanager
+def _count_statement_preparations():
+    counter = {'prepared': 0, 'queries': 0}
+    get_statement = asyncpg.Connection._get_statement
+
+    async def counting_get_statement(self, query, *args, **kwargs):
+        key = (query, self._protocol.get_record_class(), False)
+        if self._stmt_cache.get(key, promote=False) is None:
+            counter['prepared'] += 1
+        return await get_statement(self, query, *args, **kwargs)
+
+    protocol_methods = {}
+    for name in ['fetch', 'fetchval']:
+        method = protocol_methods[name] = getattr(asyncpg.Connection, name)
+
+        def counting_method(self, *args, _method=method, **kwargs):
+            counter['queries'] += 1
+            return _method(self, *args, **kwargs)
+
+        setattr(asyncpg.Connection, name, counting_method)
+    asyncpg.Connection._get_statement = counting_get_statement
+    try:
+        yield counter
+    finally:
+        asyncpg.Connection._get_statement = get_statement
+        for name, method in protocol_methods.items():
+            setattr(asyncpg.Connection, name, method)
+
+
+async def _run_query_mix(requests_count, concurrency, hours):
+    from brightsky.web.app import ctx, lifespan
+    random.seed(1)
+    start_date = datetime.datetime(2020, 1, 1, tzinfo=tzutc())
+    durations = []
+    async with lifespan(app):
+        pools = ctx['pools']
+        stations = await pools.primary.fetch(
+            """
+            SELECT id, lat, lon, wmo_station_id FROM sources
+            WHERE station_name LIKE 'Benchmark %'
+            """)
+        slots = asyncio.Semaphore(concurrency)
+
+        async def run_request():
+            station = random.choice(stations)
+            days = random.choice([1, 2, 3, 7, 10])
+            date = start_date + datetime.timedelta(
+                days=random.randrange(hours // 24 - days))
+            last_date = date + datetime.timedelta(days=days)
+            kind = random.choice(['location', 'wmo', 'sources'])
+            if kind == 'location':
+                coro = query.weather(
+                    pools.reader(), date, last_date,
+                    lat=station['lat'] + 0.01, lon=station['lon'] - 0.01)
+            elif kind == 'wmo':
+                coro = query.weather(
+                    pools.reader(), date, last_date,
+                    wmo_station_ids=[station['wmo_station_id']])
+            else:
+                coro = query.sources(
+                    pools.reader(), source_ids=[station['id']])
+            async with slots:
+                start = time.perf_counter()
+                with suppress(query.NoData):
+                    await coro
+                durations.append(time.perf_counter() - start)
+
+        with _count_statement_preparations() as counter:
+            await asyncio.gather(
+                *(run_request() for _ in range(requests_count)))
+    return counter, np.percentile(durations, [50, 95]) * 1000
+
+
+@cli.command(help='Count statement preparations of a mix of web queries')
+@click.option('--stations', default=200, help='Number of locations')
+@click.option('--hours', default=24*30, help='Number of records per source')
+@click.option('--requests', 'requests_count', default=2000)
+@click.option('--concurrency', default=8)
+def query_statements(stations, hours, requests_count, concurrency):
+    settings['EXPORT_METHOD'] = 'copy'
+    settings['DATABASE_CONNECTION_POOL_SIZE'] = concurrency
+    _delete_benchmark_records()
+    optional_fields = [
+        'cloud_cover', 'dew_point', 'relative_humidity', 'sunshine',
+        'visibility', 'wind_gust_direction', 'wind_gust_speed',
+    ]
+    # Observations miss a different set of fields at every station, so that
+    # queries have to fill in different fields from the forecasts
+    records = []
+    for observation_type in ['historical', 'forecast']:
+        for record in _make_benchmark_records(
+                stations, hours, observation_type=observation_type,
+                cloud_cover=50, dew_point=280.15, relative_humidity=80,
+                sunshine=1800, visibility=20000, wind_gust_direction=180,
+                wind_gust_speed=4):
+            station = int(record['wmo_station_id'][1:])
+            if observation_type == 'historical':
+                for i, field in enumerate(optional_fields):
+                    if station >> i & 1:
+                        del record[field]
+            records.append(record)
+    DBExporter().export(records)
+    counter, (p50, p95) = asyncio.run(
+        _run_query_mix(requests_count, concurrency, hours))
+    click.echo(
+        f"{counter['queries']} queries, {counter['prepared']} statements "
+        f"prepared, cache hit rate "
+        f"{1 - counter['prepared'] / counter['queries']:.1%}, "
+        f"request p50 {p50:.2f} ms p95 {p95:.2f} ms")
+    _delete_benchmark_records()
 
 
 @cli.command(help='Re-parse MOSMIX data')
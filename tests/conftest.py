@@ -11,6 +11,8 @@ from fastapi.testclient import TestClient
 from psycopg2.extras import execute_values
 
 from brightsky.db import get_connection, migrate
+from brightsky.export import DBExporter
+from brightsky.parsers import CurrentObservationsParser
 
 
 @pytest.fixture(scope='session')
@@ -81,12 +83,15 @@ def db(_database):
         yield TestConnection(conn)
         with conn.cursor() as cur:
             cur.execute("""
+                DELETE FROM alerts;
                 DELETE FROM parsed_files;
                 DELETE FROM synop;
                 DELETE FROM weather;
+                DELETE FROM current_weather;
                 DELETE FROM sources;
-                REFRESH MATERIALIZED VIEW current_weather;
             """)
+        DBExporter.clear_source_cache()
+        CurrentObservationsParser.clear_location_cache()
 
 
 @pytest.fixture
@@ -1,9 +1,26 @@
 import datetime
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dateutil.tz import tzutc
 
+import numpy as np
+import psycopg2
 import pytest
 
-from brightsky.export import DBExporter, SYNOPExporter
+from brightsky.export import (
+    AlertExporter,
+    BinaryCopyWriter,
+    DBExporter,
+    ForecastExporter,
+    RecordBatch,
+    SYNOPExporter,
+    pipelined_batches,
+)
+from brightsky.parsers import CAPParser
+
+from .utils import settings
 
 
 SOURCES = [
@@ -103,6 +120,33 @@ def test_db_exporter_reuses_existing_sources(db, exporter):
     assert db_sources[2]['id'] == db_sources[0]['id'] + 2
 
 
+def test_db_exporter_caches_known_sources(db, exporter, monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError('Known source was registered again')
+    monkeypatch.setattr(DBExporter, 'register_sources', fail)
+    exporter = DBExporter()
+    exporter.BATCH_SIZE = 1
+    exporter.export([
+        {**SOURCES[0], **RECORDS[2]},
+        {**SOURCES[1], **RECORDS[0]},
+    ])
+    db_sources = _query_sources(db)
+    assert len(db_sources) == 2
+    assert db_sources[0]['last_record'] == RECORDS[2]['timestamp']
+    assert db_sources[1]['first_record'] == RECORDS[0]['timestamp']
+    assert db_sources[1]['last_record'] == RECORDS[1]['timestamp']
+
+
+def test_db_exporter_clears_stale_source_cache(db, exporter):
+    with db.cursor() as cur:
+        cur.execute('DELETE FROM sources')
+    db.commit()
+    with pytest.raises(psycopg2.errors.ForeignKeyViolation):
+        exporter.export([{**SOURCES[0], **RECORDS[2]}])
+    exporter.export([{**SOURCES[0], **RECORDS[2]}])
+    assert len(_query_sources(db)) == 1
+
+
 def test_db_exporter_creates_new_records(db, exporter):
     db_records = _query_records(db)
     for record, source, row in zip(RECORDS[:2], SOURCES[:2], db_records):
@@ -122,6 +166,218 @@ def test_db_exporter_updates_existing_records(db, exporter):
         assert db_records[0][k] == v
 
 
+@pytest.mark.parametrize('method', ['copy', 'merge'])
+def test_db_exporter_staging_methods(db, exporter, method):
+    record = RECORDS[0].copy()
+    record['precipitation'] = None
+    record['cloud_cover'] = 50
+    del record['temperature']
+    with settings(EXPORT_METHOD=method):
+        exporter.export([
+            {**SOURCES[0], **record},
+            {**SOURCES[0], **RECORDS[2]},
+        ])
+    db_records = _query_records(db)
+    assert len(db_records) == 3
+    # Only fields present in the record are overwritten
+    assert db_records[0]['temperature'] == RECORDS[0]['temperature']
+    assert db_records[0]['precipitation'] is None
+    assert db_records[0]['cloud_cover'] == 50
+    for k, v in RECORDS[2].items():
+        assert db_records[1][k] == v
+
+
+def test_binary_copy_writer_columns():
+    column_types = [
+        'timestamp with time zone', 'integer', 'smallint', 'real', 'text']
+    rows = [
+        [RECORDS[0]['timestamp'], 1, 2.5, 0.25, 'rain'],
+        [RECORDS[1]['timestamp'], None, -2.5, None, None],
+        [RECORDS[2]['timestamp'], 3, None, 1.5, 'dry'],
+    ]
+    expected = BinaryCopyWriter(column_types)
+    for row in rows:
+        expected.write_row(row)
+    columns = []
+    for values in zip(*rows):
+        valid = np.array([v is not None for v in values])
+        values = np.array(values, dtype=object)
+        if not isinstance(values[0], str) and values[0] is not None:
+            if isinstance(values[0], datetime.datetime):
+                values = np.array(
+                    [v.replace(tzinfo=None) for v in values],
+                    dtype='datetime64[us]')
+            else:
+                values = np.where(valid, values, 0).astype(float)
+        columns.append((values, valid))
+    writer = BinaryCopyWriter(column_types)
+    writer.write_columns(column_types, columns)
+    assert writer.getbuffer().read() == expected.getbuffer().read()
+
+
+@pytest.mark.parametrize('method', ['insert', 'copy', 'merge'])
+def test_db_exporter_record_batches(db, exporter, method):
+    batch = RecordBatch(
+        SOURCES[0],
+        [
+            np.datetime64(r['timestamp'].replace(tzinfo=None))
+            for r in [RECORDS[2], RECORDS[0]]
+        ],
+        {
+            'precipitation': [RECORDS[2]['precipitation'], np.nan],
+            # Object arrays (with Python ints) as yielded by MOSMIXParser
+            'cloud_cover': np.array([25, 50], dtype=object),
+        })
+    with settings(EXPORT_METHOD=method):
+        exporter.export([batch, {**SOURCES[2], **RECORDS[1]}])
+    db_records = _query_records(db)
+    assert len(db_records) == 4
+    # Only fields present in the batch are overwritten
+    assert db_records[0]['temperature'] == RECORDS[0]['temperature']
+    assert db_records[0]['precipitation'] is None
+    assert db_records[0]['cloud_cover'] == 50
+    assert db_records[1]['temperature'] is None
+    assert db_records[1]['precipitation'] == RECORDS[2]['precipitation']
+    assert db_records[1]['cloud_cover'] == 25
+    assert db_records[3]['station_name'] == SOURCES[2]['station_name']
+    assert _query_sources(db)[0]['last_record'] == RECORDS[2]['timestamp']
+
+
+@pytest.mark.parametrize('method', ['insert', 'copy', 'merge'])
+def test_db_exporter_compact_storage(db, method):
+    values = {
+        'temperature': 291.25,
+        'dew_point': 280.05,
+        'pressure_msl': 101320,
+        'precipitation': 0.3,
+        'wind_speed': 2.1,
+        'cloud_cover': 75,
+    }
+    batch = RecordBatch(
+        SOURCES[1],
+        [np.datetime64(RECORDS[1]['timestamp'].replace(tzinfo=None))],
+        {
+            'temperature': np.array([None], dtype=object),
+            'wind_speed': np.array([4.6]),
+        })
+    with settings(EXPORT_METHOD=method, WEATHER_STORAGE='compact'):
+        DBExporter().export([{**SOURCES[0], **RECORDS[0], **values}, batch])
+    assert not db.table('weather')
+    rows = {
+        row['wmo_station_id']: row
+        for row in _query_records(db, table='weather_compact')
+    }
+    assert len(rows) == 2
+    row = rows[SOURCES[0]['wmo_station_id']]
+    assert {f: row[f] for f in values} == {
+        'temperature': 181,
+        'dew_point': 69,
+        'pressure_msl': 10132,
+        'precipitation': 30,
+        'wind_speed': 21,
+        'cloud_cover': 75,
+    }
+    row = rows[SOURCES[1]['wmo_station_id']]
+    assert row['temperature'] is None
+    assert row['wind_speed'] == 46
+    decoded = {
+        row['wmo_station_id']: row
+        for row in _query_records(db, table='weather_compact_decoded')
+    }
+    row = decoded[SOURCES[0]['wmo_station_id']]
+    assert {f: row[f] for f in values} == values
+    assert decoded[SOURCES[1]['wmo_station_id']]['wind_speed'] == 4.6
+
+
+def test_forecast_exporter_generations(db, caplog):
+    source = {**SOURCES[0], 'observation_type': 'forecast'}
+    now = datetime.datetime.now(tzutc()).replace(
+        minute=0, second=0, microsecond=0)
+    timestamps = [now + datetime.timedelta(hours=h) for h in range(3)]
+    exporter = ForecastExporter()
+    # Records exported before generations were enabled are carried over,
+    # unless they expired
+    exporter.export([
+        {
+            **source, 'timestamp': timestamps[0], 'temperature': 280.,
+            'wind_speed': 5.,
+        },
+        {
+            **source, 'timestamp': now - datetime.timedelta(hours=6),
+            'temperature': 270.,
+        },
+    ])
+    # Other tables that happen to share the prefix are no generations
+    with db.cursor() as cur:
+        cur.execute('CREATE TABLE weather_forecast_old () INHERITS (weather)')
+    db.commit()
+    with settings(FORECAST_GENERATIONS=True):
+        with caplog.at_level('INFO', logger='brightsky.export'):
+            exporter.export([
+                {
+                    **source, 'timestamp': t, 'temperature': 290.,
+                    'wind_speed': 3.,
+                }
+                for t in timestamps[:2]
+            ])
+        assert (
+            'Published forecast generation weather_forecast_1 with 2 records'
+            in caplog.messages)
+        assert exporter.find_generations(db) == ['weather_forecast_1']
+        assert _query_sources(db)[0]['first_record'] == timestamps[0]
+        # A run covering only some fields keeps the others of the previous
+        # generation
+        exporter.export([
+            {**source, 'timestamp': t, 'temperature': 300.}
+            for t in timestamps[1:]
+        ])
+        assert exporter.find_generations(db) == ['weather_forecast_2']
+    db_records = _query_records(db)
+    assert [r['timestamp'] for r in db_records] == timestamps
+    assert [r['temperature'] for r in db_records] == [290., 300., 300.]
+    assert [r['wind_speed'] for r in db_records] == [3., 3., None]
+    assert not db.fetch('SELECT * FROM ONLY weather')
+    assert _query_sources(db)[0]['last_record'] == timestamps[2]
+    # Disabling generations folds the records back into the weather table
+    exporter.export([{
+        **source, 'timestamp': timestamps[2], 'wind_speed': 4.,
+    }])
+    assert exporter.find_generations(db) == []
+    db_records = _query_records(db)
+    assert [r['temperature'] for r in db_records] == [290., 300., 300.]
+    assert [r['wind_speed'] for r in db_records] == [3., 3., 4.]
+    with db.cursor() as cur:
+        cur.execute('DROP TABLE weather_forecast_old')
+    db.commit()
+
+
+def test_pipelined_batches():
+    assert list(pipelined_batches(range(7), 3, 1)) == [
+        (0, 1, 2), (3, 4, 5), (6,)]
+
+    def failing():
+        yield 1
+        raise ValueError('Parser error')
+
+    batches = pipelined_batches(failing(), 1, 1)
+    assert next(batches) == (1,)
+    with pytest.raises(ValueError, match='Parser error'):
+        next(batches)
+    # Closing stops the producer even if it is blocked on the full queue
+    batches = pipelined_batches(range(100), 1, 1)
+    assert next(batches) == (0,)
+    batches.close()
+
+
+def test_db_exporter_pipelined(db):
+    records = [{**SOURCES[i], **RECORDS[i]} for i in range(3)]
+    exporter = DBExporter()
+    exporter.BATCH_SIZE = 1
+    with settings(EXPORT_PIPELINE_DEPTH=2):
+        exporter.export(records)
+    assert len(_query_records(db)) == 3
+
+
 def test_db_exporter_updates_parsed_files(db, exporter):
     parsed_files = db.fetch("SELECT * FROM parsed_files")
     assert len(parsed_files) == 1
@@ -139,6 +395,150 @@ def test_db_exporter_updates_source_first_last_record(db, exporter):
     assert db_sources[0]['last_record'] == RECORDS[2]['timestamp']
 
 
+@pytest.mark.parametrize('exporter_cls', [DBExporter, SYNOPExporter])
+def test_concurrent_exporters(db, exporter_cls):
+    now = datetime.datetime.now(datetime.UTC).replace(
+        minute=0, second=0, microsecond=0, tzinfo=tzutc())
+    sources = [
+        {
+            **SOURCES[0],
+            'lat': 10 + i,
+            'wmo_station_id': f'2{i:04d}',
+            'station_name': f'Station {i}',
+        }
+        for i in range(20)
+    ]
+
+    def export(seed):
+        # Use a separate source cache per exporter to mimic separate worker
+        # processes. SYNOP exports lock all their stations up front, and can
+        # write them in several batches per transaction.
+        exporter = type('Exporter', (exporter_cls,), {
+            '_source_ids': {},
+            'BATCH_SIZE': 7 if exporter_cls is SYNOPExporter else 10000,
+        })()
+        rnd = random.Random(seed)
+        records = [
+            {
+                **source,
+                'timestamp': now - datetime.timedelta(minutes=30 * hours),
+                'temperature': 280 + seed,
+            }
+            for source in rnd.sample(sources, 15)
+            for hours in range(4)
+        ]
+        rnd.shuffle(records)
+        exporter.export(records)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(export, range(32)))
+    assert len(_query_sources(db)) == len(sources)
+    db_records = _query_records(
+        db, table='synop' if exporter_cls is SYNOPExporter else 'weather')
+    assert len(db_records) == 4 * len(sources)
+
+
+def test_db_exporter_registers_sources_separately(db):
+    exporter = DBExporter()
+    exporter.BATCH_SIZE = 1
+    records = [
+        {**SOURCES[0], **RECORDS[0]},
+        {**SOURCES[1], **RECORDS[1]},
+        {**SOURCES[1], **RECORDS[2], 'temperature': 'hot'},
+    ]
+    with pytest.raises(psycopg2.DataError):
+        exporter.export(records)
+    # New sources are kept, but nothing of the failed export was committed
+    assert len(_query_sources(db)) == 2
+    assert len(_query_records(db)) == 0
+
+
+def test_synop_exporter_locks_shards_before_writing(db, monkeypatch):
+    calls = []
+    lock_shards = SYNOPExporter.lock_shards
+    update_weather = SYNOPExporter.update_weather
+    monkeypatch.setattr(
+        SYNOPExporter, 'lock_shards',
+        lambda self, conn, keys: (
+            calls.append(('lock', sorted(keys))) or
+            lock_shards(self, conn, keys)))
+    monkeypatch.setattr(
+        SYNOPExporter, 'update_weather',
+        lambda self, conn, records: (
+            calls.append(('write', len(records))) or
+            update_weather(self, conn, records)))
+    now = datetime.datetime.now(datetime.UTC).replace(
+        minute=0, second=0, microsecond=0, tzinfo=tzutc())
+    exporter = SYNOPExporter()
+    exporter.BATCH_SIZE = 1
+    exporter.export_many([
+        ([{**SOURCES[i], **RECORDS[0], 'timestamp': now}], None)
+        for i in range(3)
+    ])
+    source_ids = [s['id'] for s in _query_sources(db)]
+    assert calls == [
+        ('lock', source_ids),
+        ('write', 1),
+        ('write', 1),
+        ('write', 1),
+    ]
+
+
+def test_db_exporter_skips_unchanged_records(db, monkeypatch):
+    records = [
+        {**SOURCES[0], **RECORDS[0]},
+        {**SOURCES[0], **RECORDS[1]},
+        {
+            **SOURCES[0],
+            **RECORDS[2],
+            'timestamp': RECORDS[2]['timestamp'] + datetime.timedelta(days=1),
+        },
+    ]
+    written = []
+    update_weather = DBExporter.update_weather
+    monkeypatch.setattr(
+        DBExporter, 'update_weather',
+        lambda self, conn, records: (
+            written.append(len(records)) or
+            update_weather(self, conn, records)))
+    with settings(EXPORT_SKIP_UNCHANGED=True):
+        DBExporter().export([dict(r) for r in records])
+        DBExporter().export([dict(r) for r in records])
+        assert written == [3]
+        # Changing one record re-writes all records of that day
+        DBExporter().export([
+            {**records[0], 'temperature': 280.0},
+            *(dict(r) for r in records[1:]),
+        ])
+        assert written == [3, 2]
+        # Different field sets are tracked separately
+        DBExporter().export([{
+            **SOURCES[0],
+            'timestamp': RECORDS[0]['timestamp'],
+            'cloud_cover': 10,
+        }])
+        assert written == [3, 2, 1]
+    db_records = _query_records(db)
+    assert len(db_records) == 3
+    assert db_records[0]['temperature'] == 280
+    assert db_records[0]['cloud_cover'] == 10
+    # Station-days are not split across batches
+    monkeypatch.setattr(DBExporter, 'BATCH_SIZE', 1)
+    records = [
+        {**SOURCES[0], **r, 'temperature': 290.0} for r in RECORDS[:3]]
+    with settings(EXPORT_SKIP_UNCHANGED=True):
+        DBExporter().export([dict(r) for r in records])
+        DBExporter().export([dict(r) for r in records])
+    assert written == [3, 2, 1, 3]
+    # Writing with skipping disabled drops the digests of the written days
+    with settings(EXPORT_SKIP_UNCHANGED=False):
+        DBExporter().export([{**records[0], 'temperature': 300.0}])
+    with settings(EXPORT_SKIP_UNCHANGED=True):
+        DBExporter().export([dict(r) for r in records])
+    assert written == [3, 2, 1, 3, 1, 3]
+    assert _query_records(db)[0]['temperature'] == 290
+
+
 def test_synop_exporter(db):
     exporter = SYNOPExporter()
     assert len(_query_records(db, table='current_weather')) == 0
@@ -169,3 +569,168 @@ def test_synop_exporter(db):
     #      finished yet. Can we somehow wait until the lock is released?
     current_weather_records = _query_records(db, table='current_weather')
     assert len(current_weather_records) == 1
+
+
+def test_synop_exporter_refreshes_touched_stations_only(db):
+    exporter = SYNOPExporter()
+    now = datetime.datetime.now(datetime.UTC).replace(
+        minute=0, second=0, microsecond=0, tzinfo=tzutc())
+    exporter.export([
+        {**SOURCES[0], **RECORDS[0], 'timestamp': now},
+        {**SOURCES[1], **RECORDS[0], 'timestamp': now},
+    ])
+    # Sneak in a record without going through the exporter
+    with db.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE synop SET temperature = 300
+            WHERE source_id = (SELECT MAX(id) FROM sources)
+            """)
+    db.commit()
+    exporter.export([
+        {**SOURCES[0], **RECORDS[0], 'timestamp': now, 'temperature': 280},
+    ])
+    current_weather = _query_records(db, table='current_weather')
+    assert [r['temperature'] for r in current_weather] == [
+        280, RECORDS[0]['temperature']]
+    # Stations without recent records are removed
+    exporter.export([
+        {
+            **SOURCES[2],
+            **RECORDS[0],
+            'timestamp': now - datetime.timedelta(hours=2),
+        },
+    ])
+    assert len(_query_records(db, table='current_weather')) == 2
+    with db.cursor() as cur:
+        cur.execute("DELETE FROM synop WHERE source_id = %s", (
+            current_weather[0]['source_id'],))
+        cur.execute("SELECT refresh_current_weather()")
+    db.commit()
+    current_weather = _query_records(db, table='current_weather')
+    assert [r['temperature'] for r in current_weather] == [300]
+
+
+def test_synop_exporter_coalesces_exports(db, monkeypatch):
+    now = datetime.datetime.now(datetime.UTC).replace(
+        minute=0, second=0, microsecond=0, tzinfo=tzutc())
+    exports = []
+    export_many = SYNOPExporter.export_many
+    monkeypatch.setattr(
+        SYNOPExporter, 'export_many',
+        lambda self, e: exports.append(e) or export_many(self, e))
+    parsing = threading.Barrier(3)
+
+    def parse(i, **overrides):
+        # Make sure all exports are parsing at the same time
+        parsing.wait()
+        yield {**SOURCES[i], **RECORDS[0], 'timestamp': now, **overrides}
+
+    def export(i, **overrides):
+        SYNOPExporter().export(
+            parse(i, **overrides),
+            fingerprint={**FINGERPRINT, 'url': f'{FINGERPRINT["url"]}{i}'})
+
+    with settings(SYNOP_COALESCE_DELAY=10):
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            start = time.monotonic()
+            list(executor.map(export, range(3)))
+            # No waiting once all exports arrived
+            assert time.monotonic() - start < 5
+    assert len(exports) == 1
+    assert len(exports[0]) == 3
+    assert len(_query_records(db, table='synop')) == 3
+    assert len(_query_records(db, table='current_weather')) == 3
+    assert len(db.table('parsed_files')) == 3
+
+    # Without concurrent exports, export right away
+    parsing = threading.Barrier(1)
+    with settings(SYNOP_COALESCE_DELAY=10):
+        start = time.monotonic()
+        export(0)
+        assert time.monotonic() - start < 5
+
+    # Only the export whose file caused an error fails
+    exports.clear()
+    parsing = threading.Barrier(3)
+    later = now + datetime.timedelta(hours=1)
+    with settings(SYNOP_COALESCE_DELAY=10):
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            futures = [
+                executor.submit(export, 0, timestamp=later),
+                executor.submit(
+                    export, 1, timestamp=later, temperature='hot'),
+                executor.submit(export, 2, timestamp=later),
+            ]
+    assert futures[0].exception() is None
+    assert futures[1].exception() is not None
+    assert futures[2].exception() is None
+    assert len(exports) == 4
+    assert len(_query_records(db, table='synop')) == 5
+
+    # An interrupted leader fails all exports
+    def interrupt(self, e):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(SYNOPExporter, 'export_many', interrupt)
+    parsing = threading.Barrier(3)
+    with settings(SYNOP_COALESCE_DELAY=10):
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            futures = [executor.submit(export, i) for i in range(3)]
+    for future in futures:
+        assert isinstance(future.exception(), KeyboardInterrupt)
+
+
+@pytest.mark.parametrize('method', ['copy', 'merge'])
+def test_synop_exporter_staging_methods(db, method):
+    exporter = SYNOPExporter()
+    now = datetime.datetime.now(datetime.UTC).replace(
+        minute=0, second=0, microsecond=0, tzinfo=tzutc())
+    record = {**SOURCES[0], **RECORDS[0], 'timestamp': now}
+    with settings(EXPORT_METHOD=method):
+        exporter.export([record])
+        exporter.export([
+            {**record, 'temperature': None, 'pressure_msl': 101010},
+        ])
+    synop_records = _query_records(db, table='synop')
+    assert len(synop_records) == 1
+    assert synop_records[0]['temperature'] == RECORDS[0]['temperature']
+    assert synop_records[0]['pressure_msl'] == 101010
+    assert len(_query_records(db, table='current_weather')) == 1
+
+
+def test_alert_exporter_only_writes_changes(db, data_dir, monkeypatch):
+    fn = 'Z_CAP_C_EDZW_LATEST_PVW_STATUS_PREMIUMDWD_COMMUNEUNION_MUL.zip'
+    alerts = list(CAPParser().parse(data_dir / fn))
+    exporter = AlertExporter()
+    exporter.export([dict(a) for a in alerts])
+    db_alerts = {a['alert_id']: a for a in db.table('alerts')}
+    db_cells = db.table('alert_cells')
+    assert len(db_alerts) == len(alerts)
+    # Re-exporting the same alerts does not write anything
+    updated_alerts = []
+    monkeypatch.setattr(
+        AlertExporter, 'update_alerts',
+        lambda self, conn, alerts: updated_alerts.extend(alerts))
+    exporter.export([dict(a) for a in alerts])
+    assert updated_alerts == []
+    assert db.table('alert_cells') == db_cells
+    # Changed alerts and cells are written, removed ones deleted
+    monkeypatch.undo()
+    changed = {**alerts[0], 'headline_en': 'Changed'}
+    changed['warn_cell_ids'] = changed['warn_cell_ids'][1:]
+    exporter.export([changed, *(dict(a) for a in alerts[2:])])
+    db_alerts_after = {a['alert_id']: a for a in db.table('alerts')}
+    assert len(db_alerts_after) == len(alerts) - 1
+    assert alerts[1]['id'] not in db_alerts_after
+    assert db_alerts_after[alerts[0]['id']]['headline_en'] == 'Changed'
+    assert db_alerts_after[alerts[0]['id']]['id'] == (
+        db_alerts[alerts[0]['id']]['id'])
+    db_cells_after = db.fetch(
+        "SELECT alert_id, warn_cell_id FROM alert_cells")
+    assert len(db_cells_after) == len(db_cells) - len(
+        alerts[1]['warn_cell_ids']) - 1
+    assert (
+        db_alerts[alerts[0]['id']]['id'],
+        alerts[0]['warn_cell_ids'][0],
+    ) not in {tuple(c) for c in db_cells_after}
@@ -1,10 +1,15 @@
 import datetime
+import zipfile
+
 
 import numpy as np
+import pytest
 from dateutil.tz import tzutc
 from freezegun import freeze_time
 from isal import isal_zlib as zlib
 
+from brightsky import parsers
+from brightsky.export import DBExporter, iter_records, RecordBatch
 from brightsky.parsers import (
     CloudCoverObservationsParser,
     CurrentObservationsParser,
@@ -42,6 +47,44 @@ def test_current_observation_parser_loads_station_data_from_db(db, data_dir):
         assert record[field] == source[field]
 
 
+def test_current_observation_parser_caches_station_locations(
+        db, data_dir, monkeypatch):
+    source = {
+        'observation_type': 'forecast',
+        'lat': 52.12,
+        'lon': 7.62,
+        'height': 5.,
+        'wmo_station_id': '01049',
+        'station_name': 'Münster',
+    }
+    db.insert('sources', [source])
+    queries = []
+
+    def fetch(*args, **kwargs):
+        queries.append(args)
+        return db_fetch(*args, **kwargs)
+    db_fetch = parsers.fetch
+    monkeypatch.setattr(parsers, 'fetch', fetch)
+    path = data_dir / 'observations_current.csv'
+    for _ in range(3):
+        record = next(CurrentObservationsParser().parse(path))
+        assert record['station_name'] == 'Münster'
+    assert len(queries) == 1
+    # Sources registered by this worker trigger a reload
+    DBExporter().export([{
+        **source, 'lat': 52.13, 'station_name': 'Münster-Osnabrück',
+        'dwd_station_id': None,
+        'timestamp': datetime.datetime(2020, 1, 1, tzinfo=tzutc()),
+        'temperature': 280.,
+    }])
+    record = next(CurrentObservationsParser().parse(path))
+    assert record['station_name'] == 'Münster-Osnabrück'
+    assert len(queries) == 2
+    with settings(STATION_LOCATIONS_MAX_AGE=-1):
+        next(CurrentObservationsParser().parse(path))
+    assert len(queries) == 3
+
+
 def test_observations_parser_skips_file_if_out_of_range(data_dir):
     p = PressureObservationsParser()
     path = data_dir / 'observations_19950901_20150817_hist.zip'
@@ -75,6 +118,167 @@ def test_observations_parser_skips_rows_if_before_cutoff(data_dir):
             2018, 9, 15, 4, tzinfo=tzutc())
 
 
+def test_observations_parser_filters_lines_before_parsing(
+        data_dir, monkeypatch):
+    p = WindObservationsParser()
+    path = data_dir / 'observations_recent_FF_akt.zip'
+    parsed_rows = []
+    filter_lines = p.filter_lines
+
+    def counting_filter_lines(lines):
+        for i, line in enumerate(filter_lines(lines)):
+            if i:
+                parsed_rows.append(line)
+            yield line
+
+    monkeypatch.setattr(p, 'filter_lines', counting_filter_lines)
+    with settings(
+        MIN_DATE=datetime.datetime(2019, 1, 1, tzinfo=tzutc()),
+    ):
+        assert len(list(p.parse(path))) == 5
+    assert len(parsed_rows) == 5
+    # Rows within a day of the window are still passed on
+    parsed_rows.clear()
+    with settings(
+        MIN_DATE=datetime.datetime(2018, 9, 16, tzinfo=tzutc()),
+        MAX_DATE=datetime.datetime(2019, 4, 19, tzinfo=tzutc()),
+    ):
+        assert list(p.parse(path)) == []
+    assert len(parsed_rows) == 6
+
+
+def _parse_rows_and_columns(parser_cls, path):
+    p = parser_cls()
+    assert p.DECODE_COLUMNS
+    columns = list(p.parse(path))
+    p.DECODE_COLUMNS = False
+    return list(p.parse(path)), columns
+
+
+@pytest.mark.parametrize('min_date, max_date', [
+    (datetime.datetime(1900, 1, 1, tzinfo=tzutc()), None),
+    (datetime.datetime(2019, 1, 1, tzinfo=tzutc()), None),
+    (
+        datetime.datetime(2018, 9, 15, 2, tzinfo=tzutc()),
+        datetime.datetime(2020, 3, 17, 21, tzinfo=tzutc()),
+    ),
+])
+def test_observations_parser_decode_columns(data_dir, min_date, max_date):
+    path = data_dir / 'observations_recent_FF_akt.zip'
+    with settings(MIN_DATE=min_date, MAX_DATE=max_date):
+        rows, columns = _parse_rows_and_columns(WindObservationsParser, path)
+    assert rows
+    assert columns == rows
+
+
+@pytest.mark.parametrize('parser_cls, values', [
+    (CloudCoverObservationsParser, {' V_N': ['8', '-1', '9', '-999', '3']}),
+    (DewPointObservationsParser, {'  TD': ['-2.3', '0.0', '-999', '11.7']}),
+    (SunshineObservationsParser, {'SD_SO': ['60', '0', '-999', '12.5']}),
+    (TemperatureObservationsParser, {
+        'RF_TU': ['85.0', '-999', '100.0', '47.0'],
+        'TT_TU': ['-11.3', '23.85', '-999', '0.1'],
+    }),
+    (VisibilityObservationsParser, {'V_VV': ['25000', '-999', '150']}),
+])
+def test_observations_parsers_decode_columns(
+        data_dir, tmp_path, parser_cls, values):
+    path = tmp_path / 'stundenwerte_XX_04911_akt.zip'
+    with zipfile.ZipFile(data_dir / 'observations_recent_FF_akt.zip') as zf:
+        metadata = zf.read('Metadaten_Geographie_04911.txt')
+    rows = len(next(iter(values.values())))
+    lines = [';'.join(['STATIONS_ID', 'MESS_DATUM', 'QN_9', *values, 'eor'])]
+    for i in range(rows):
+        lines.append(';'.join([
+            '       4911', f'20191231{19 + i}', '    3',
+            *(column[i] for column in values.values()), 'eor']))
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr('Metadaten_Geographie_04911.txt', metadata)
+        zf.writestr(
+            'produkt_xx_stunde_20191231_20200101_04911.txt',
+            '\r\n'.join(lines) + '\r\n')
+    rows, columns = _parse_rows_and_columns(parser_cls, path)
+    assert len(rows) == len(lines) - 1
+    assert columns == rows
+
+
+MOSMIX_KML = """<?xml version="1.0" encoding="ISO-8859-1" standalone="yes"?>
+<kml:kml xmlns:dwd="https://opendata.dwd.de/weather/lib/pointforecast_dwd_extension_V1_0.xsd" xmlns:kml="http://www.opengis.net/kml/2.2">
+<kml:Document>
+<kml:ExtendedData>
+<dwd:ProductDefinition>
+<dwd:ProductID>MOSMIX</dwd:ProductID>
+<dwd:IssueTime>2020-03-29T09:00:00.000Z</dwd:IssueTime>
+<dwd:ForecastTimeSteps>
+<dwd:TimeStep>2020-03-29T10:00:00.000Z</dwd:TimeStep>
+<dwd:TimeStep>2020-03-29T11:00:00.000Z</dwd:TimeStep>
+<dwd:TimeStep>2020-03-29T12:00:00.000Z</dwd:TimeStep>
+</dwd:ForecastTimeSteps>
+</dwd:ProductDefinition>
+</kml:ExtendedData>
+<kml:Placemark>
+<kml:name>01001</kml:name>
+<kml:description>JAN MAYEN</kml:description>
+<kml:ExtendedData>
+<dwd:Forecast dwd:elementName="TTT">
+<dwd:value>     271.75     271.85          -</dwd:value>
+</dwd:Forecast>
+<dwd:Forecast dwd:elementName="FF">
+<dwd:value>       4.63      -1.00       5.14</dwd:value>
+</dwd:Forecast>
+<dwd:Forecast dwd:elementName="ww">
+<dwd:value>          -      61.00       2.00</dwd:value>
+</dwd:Forecast>
+<dwd:Forecast dwd:elementName="E_TTT">
+<dwd:value>       0.80       0.90       1.00</dwd:value>
+</dwd:Forecast>
+</kml:ExtendedData>
+<kml:Point>
+<kml:coordinates>-8.67,70.93,10.0</kml:coordinates>
+</kml:Point>
+</kml:Placemark>
+<kml:Placemark>
+<kml:name>X001</kml:name>
+<kml:description>NOWHERE</kml:description>
+<kml:ExtendedData>
+<dwd:Forecast dwd:elementName="TTT">
+<dwd:value>     271.75     271.85     272.00</dwd:value>
+</dwd:Forecast>
+</kml:ExtendedData>
+</kml:Placemark>
+<kml:Placemark>
+<kml:name>10315</kml:name>
+<kml:description>MUENSTER/OSN.</kml:description>
+<kml:ExtendedData>
+<dwd:Forecast dwd:elementName="TTT">
+<dwd:value>     281.25     282.05     283.15</dwd:value>
+</dwd:Forecast>
+<dwd:Forecast dwd:elementName="N">
+<dwd:value>     100.00     105.00      50.00</dwd:value>
+</dwd:Forecast>
+</kml:ExtendedData>
+<kml:Point>
+<kml:coordinates>7.7,52.13,48.0</kml:coordinates>
+</kml:Point>
+</kml:Placemark>
+</kml:Document>
+</kml:kml>
+"""  # noqa: E501
+
+
+def test_mosmix_parser_streams_station_batches(tmp_path):
+    path = tmp_path / 'MOSMIX_S_LATEST_240.kmz'
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr('MOSMIX_S_2020032909_240.kml', MOSMIX_KML)
+    p = MOSMIXParser()
+    records = list(p.parse(path))
+    assert len(records) == 6
+    with settings(MOSMIX_STREAMING=True):
+        batches = list(p.parse(path))
+    assert [type(b) for b in batches] == [RecordBatch, RecordBatch]
+    assert list(iter_records(batches)) == records
+
+
 def test_radar_parser(data_dir):
     p = RadarParser()
     records = list(p.parse(data_dir / 'composite_rv_20250923_0855.tar'))
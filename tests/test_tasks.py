@@ -1,9 +1,19 @@
 import datetime
+import os
+import shutil
 
+import pytest
 from dateutil.tz import tzutc
 
+from brightsky import tasks
 from brightsky.export import DBExporter, SYNOPExporter
-from brightsky.tasks import clean
+from brightsky.parsers import WindObservationsParser
+from brightsky.partitions import PartitionManager
+from brightsky.tasks import (
+    clean, group_station_files, merge_records, parse_merged,
+    parse_records)
+
+from .utils import settings
 
 
 def test_clean_deletes_expired_parsed_files(db):
@@ -106,3 +116,155 @@ def test_clean_deletes_expired_forecast_current_synop_records(db):
     assert [r['temperature'] for r in rows] == [10., 30., 40.]
     rows = db.fetch('SELECT temperature FROM synop ORDER BY temperature')
     assert [r['temperature'] for r in rows] == [60., 70.]
+
+
+def test_clean_narrows_record_ranges_of_affected_sources(db):
+    now = datetime.datetime.now(datetime.UTC).replace(
+        minute=0, second=0, microsecond=0, tzinfo=tzutc())
+    other_place = {**PLACE, 'lat': 11, 'wmo_station_id': '10316'}
+    DBExporter().export([
+        {
+            'observation_type': 'current',
+            'timestamp': now - datetime.timedelta(hours=hours),
+            **place,
+            'temperature': 10.,
+        }
+        for hours in [0, 72]
+        for place in [PLACE, other_place]
+    ])
+    sources = db.fetch('SELECT * FROM sources ORDER BY id')
+    assert all(
+        s['first_record'] == now - datetime.timedelta(hours=72)
+        for s in sources)
+    # Records removed outside of clean are not noticed, since only sources
+    # that lost records to the retention deletes are recomputed
+    with db.cursor() as cur:
+        cur.execute(
+            """
+            DELETE FROM weather
+            WHERE source_id = %s AND timestamp < %s
+            """,
+            (sources[1]['id'], now))
+    db.commit()
+    clean()
+    sources = db.fetch('SELECT * FROM sources ORDER BY id')
+    assert sources[0]['first_record'] == now
+    assert sources[0]['last_record'] == now
+    assert sources[1]['first_record'] == now - datetime.timedelta(hours=72)
+
+
+def test_clean_drops_expired_partitions(db):
+    now = datetime.datetime.now(datetime.UTC).replace(tzinfo=tzutc())
+    manager = PartitionManager()
+    today = manager.get_partition_start('synop', now)
+    expired = today - datetime.timedelta(days=3)
+    # Without a partition for today, the current record is stored in the
+    # default partition until maintenance moves it
+    with db.cursor() as cur:
+        for partition in manager.get_partitions(db, 'synop').values():
+            cur.execute(f'DROP TABLE {partition}')
+    manager.create_partition(db, 'synop', expired)
+    db.commit()
+    SYNOPExporter().export([
+        {
+            'observation_type': 'synop',
+            'timestamp': timestamp,
+            **PLACE,
+            'temperature': 60.,
+        }
+        for timestamp in [expired, now - datetime.timedelta(hours=1)]
+    ])
+    assert len(db.table('synop_default')) == 1
+    clean()
+    partitions = manager.get_partitions(db, 'synop')
+    assert expired not in partitions
+    assert today in partitions
+    assert today + datetime.timedelta(days=2) in partitions
+    assert len(db.table('synop_default')) == 0
+    assert len(db.table(partitions[manager.get_partition_start(
+        'synop', now - datetime.timedelta(hours=1))])) == 1
+    radar_partitions = manager.get_partitions(db, 'radar')
+    assert manager.get_partition_start('radar', now) in radar_partitions
+
+
+def test_group_station_files():
+    base = 'https://example.com/hourly'
+    urls = [
+        f'{base}/wind/recent/stundenwerte_FF_01766_akt.zip',
+        f'{base}/sun/recent/stundenwerte_SD_01766_akt.zip',
+        f'{base}/wind/recent/stundenwerte_FF_04911_akt.zip',
+        f'{base}/wind/historical/stundenwerte_FF_01766_19360101_20231231_hist.zip',
+        f'{base}/sun/historical/stundenwerte_SD_01766_18910101_20231231_hist.zip',
+        'https://example.com/MOSMIX_S_LATEST_240.kmz',
+    ]
+    assert group_station_files(urls) == [
+        urls[0:2], urls[2:3], urls[3:5], urls[5:6]]
+
+
+def test_parse_merged(db, data_dir, monkeypatch, tmp_path):
+    def download(url, directory):
+        path = os.path.join(directory, os.path.basename(url))
+        shutil.copy(data_dir / 'observations_recent_FF_akt.zip', path)
+        return path, {
+            'url': url,
+            'last_modified': datetime.datetime(2020, 3, 19, tzinfo=tzutc()),
+            'file_size': os.path.getsize(path),
+        }
+
+    monkeypatch.setattr(tasks, 'download', download)
+    parse_merged([
+        'https://example.com/recent/stundenwerte_FF_04911_akt.zip',
+        'https://example.com/historical/stundenwerte_FF_04911_akt.zip',
+    ])
+    assert len(db.table('weather')) == 10
+    assert len(db.table('parsed_files')) == 2
+
+
+def test_merge_records():
+    t = [datetime.datetime(2020, 1, 1, h, tzinfo=tzutc()) for h in range(3)]
+    source = {f: None for f in DBExporter.SOURCE_FIELDS}
+    other_source = {**source, 'height': 10.}
+    parsed = []
+
+    def parse(records):
+        for r in records:
+            parsed.append(r)
+            yield r
+
+    merged = merge_records([
+        parse([
+            {**source, 'timestamp': t[0], 'temperature': 1},
+            {**other_source, 'timestamp': t[1], 'temperature': 2},
+            {**source, 'timestamp': t[2], 'temperature': 3},
+        ]),
+        parse([
+            {**source, 'timestamp': t[0], 'temperature': 0, 'wind_speed': 4},
+            {**source, 'timestamp': t[1], 'wind_speed': 5},
+        ]),
+    ])
+    assert next(merged) == {
+        **source, 'timestamp': t[0], 'temperature': 0, 'wind_speed': 4}
+    # Streamed instead of read at once
+    assert len(parsed) < 5
+    assert list(merged) == [
+        {**other_source, 'timestamp': t[1], 'temperature': 2},
+        {**source, 'timestamp': t[1], 'wind_speed': 5},
+        {**source, 'timestamp': t[2], 'temperature': 3},
+    ]
+    with pytest.raises(ValueError):
+        list(merge_records([[
+            {**source, 'timestamp': t[1]},
+            {**source, 'timestamp': t[0]},
+        ]]))
+
+
+def test_parse_records_in_process(data_dir, tmp_path):
+    path = tmp_path / 'stundenwerte_FF_01766_19360101_20231231_hist.zip'
+    shutil.copy(data_dir / 'observations_recent_FF_akt.zip', path)
+    parser = WindObservationsParser()
+    assert parser.is_cpu_bound(str(path))
+    expected = list(parser.parse(str(path)))
+    with settings(PARSE_PROCESSES=1):
+        assert list(parse_records(parser, str(path))) == expected
+        with pytest.raises(FileNotFoundError):
+            list(parse_records(parser, str(tmp_path / 'missing_hist.zip')))
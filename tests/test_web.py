@@ -1,5 +1,7 @@
+import asyncio
 import base64
 import datetime
+import os
 import zlib
 
 import numpy as np
@@ -10,8 +12,10 @@ from fastapi.testclient import TestClient
 import brightsky
 from brightsky.export import DBExporter, SYNOPExporter
 from brightsky.parsers import CAPParser, RadarParser
-from brightsky.query import _warn_cells
-from brightsky.web import make_app
+from brightsky.query import _warn_cells, get_statements
+from brightsky.web import app, make_app
+from brightsky.web.app import ctx
+from brightsky.web.replicas import DatabasePools
 
 from .utils import settings
 
@@ -303,6 +307,122 @@ def alerts_data(db, data_dir):
     _warn_cells.CELLS_CACHE_PATH = data_dir / 'alert_cells.json'
 
 
+def test_catalog_statements_are_prepared(data):
+    statements = [
+        s.sql for s in get_statements().values() if s.param_names]
+
+    async def count_prepared():
+        async with ctx['pools'].primary.acquire() as conn:
+            return await conn.fetchval(
+                'SELECT COUNT(*) FROM pg_prepared_statements '
+                'WHERE statement = ANY($1)',
+                statements,
+            )
+
+    with TestClient(app) as client:
+        assert client.portal.call(count_prepared) == len(statements)
+        resp = client.get('/weather?lat=52&lon=7.6&date=2020-08-20')
+        assert resp.status_code == 200
+        assert client.portal.call(count_prepared) == len(statements)
+
+
+def test_read_replicas(data):
+    replica_urls = [
+        os.environ['BRIGHTSKY_DATABASE_URL'],
+        'postgres://postgres@localhost:1/brightsky',
+    ]
+    with settings(DATABASE_REPLICA_URLS=replica_urls):
+        with TestClient(app) as client:
+            pools = ctx['pools']
+            replicas = pools.replicas
+            assert [r.healthy for r in replicas] == [True, False]
+            assert pools.reader().replica is replicas[0]
+            resp = client.get('/weather?lat=52&lon=7.6&date=2020-08-20')
+            assert resp.status_code == 200
+            # Replicas that become unreachable fall back to the primary
+            replicas[0].healthy, replicas[1].healthy = False, True
+            assert pools.reader().replica is replicas[1]
+            fallback_resp = client.get(
+                '/weather?lat=52&lon=7.6&date=2020-08-20')
+            assert fallback_resp.json() == resp.json()
+            assert not replicas[1].healthy
+            assert pools.reader() is pools.primary
+        with settings(DATABASE_REPLICA_MAX_LAG=-1.):
+            with TestClient(app) as client:
+                pools = ctx['pools']
+                assert pools.replicas[0].lag == 0
+                assert not pools.replicas[0].healthy
+                assert pools.reader() is pools.primary
+
+
+def test_read_replica_lag(db):
+    # Simulate a replica by shadowing the replication functions (and view)
+    # of pg_catalog
+    with db.cursor() as cur:
+        cur.execute("""
+            CREATE SCHEMA replica_sim;
+            CREATE TABLE replica_sim.state (
+                lsn pg_lsn, replayed_at timestamptz, status text);
+            CREATE FUNCTION replica_sim.pg_is_in_recovery() RETURNS boolean
+                AS 'SELECT true' LANGUAGE sql;
+            CREATE FUNCTION replica_sim.pg_last_wal_receive_lsn()
+                RETURNS pg_lsn
+                AS 'SELECT lsn FROM replica_sim.state' LANGUAGE sql;
+            CREATE FUNCTION replica_sim.pg_last_wal_replay_lsn()
+                RETURNS pg_lsn
+                AS 'SELECT lsn FROM replica_sim.state' LANGUAGE sql;
+            CREATE FUNCTION replica_sim.pg_last_xact_replay_timestamp()
+                RETURNS timestamptz
+                AS 'SELECT replayed_at FROM replica_sim.state' LANGUAGE sql;
+            CREATE VIEW replica_sim.pg_stat_wal_receiver AS
+                SELECT status FROM replica_sim.state WHERE status IS NOT NULL;
+        """)
+    db.commit()
+
+    def simulate(lsn, lag, status):
+        with db.cursor() as cur:
+            cur.execute('DELETE FROM replica_sim.state')
+            cur.execute(
+                """
+                INSERT INTO replica_sim.state
+                VALUES (%s, now() - %s * interval '1 second', %s)
+                """,
+                (lsn, lag, status))
+        db.commit()
+
+    async def check(primary_reachable=True):
+        url = os.environ['BRIGHTSKY_DATABASE_URL']
+        replica_url = f'{url}?search_path=replica_sim,pg_catalog,public'
+        async with DatabasePools(url, [replica_url], max_lag=30.) as pools:
+            replica = pools.replicas[0]
+            if not primary_reachable:
+                await pools.check(replica, None)
+            return replica.healthy, replica.lag
+
+    try:
+        # Caught up with the primary, no matter how long ago it last wrote
+        simulate('FFFFFFFF/FFFFFFFF', 3600, 'streaming')
+        assert asyncio.run(check()) == (True, 0)
+        # A replica whose WAL receiver disconnected has replayed everything
+        # it received, but falls behind the primary
+        simulate('0/1', 3600, None)
+        healthy, lag = asyncio.run(check())
+        assert not healthy
+        assert lag >= 3600
+        simulate('0/1', 10, None)
+        assert asyncio.run(check())[0]
+        # Without the primary's WAL position, only a streaming replica that
+        # replayed everything it received is up to date
+        simulate('0/1', 3600, 'streaming')
+        assert asyncio.run(check(primary_reachable=False)) == (True, 0)
+        simulate('0/1', 3600, None)
+        assert not asyncio.run(check(primary_reachable=False))[0]
+    finally:
+        with db.cursor() as cur:
+            cur.execute('DROP SCHEMA replica_sim CASCADE')
+        db.commit()
+
+
 def test_sources_required_parameters(data, api):
     assert api.get('/sources').status_code == 422
     assert api.get('/sources?lat=52').status_code == 422
@@ -440,6 +560,24 @@ def test_weather_units(data, api):
         assert data_si['weather'][0][k] == v
 
 
+def test_weather_compact_storage(db, api):
+    records = [
+        {**RECENT_RECORDS[i], 'temperature': 290.15 + i / 10}
+        for i in range(12)
+    ] + RECENT_RECORDS[12:13]
+    with settings(WEATHER_STORAGE='compact'):
+        DBExporter().export(records)
+        data_si = api.get(
+            '/weather?lat=52&lon=7.6&date=2020-08-19T12:00'
+            '&last_date=2020-08-20&units=si'
+        ).json()
+    assert len(data_si['weather']) == 13
+    for w, record in zip(data_si['weather'][:12], records):
+        assert w['temperature'] == round(record['temperature'], 2)
+    for k, v in ALL_FIELDS_RECORD.items():
+        assert data_si['weather'][12][k] == v
+
+
 def test_weather_timezone(data, api):
     resp = api.get(
         '/weather?lat=52&lon=7.6&date=2020-08-20&tz=Europe/Berlin')